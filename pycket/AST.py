@@ -1,7 +1,7 @@
 
 class AST(object):
-    _attrs_ = ["should_enter", "mvars", "surrounding_lambda"]
-    _immutable_fields_ = ["should_enter?", "surrounding_lambda"]
+    _attrs_ = ["should_enter", "mvars", "surrounding_lambda", "direct_depth"]
+    _immutable_fields_ = ["should_enter?", "surrounding_lambda", "direct_depth"]
     _settled_ = True
 
     should_enter = False # default value
@@ -9,6 +9,9 @@ class AST(object):
     surrounding_lambda = None
 
     simple = False
+    # how deep interpret_direct recurses to evaluate this AST, or -1 if it
+    # can only be evaluated with continuations
+    direct_depth = -1
 
     def defined_vars(self): return {}
 
@@ -23,6 +26,17 @@ class AST(object):
     def interpret_simple(self, env):
         raise NotImplementedError("abstract base class")
 
+    def is_direct(self):
+        return self.simple or self.direct_depth >= 0
+
+    def interpret_direct(self, env):
+        """ evaluate the AST recursively, without a continuation. only
+        allowed if is_direct() is true """
+        from pycket.values import Values
+        # default implementation for simple AST forms
+        assert self.simple
+        return Values.make1(self.interpret_simple(env))
+
     def set_surrounding_lambda(self, lam):
         from pycket.interpreter import Lambda
         assert isinstance(lam, Lambda)
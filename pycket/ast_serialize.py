@@ -0,0 +1,756 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Binary serialization of assign-converted module ASTs.
+#
+# The cache file starts with a header (magic, format version, source hash and
+# a checksum of the payload). The payload holds the list of modules the AST
+# requires, each with the key it had when the cache was written, followed by
+# the module itself. The key of a module covers its source and the keys of its
+# own requires, so the cache goes stale when anything it was expanded against
+# or inlined from changes. Symbols, strings and environment
+# structures (SymLists) are written once and referred to by index afterwards,
+# which keeps the files small and preserves sharing and identity: uninterned
+# symbols introduced by let-conversion and env_structures shared between AST
+# nodes come back as the same objects.
+#
+import os
+
+from rpython.rlib.rarithmetic import r_uint, intmask, LONG_BIT
+from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rmd5 import RMD5
+from rpython.rlib.rstring import StringBuilder
+from rpython.rlib.rstruct.ieee import float_pack, float_unpack
+from rpython.rlib.rarithmetic import r_ulonglong
+from rpython.rlib import streamio
+
+from pycket import values, vector, values_hash
+from pycket.env import SymList
+from pycket.error import SchemeException
+from pycket.interpreter import (Module, Require, Cell, Quote, QuoteSyntax,
+                                VariableReference, WithContinuationMark, App,
+                                Begin0, Begin, CellRef, LexicalVar, ModuleVar,
+                                ToplevelVar, SetBang, If, CaseLambda, Lambda,
+                                Letrec, Let, DefineValues)
+
+class SerializationError(SchemeException):
+    pass
+
+MAGIC = "PYCKETAST"
+FORMAT_VERSION = 3
+
+def _source_fingerprint():
+    "NON_RPYTHON"
+    # every change to the modules defining the AST (or how it is built,
+    # including the Racket side of the expander) invalidates existing caches
+    import hashlib
+    import pycket
+    h = hashlib.md5()
+    h.update(str(FORMAT_VERSION))
+    base = os.path.dirname(os.path.abspath(pycket.__file__))
+    for name in ["AST.py", "ast_serialize.py", "env.py", "expand.py",
+                 "interpreter.py", "simplify.py", "pycket-lang/expand.rkt"]:
+        with open(os.path.join(base, name)) as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+PYCKET_VERSION = _source_fingerprint()
+
+def source_hash(data):
+    return RMD5(data).hexdigest()
+
+# AST tags
+(T_NONE, T_REQUIRE, T_CELL, T_QUOTE, T_QUOTE_SYNTAX, T_VARIABLE_REFERENCE,
+ T_WCM, T_APP, T_BEGIN0, T_BEGIN, T_CELLREF, T_LEXICAL, T_MODULE_VAR,
+ T_TOPLEVEL, T_SET_BANG, T_IF, T_CASE_LAMBDA, T_LAMBDA, T_LETREC, T_LET,
+ T_DEFINE_VALUES) = range(21)
+
+# value tags
+(V_FALSE, V_TRUE, V_NULL, V_VOID, V_EOF, V_FIXNUM, V_FLONUM, V_BIGNUM,
+ V_RATIONAL, V_COMPLEX, V_STRING, V_BYTES, V_SYMBOL, V_KEYWORD, V_CHAR,
+ V_PATH, V_REGEXP, V_PREGEXP, V_BYTE_REGEXP, V_BYTE_PREGEXP, V_CONS,
+ V_VECTOR, V_BOX, V_HASH) = range(24)
+
+# symbol kinds
+S_INTERNED, S_UNREADABLE, S_UNINTERNED = range(3)
+
+# shared objects (symbols, strings, SymLists) are written as NONE, or as NEW
+# followed by their contents, or as BACKREF followed by the index of an
+# object written before
+NONE, NEW, BACKREF = range(3)
+
+
+class ASTWriter(object):
+    def __init__(self):
+        self.builder = StringBuilder()
+        self.symbols = {}
+        self.strings = {}
+        self.symlists = {}
+        self.requires = []
+
+    def write_byte(self, b):
+        self.builder.append(chr(b))
+
+    def write_uint(self, u):
+        u = r_uint(u)
+        while u >= 0x80:
+            self.builder.append(chr(intmask(u & 0x7f) | 0x80))
+            u = u >> 7
+        self.builder.append(chr(intmask(u)))
+
+    def write_int(self, n):
+        # zigzag encoding, so that small negative numbers stay small
+        u = (r_uint(n) << 1) ^ r_uint(n >> (LONG_BIT - 1))
+        self.write_uint(u)
+
+    def write_bool(self, b):
+        self.write_byte(1 if b else 0)
+
+    def write_str(self, s):
+        self.write_uint(len(s))
+        self.builder.append(s)
+
+    def write_shared_str(self, s):
+        if s is None:
+            self.write_byte(NONE)
+            return
+        index = self.strings.get(s, -1)
+        if index >= 0:
+            self.write_byte(BACKREF)
+            self.write_uint(index)
+        else:
+            self.strings[s] = len(self.strings)
+            self.write_byte(NEW)
+            self.write_str(s)
+
+    def write_symbol(self, w_sym):
+        if w_sym is None:
+            self.write_byte(NONE)
+            return
+        index = self.symbols.get(w_sym, -1)
+        if index >= 0:
+            self.write_byte(BACKREF)
+            self.write_uint(index)
+            return
+        self.symbols[w_sym] = len(self.symbols)
+        self.write_byte(NEW)
+        if not w_sym.is_interned():
+            self.write_byte(S_UNINTERNED)
+        elif w_sym.unreadable:
+            self.write_byte(S_UNREADABLE)
+        else:
+            self.write_byte(S_INTERNED)
+        self.write_str(w_sym.value)
+
+    def write_symbols(self, syms):
+        self.write_uint(len(syms))
+        for w_sym in syms:
+            self.write_symbol(w_sym)
+
+    def write_ints(self, ints):
+        self.write_uint(len(ints))
+        for i in ints:
+            self.write_int(i)
+
+    def write_symlist(self, symlist):
+        if symlist is None:
+            self.write_byte(NONE)
+            return
+        index = self.symlists.get(symlist, -1)
+        if index >= 0:
+            self.write_byte(BACKREF)
+            self.write_uint(index)
+            return
+        self.write_byte(NEW)
+        self.write_symbols(symlist.elems)
+        self.write_symlist(symlist.prev)
+        # registered after the children, in the order the reader creates them
+        self.symlists[symlist] = len(self.symlists)
+
+    def write_value(self, w_val):
+        if w_val is values.w_false:
+            self.write_byte(V_FALSE)
+        elif w_val is values.w_true:
+            self.write_byte(V_TRUE)
+        elif w_val is values.w_null:
+            self.write_byte(V_NULL)
+        elif w_val is values.w_void:
+            self.write_byte(V_VOID)
+        elif w_val is values.eof_object:
+            self.write_byte(V_EOF)
+        elif isinstance(w_val, values.W_Fixnum):
+            self.write_byte(V_FIXNUM)
+            self.write_int(w_val.value)
+        elif isinstance(w_val, values.W_Flonum):
+            self.write_byte(V_FLONUM)
+            bits = float_pack(w_val.value, 8)
+            for i in range(8):
+                self.write_byte(intmask((bits >> (8 * i)) & 0xff))
+        elif isinstance(w_val, values.W_Bignum):
+            self.write_byte(V_BIGNUM)
+            self.write_str(w_val.value.str())
+        elif isinstance(w_val, values.W_Rational):
+            self.write_byte(V_RATIONAL)
+            self.write_str(w_val._numerator.str())
+            self.write_str(w_val._denominator.str())
+        elif isinstance(w_val, values.W_Complex):
+            self.write_byte(V_COMPLEX)
+            self.write_value(w_val.real)
+            self.write_value(w_val.imag)
+        elif isinstance(w_val, values.W_String):
+            self.write_byte(V_STRING)
+            self.write_str(w_val.value)
+        elif isinstance(w_val, values.W_Bytes):
+            self.write_byte(V_BYTES)
+            self.write_str(w_val.as_str())
+        elif isinstance(w_val, values.W_Symbol):
+            self.write_byte(V_SYMBOL)
+            self.write_symbol(w_val)
+        elif isinstance(w_val, values.W_Keyword):
+            self.write_byte(V_KEYWORD)
+            self.write_str(w_val.value)
+        elif isinstance(w_val, values.W_Character):
+            self.write_byte(V_CHAR)
+            self.write_uint(ord(w_val.value))
+        elif isinstance(w_val, values.W_Path):
+            self.write_byte(V_PATH)
+            self.write_str(w_val.path)
+        elif isinstance(w_val, values.W_Regexp):
+            self.write_byte(V_REGEXP)
+            self.write_str(w_val.str)
+        elif isinstance(w_val, values.W_PRegexp):
+            self.write_byte(V_PREGEXP)
+            self.write_str(w_val.str)
+        elif isinstance(w_val, values.W_ByteRegexp):
+            self.write_byte(V_BYTE_REGEXP)
+            self.write_str(w_val.str)
+        elif isinstance(w_val, values.W_BytePRegexp):
+            self.write_byte(V_BYTE_PREGEXP)
+            self.write_str(w_val.str)
+        elif isinstance(w_val, values.W_Cons):
+            self.write_byte(V_CONS)
+            self.write_value(w_val.car())
+            self.write_value(w_val.cdr())
+        elif isinstance(w_val, vector.W_Vector):
+            self.write_byte(V_VECTOR)
+            length = w_val.length()
+            self.write_uint(length)
+            for i in range(length):
+                self.write_value(w_val.ref(i))
+        elif isinstance(w_val, values.W_IBox):
+            self.write_byte(V_BOX)
+            self.write_value(w_val.value)
+        elif isinstance(w_val, values_hash.W_ImmutableEqualHashTable):
+            self.write_byte(V_HASH)
+            items = w_val.hash_items()
+            self.write_uint(len(items))
+            for k, v in items:
+                self.write_value(k)
+                self.write_value(v)
+        else:
+            # e.g. prefab structs: the module is simply not cached
+            raise SerializationError("cannot serialize value %s" % w_val.tostring())
+
+    def write_asts(self, asts):
+        self.write_uint(len(asts))
+        for ast in asts:
+            self.write_ast(ast)
+
+    def write_ast(self, ast):
+        from pycket.expand import LazyLambdaBody
+        if ast is None:
+            self.write_byte(T_NONE)
+        elif isinstance(ast, LazyLambdaBody):
+            self.write_ast(ast.force())
+        elif isinstance(ast, Require):
+            self.write_byte(T_REQUIRE)
+            self.write_uint(len(self.requires))
+            self.requires.append(ast.modname)
+        elif isinstance(ast, Cell):
+            self.write_byte(T_CELL)
+            self.write_ast(ast.expr)
+            self.write_uint(len(ast.need_cell_flags))
+            for flag in ast.need_cell_flags:
+                self.write_bool(flag)
+        elif isinstance(ast, Quote):
+            self.write_byte(T_QUOTE)
+            self.write_value(ast.w_val)
+        elif isinstance(ast, QuoteSyntax):
+            self.write_byte(T_QUOTE_SYNTAX)
+            self.write_value(ast.w_val)
+        elif isinstance(ast, VariableReference):
+            self.write_byte(T_VARIABLE_REFERENCE)
+            self.write_ast(ast.var)
+            self.write_shared_str(ast.path)
+            self.write_bool(ast.is_mut)
+        elif isinstance(ast, WithContinuationMark):
+            self.write_byte(T_WCM)
+            self.write_ast(ast.key)
+            self.write_ast(ast.value)
+            self.write_ast(ast.body)
+        elif isinstance(ast, App):
+            self.write_byte(T_APP)
+            self.write_ast(ast.rator)
+            self.write_asts(ast.rands)
+            self.write_symlist(ast.env_structure)
+        elif isinstance(ast, Begin0):
+            self.write_byte(T_BEGIN0)
+            self.write_ast(ast.first)
+            self.write_ast(ast.body)
+        elif isinstance(ast, Begin):
+            self.write_byte(T_BEGIN)
+            self.write_asts(ast.body)
+        elif isinstance(ast, CellRef):
+            self.write_byte(T_CELLREF)
+            self.write_symbol(ast.sym)
+            self.write_symlist(ast.env_structure)
+        elif isinstance(ast, LexicalVar):
+            self.write_byte(T_LEXICAL)
+            self.write_symbol(ast.sym)
+            self.write_symlist(ast.env_structure)
+        elif isinstance(ast, ModuleVar):
+            self.write_byte(T_MODULE_VAR)
+            self.write_symbol(ast.sym)
+            self.write_shared_str(ast.srcmod)
+            self.write_symbol(ast.srcsym)
+        elif isinstance(ast, ToplevelVar):
+            self.write_byte(T_TOPLEVEL)
+            self.write_symbol(ast.sym)
+        elif isinstance(ast, SetBang):
+            self.write_byte(T_SET_BANG)
+            self.write_ast(ast.var)
+            self.write_ast(ast.rhs)
+        elif isinstance(ast, If):
+            self.write_byte(T_IF)
+            self.write_ast(ast.tst)
+            self.write_ast(ast.thn)
+            self.write_ast(ast.els)
+        elif isinstance(ast, CaseLambda):
+            self.write_byte(T_CASE_LAMBDA)
+            self.write_asts(ast.lams)
+            self.write_symbol(ast.recursive_sym)
+        elif isinstance(ast, Lambda):
+            self.write_byte(T_LAMBDA)
+            self.write_symbols(ast.formals)
+            self.write_symbol(ast.rest)
+            self.write_symlist(ast.args)
+            self.write_symlist(ast.frees)
+            self.write_asts(ast.body)
+            self.write_int(ast.srcpos)
+            self.write_shared_str(ast.srcfile)
+            self.write_symlist(ast.enclosing_env_structure)
+            self.write_symlist(ast.env_structure)
+        elif isinstance(ast, Letrec):
+            self.write_byte(T_LETREC)
+            self.write_symlist(ast.args)
+            self.write_ints(ast.counts)
+            self.write_asts(ast.rhss)
+            self.write_asts(ast.body)
+        elif isinstance(ast, Let):
+            self.write_byte(T_LET)
+            self.write_symlist(ast.args)
+            self.write_ints(ast.counts)
+            self.write_asts(ast.rhss)
+            self.write_asts(ast.body)
+            self.write_ints(ast.remove_num_envs)
+        elif isinstance(ast, DefineValues):
+            self.write_byte(T_DEFINE_VALUES)
+            self.write_symbols(ast.names)
+            self.write_ast(ast.rhs)
+            self.write_symbols(ast.display_names)
+        else:
+            raise SerializationError("cannot serialize AST %s" % ast.tostring())
+
+    def write_module(self, module):
+        self.write_shared_str(module.name)
+        self.write_uint(len(module.config))
+        for k, v in module.config.iteritems():
+            self.write_str(k)
+            self.write_str(v)
+        self.write_asts(module.body)
+        inlinable = module.inlinable
+        if inlinable is None:
+            inlinable = {}
+        self.write_uint(len(inlinable))
+        for sym, caselam in inlinable.iteritems():
+            self.write_symbol(sym)
+            self.write_ast(caselam)
+
+
+class ASTReader(object):
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+        self.symbols = []
+        self.strings = []
+        self.symlists = []
+        self.requires = []
+
+    def read_byte(self):
+        pos = self.pos
+        if pos >= len(self.data):
+            raise SerializationError("unexpected end of AST cache")
+        self.pos = pos + 1
+        return ord(self.data[pos])
+
+    def read_uint(self):
+        result = r_uint(0)
+        shift = 0
+        while True:
+            b = self.read_byte()
+            result |= r_uint(b & 0x7f) << shift
+            if b < 0x80:
+                return result
+            shift += 7
+
+    def read_int(self):
+        u = self.read_uint()
+        return intmask((u >> 1) ^ (r_uint(0) - (u & 1)))
+
+    def read_length(self):
+        return intmask(self.read_uint())
+
+    def read_bool(self):
+        return self.read_byte() != 0
+
+    def read_str(self):
+        length = self.read_length()
+        start = self.pos
+        stop = start + length
+        if length < 0 or stop > len(self.data):
+            raise SerializationError("unexpected end of AST cache")
+        assert start >= 0 and stop >= 0
+        self.pos = stop
+        return self.data[start:stop]
+
+    def read_shared_str(self):
+        kind = self.read_byte()
+        if kind == NONE:
+            return None
+        if kind == BACKREF:
+            return self.strings[self.read_length()]
+        s = self.read_str()
+        self.strings.append(s)
+        return s
+
+    def read_symbol(self):
+        kind = self.read_byte()
+        if kind == NONE:
+            return None
+        if kind == BACKREF:
+            return self.symbols[self.read_length()]
+        sym_kind = self.read_byte()
+        name = self.read_str()
+        if sym_kind == S_INTERNED:
+            w_sym = values.W_Symbol.make(name)
+        elif sym_kind == S_UNREADABLE:
+            w_sym = values.W_Symbol.make_unreadable(name)
+        else:
+            w_sym = values.W_Symbol(name)
+        self.symbols.append(w_sym)
+        return w_sym
+
+    def read_symbols(self):
+        return [self.read_symbol() for i in range(self.read_length())]
+
+    def read_ints(self):
+        return [self.read_int() for i in range(self.read_length())]
+
+    def read_symlist(self):
+        kind = self.read_byte()
+        if kind == NONE:
+            return None
+        if kind == BACKREF:
+            return self.symlists[self.read_length()]
+        elems = self.read_symbols()
+        prev = self.read_symlist()
+        symlist = SymList(elems, prev)
+        self.symlists.append(symlist)
+        return symlist
+
+    def read_value(self):
+        tag = self.read_byte()
+        if tag == V_FALSE:
+            return values.w_false
+        if tag == V_TRUE:
+            return values.w_true
+        if tag == V_NULL:
+            return values.w_null
+        if tag == V_VOID:
+            return values.w_void
+        if tag == V_EOF:
+            return values.eof_object
+        if tag == V_FIXNUM:
+            return values.W_Fixnum.make(self.read_int())
+        if tag == V_FLONUM:
+            bits = r_ulonglong(0)
+            for i in range(8):
+                bits |= r_ulonglong(self.read_byte()) << (8 * i)
+            return values.W_Flonum(float_unpack(bits, 8))
+        if tag == V_BIGNUM:
+            return values.W_Bignum(rbigint.fromdecimalstr(self.read_str()))
+        if tag == V_RATIONAL:
+            num = rbigint.fromdecimalstr(self.read_str())
+            den = rbigint.fromdecimalstr(self.read_str())
+            return values.W_Rational(num, den)
+        if tag == V_COMPLEX:
+            real = self.read_value()
+            imag = self.read_value()
+            assert isinstance(real, values.W_Number)
+            assert isinstance(imag, values.W_Number)
+            return values.W_Complex.make(real, imag)
+        if tag == V_STRING:
+            return values.W_String.make(self.read_str())
+        if tag == V_BYTES:
+            return values.W_Bytes.from_string(self.read_str())
+        if tag == V_SYMBOL:
+            return self.read_symbol()
+        if tag == V_KEYWORD:
+            return values.W_Keyword.make(self.read_str())
+        if tag == V_CHAR:
+            return values.W_Character.make(unichr(self.read_length()))
+        if tag == V_PATH:
+            return values.W_Path(self.read_str())
+        if tag == V_REGEXP:
+            return values.W_Regexp(self.read_str())
+        if tag == V_PREGEXP:
+            return values.W_PRegexp(self.read_str())
+        if tag == V_BYTE_REGEXP:
+            return values.W_ByteRegexp(self.read_str())
+        if tag == V_BYTE_PREGEXP:
+            return values.W_BytePRegexp(self.read_str())
+        if tag == V_CONS:
+            car = self.read_value()
+            cdr = self.read_value()
+            return values.W_Cons.make(car, cdr)
+        if tag == V_VECTOR:
+            elems = [self.read_value() for i in range(self.read_length())]
+            return vector.W_Vector.fromelements(elems, immutable=True)
+        if tag == V_BOX:
+            return values.W_IBox(self.read_value())
+        if tag == V_HASH:
+            keys = []
+            vals = []
+            for i in range(self.read_length()):
+                keys.append(self.read_value())
+                vals.append(self.read_value())
+            return values_hash.empty_immutable_equal_hash.from_lists(keys, vals)
+        raise SerializationError("unknown value tag %s in AST cache" % tag)
+
+    def read_asts(self):
+        return [self.read_ast() for i in range(self.read_length())]
+
+    def read_ast(self):
+        tag = self.read_byte()
+        if tag == T_NONE:
+            return None
+        if tag == T_REQUIRE:
+            modname, module = self.requires[self.read_length()]
+            return Require(modname, module)
+        if tag == T_CELL:
+            expr = self.read_ast()
+            flags = [self.read_bool() for i in range(self.read_length())]
+            return Cell(expr, flags)
+        if tag == T_QUOTE:
+            return Quote(self.read_value())
+        if tag == T_QUOTE_SYNTAX:
+            return QuoteSyntax(self.read_value())
+        if tag == T_VARIABLE_REFERENCE:
+            var = self.read_ast()
+            path = self.read_shared_str()
+            is_mut = self.read_bool()
+            return VariableReference(var, path, is_mut)
+        if tag == T_WCM:
+            key = self.read_ast()
+            value = self.read_ast()
+            body = self.read_ast()
+            return WithContinuationMark(key, value, body)
+        if tag == T_APP:
+            rator = self.read_ast()
+            rands = self.read_asts()
+            return App(rator, rands, self.read_symlist())
+        if tag == T_BEGIN0:
+            first = self.read_ast()
+            return Begin0(first, self.read_ast())
+        if tag == T_BEGIN:
+            return Begin(self.read_asts())
+        if tag == T_CELLREF:
+            sym = self.read_symbol()
+            return CellRef(sym, self.read_symlist())
+        if tag == T_LEXICAL:
+            sym = self.read_symbol()
+            return LexicalVar(sym, self.read_symlist())
+        if tag == T_MODULE_VAR:
+            sym = self.read_symbol()
+            srcmod = self.read_shared_str()
+            return ModuleVar(sym, srcmod, self.read_symbol())
+        if tag == T_TOPLEVEL:
+            return ToplevelVar(self.read_symbol())
+        if tag == T_SET_BANG:
+            var = self.read_ast()
+            return SetBang(var, self.read_ast())
+        if tag == T_IF:
+            tst = self.read_ast()
+            thn = self.read_ast()
+            return If(tst, thn, self.read_ast())
+        if tag == T_CASE_LAMBDA:
+            lams = self.read_asts()
+            return CaseLambda(lams, self.read_symbol())
+        if tag == T_LAMBDA:
+            formals = self.read_symbols()
+            rest = self.read_symbol()
+            args = self.read_symlist()
+            frees = self.read_symlist()
+            body = self.read_asts()
+            srcpos = self.read_int()
+            srcfile = self.read_shared_str()
+            enclosing_env_structure = self.read_symlist()
+            env_structure = self.read_symlist()
+            return Lambda(formals, rest, args, frees, body, srcpos, srcfile,
+                          enclosing_env_structure, env_structure)
+        if tag == T_LETREC:
+            args = self.read_symlist()
+            counts = self.read_ints()
+            rhss = self.read_asts()
+            return Letrec(args, counts, rhss, self.read_asts())
+        if tag == T_LET:
+            args = self.read_symlist()
+            counts = self.read_ints()
+            rhss = self.read_asts()
+            body = self.read_asts()
+            return Let(args, counts, rhss, body, self.read_ints())
+        if tag == T_DEFINE_VALUES:
+            names = self.read_symbols()
+            rhs = self.read_ast()
+            return DefineValues(names, rhs, self.read_symbols())
+        raise SerializationError("unknown AST tag %s in AST cache" % tag)
+
+    def read_module(self):
+        name = self.read_shared_str()
+        config = {}
+        for i in range(self.read_length()):
+            k = self.read_str()
+            config[k] = self.read_str()
+        body = self.read_asts()
+        inlinable = {}
+        for i in range(self.read_length()):
+            sym = self.read_symbol()
+            caselam = self.read_ast()
+            assert isinstance(caselam, CaseLambda)
+            inlinable[sym] = caselam
+        return Module(name, body, config, inlinable)
+
+
+def serialize_module(module, source_hash, dependency_keys):
+    writer = ASTWriter()
+    writer.write_module(module)
+    body = writer.builder.build()
+    payload = ASTWriter()
+    payload.write_uint(len(writer.requires))
+    for modname in writer.requires:
+        payload.write_str(modname)
+        payload.write_str(dependency_keys.get(modname, ""))
+    payload.builder.append(body)
+    data = payload.builder.build()
+    header = ASTWriter()
+    header.builder.append(MAGIC)
+    header.write_str(PYCKET_VERSION)
+    header.write_str(source_hash)
+    header.write_str(RMD5(data).hexdigest())
+    header.builder.append(data)
+    return header.builder.build()
+
+def _open_payload(data, source_hash):
+    # a reader positioned at the start of the payload, or None if data is not
+    # a valid cache for a source with the given hash
+    if not data.startswith(MAGIC):
+        return None
+    reader = ASTReader(data, len(MAGIC))
+    try:
+        if reader.read_str() != PYCKET_VERSION:
+            return None
+        if reader.read_str() != source_hash:
+            return None
+        checksum = reader.read_str()
+    except SerializationError:
+        return None
+    start = reader.pos
+    assert start >= 0
+    if RMD5(data[start:]).hexdigest() != checksum:
+        return None
+    # the checksum matched, so the rest can be read without further checks
+    return reader
+
+def deserialize_module(data, source_hash, load_require, dependency_keys):
+    """ Returns the module stored in data, or None if data is not a valid
+    cache for a source with the given hash. load_require is called on every
+    module path the module requires, in order, before the module itself is
+    built; it returns the Module to instantiate or None. Once a require is
+    loaded, its key in dependency_keys has to match the one stored in data,
+    otherwise the cache is out of date. """
+    reader = _open_payload(data, source_hash)
+    if reader is None:
+        return None
+    # the requires are only done once the data is known to be good
+    modnames = []
+    keys = []
+    for i in range(reader.read_length()):
+        modnames.append(reader.read_str())
+        keys.append(reader.read_str())
+    for i in range(len(modnames)):
+        modname = modnames[i]
+        reader.requires.append((modname, load_require(modname)))
+        if dependency_keys.get(modname, "") != keys[i]:
+            return None
+    return reader.read_module()
+
+def _read_file(cache_file):
+    try:
+        f = streamio.open_file_as_stream(cache_file, "rb")
+        data = f.readall()
+        f.close()
+    except (OSError, IOError, streamio.StreamError):
+        return None
+    return data
+
+def read_cache(cache_file, source_hash, load_require, dependency_keys):
+    data = _read_file(cache_file)
+    if data is None:
+        return None
+    return deserialize_module(data, source_hash, load_require, dependency_keys)
+
+def read_cache_requires(cache_file, source_hash):
+    """ The module paths required by the module cached in cache_file, or None
+    if there is no valid cache. """
+    data = _read_file(cache_file)
+    if data is None:
+        return None
+    reader = _open_payload(data, source_hash)
+    if reader is None:
+        return None
+    requires = []
+    for i in range(reader.read_length()):
+        requires.append(reader.read_str())
+        reader.read_str() # the key
+    return requires
+
+def write_cache(cache_file, source_hash, module, dependency_keys):
+    try:
+        data = serialize_module(module, source_hash, dependency_keys)
+    except SerializationError:
+        return False
+    # write to a private file first and rename it into place, so that
+    # concurrent processes sharing the cache never see a partial file
+    tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    try:
+        f = streamio.open_file_as_stream(tmp_file, "wb")
+        f.write(data)
+        f.close()
+        os.rename(tmp_file, cache_file)
+    except (OSError, IOError, streamio.StreamError):
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        return False
+    return True
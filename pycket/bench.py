@@ -0,0 +1,240 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark harness for the benchmark programs in pycket/test.
+#
+# Every benchmark is run several times on each virtual machine it has a
+# program for: Pycket and Racket run the .rkt version (or, for benchmarks
+# that only exist as .sch, the .sch source wrapped in `#lang pycket
+# #:stdlib`), Gambit runs the .sch version, compiled once with gsc. The time
+# of a run is the `RESULT-cpu` reported by pycket-lang's `time` macro (or
+# the cpu time reported by Gambit's `time`), and the wall-clock time of the
+# process for programs that report nothing. A program that reports several
+# times contributes all of them, in order.
+#
+# For every benchmark and VM the harness prints the warmup curve (all times,
+# in order) and the median of the times after the first --warmup ones. With
+# --save-baseline the medians are stored in the baseline file, otherwise
+# they are compared against it and slowdowns beyond --threshold are flagged
+# as regressions, which makes the harness exit with status 1.
+#
+#   python pycket/bench.py [-n <runs>] [--vm pycket,racket,gambit]
+#                          [--baseline <file>] [--save-baseline]
+#                          [--results <file>] [<benchmark> ...]
+#
+
+import json
+import optparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEST_DIR = os.path.join(BASE_DIR, "test")
+DEFAULT_BASELINE = os.path.join(BASE_DIR, "bench-baseline.json")
+
+# name, Pycket/Racket program, Gambit program
+BENCHMARKS = [
+    ("ack", "ack.rkt", None),
+    ("nbody", "nbody.rkt", None),
+    ("fannkuch-redux", "fannkuch-redux.rkt", None),
+    ("spectral-norm", "spectral-norm.rkt", None),
+    ("spectral-norm-simple", "spectral-norm-simple.rkt", None),
+    ("spectral-norm-safe", "spectral-norm-safe.rkt", None),
+    ("earley", "earley.rkt", "earley.sch"),
+    ("nucleic2", "nucleic2.rkt", "nucleic2.sch"),
+    ("nqueens", "nqueens.rkt", "nqueens.sch"),
+    ("puzzle", "puzzle.rkt", "puzzle.sch"),
+    ("triangle", "triangle.rkt", "triangle.sch"),
+    ("vector_iterate", "vector_iterate.rkt", "vector_iterate.sch"),
+    ("ctak", None, "ctak.sch"),
+    ("tak", None, "tak.sch"),
+    ("takl", None, "takl.sch"),
+    ("takr", None, "takr.sch"),
+    ("takr2", None, "takr2.sch"),
+    ("bubble", "bubble.rkt", "bubble.sch"),
+    ("bubble-imp", "bubble-imp.rkt", "bubble-imp.sch"),
+    ("bubble-unsafe", "bubble-unsafe.rkt", "bubble-unsafe.sch"),
+    ("bubble-unsafe2", "bubble-unsafe2.rkt", None),
+    ("bubble-con", "bubble-con.rkt", None),
+    ("bubble-imp-check", "bubble-imp-check.rkt", None),
+    ("bubble-unit", "bubble-unit.rkt", None),
+    ("param-depth", "param-depth.rkt", None),
+]
+
+VMS = ["pycket", "racket", "gambit"]
+
+RESULT_RE = re.compile(r"^RESULT-cpu: (\d+(?:\.\d*)?)", re.MULTILINE)
+GAMBIT_RE = re.compile(r"(\d+(?:\.\d*)?) ms cpu time")
+
+class BenchmarkError(Exception):
+    pass
+
+def median(times):
+    times = sorted(times)
+    n = len(times)
+    if n % 2:
+        return times[n // 2]
+    return (times[n // 2 - 1] + times[n // 2]) / 2.0
+
+def run_process(cmd, cwd):
+    start = time.time()
+    try:
+        p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+    except OSError, e:
+        raise BenchmarkError("cannot run %s: %s" % (cmd[0], e))
+    out, _ = p.communicate()
+    elapsed = (time.time() - start) * 1000
+    if p.returncode != 0:
+        raise BenchmarkError("%s failed with status %s:\n%s" % (
+            " ".join(cmd), p.returncode, out))
+    return out, elapsed
+
+def parse_times(out, elapsed, pattern):
+    times = [float(t) for t in pattern.findall(out)]
+    return times or [elapsed]
+
+class Runner(object):
+    def __init__(self, options, workdir):
+        self.options = options
+        self.workdir = workdir
+
+    def racket_program(self, rkt, sch):
+        # benchmarks that only exist as Scheme are run as #lang pycket
+        if rkt is not None:
+            return os.path.join(TEST_DIR, rkt)
+        wrapper = os.path.join(self.workdir, sch[:-len(".sch")] + ".rkt")
+        if not os.path.exists(wrapper):
+            with open(os.path.join(TEST_DIR, sch)) as f:
+                source = f.read()
+            with open(wrapper, "w") as f:
+                f.write("#lang pycket #:stdlib\n" + source)
+        return wrapper
+
+    def gambit_program(self, sch):
+        exe = os.path.join(self.workdir, sch + ".exe")
+        if not os.path.exists(exe):
+            run_process([self.options.gambit, "-exe", "-o", exe,
+                         os.path.join(TEST_DIR, sch)], self.workdir)
+        return exe
+
+    def command(self, vm, rkt, sch):
+        if vm == "pycket":
+            return [self.options.pycket, self.racket_program(rkt, sch)], RESULT_RE
+        if vm == "racket":
+            return [self.options.racket, self.racket_program(rkt, sch)], RESULT_RE
+        if vm == "gambit" and sch is not None:
+            return [self.gambit_program(sch)], GAMBIT_RE
+        return None, None
+
+    def run(self, vm, rkt, sch):
+        cmd, pattern = self.command(vm, rkt, sch)
+        if cmd is None:
+            return None
+        times = []
+        for i in range(self.options.runs):
+            out, elapsed = run_process(cmd, os.path.dirname(cmd[-1]))
+            times.extend(parse_times(out, elapsed, pattern))
+        return times
+
+def load_baseline(fname):
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+def save_json(fname, data):
+    with open(fname, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def parse_options(argv):
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("-n", "--runs", type="int", default=5,
+                      help="number of runs per benchmark and VM")
+    parser.add_option("--warmup", type="int", default=1,
+                      help="number of leading times left out of the median")
+    parser.add_option("--vm", default="pycket",
+                      help="comma separated VMs to run: %s" % ",".join(VMS))
+    parser.add_option("--pycket", default=os.environ.get("PYCKET", "./pycket-c"),
+                      help="Pycket executable (default: $PYCKET or ./pycket-c)")
+    parser.add_option("--racket", default="racket")
+    parser.add_option("--gambit", default="gsc")
+    parser.add_option("--baseline", default=DEFAULT_BASELINE,
+                      help="baseline file (default: %default)")
+    parser.add_option("--save-baseline", action="store_true", default=False,
+                      help="store the medians as the new baseline")
+    parser.add_option("--threshold", type="float", default=0.1,
+                      help="relative slowdown flagged as a regression")
+    parser.add_option("--results", default=None,
+                      help="write all times and medians to this JSON file")
+    options, names = parser.parse_args(argv[1:])
+    options.pycket = os.path.abspath(options.pycket)
+    vms = options.vm.split(",")
+    for vm in vms:
+        if vm not in VMS:
+            parser.error("unknown VM %s" % vm)
+    known = [b[0] for b in BENCHMARKS]
+    for name in names:
+        if name not in known:
+            parser.error("unknown benchmark %s" % name)
+    return options, vms, names
+
+def main(argv):
+    options, vms, names = parse_options(argv)
+    benchmarks = [b for b in BENCHMARKS if not names or b[0] in names]
+    baseline = load_baseline(options.baseline)
+    results = {}
+    regressions = []
+    failures = []
+    workdir = tempfile.mkdtemp(prefix="pycket-bench-")
+    runner = Runner(options, workdir)
+    try:
+        for name, rkt, sch in benchmarks:
+            for vm in vms:
+                key = "%s/%s" % (vm, name)
+                try:
+                    times = runner.run(vm, rkt, sch)
+                except BenchmarkError, e:
+                    print "%-32s FAILED" % key
+                    failures.append((key, str(e)))
+                    continue
+                if times is None:
+                    continue
+                steady = times[options.warmup:] or times
+                med = median(steady)
+                results[key] = {"times": times, "median": med}
+                line = "%-32s median %10.1f ms" % (key, med)
+                old = baseline.get(key)
+                if old is not None and not options.save_baseline:
+                    change = (med - old) / old if old else 0.0
+                    line += "  baseline %10.1f ms  %+6.1f%%" % (old, 100 * change)
+                    if change > options.threshold:
+                        line += "  REGRESSION"
+                        regressions.append(key)
+                print line
+                print "%-32s warmup %s" % ("", " ".join(["%.1f" % t for t in times]))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for key, message in failures:
+        print
+        print "%s: %s" % (key, message)
+    if options.results:
+        save_json(options.results, results)
+    if options.save_baseline:
+        baseline.update(dict([(k, r["median"]) for k, r in results.items()]))
+        save_json(options.baseline, baseline)
+        print "baseline written to %s" % options.baseline
+    if regressions:
+        print
+        print "%d regression(s): %s" % (len(regressions), ", ".join(regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
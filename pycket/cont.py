@@ -3,15 +3,25 @@ import inspect
 from rpython.rlib import jit, unroll
 
 
+# get_mark_first caches its result in every MARK_CACHE_INTERVAL-th frame it
+# walks through, like Racket's mark stack cache, so that the next lookup
+# from further up stops there. Lookups of the same key from a deep recursion
+# are then amortized O(1).
+MARK_CACHE_INTERVAL = 8
+
 class Link(object):
-    def __init__(self, k, v, next):
+    def __init__(self, k, v, next, cached=False):
         from pycket.values import W_Object
         assert isinstance(k, W_Object)
-        assert isinstance(v, W_Object)
+        # a cached link records that the key has no mark with v = None
+        assert isinstance(v, W_Object) or (cached and v is None)
         assert (next is None) or isinstance(next, Link)
         self.key = k
         self.val = v
         self.next = next
+        # whether this is the value of get_mark_first for the frame instead
+        # of a mark of the frame itself
+        self.cached = cached
 
 class BaseCont(object):
     # Racket also keeps a separate stack for continuation marks
@@ -19,23 +29,29 @@ class BaseCont(object):
     def __init__(self):
         self.marks = None
 
-    def find_cm(self, k):
+    def find_link(self, k):
         from pycket.prims.equal import eqp_logic
         l = self.marks
         while l is not None:
             if eqp_logic(l.key, k):
-                return l.val
+                return l
             l = l.next
         return None
 
+    def find_cm(self, k):
+        l = self.find_link(k)
+        if l is None or l.cached:
+            return None
+        return l.val
+
     def update_cm(self, k, v):
-        from pycket.prims.equal import eqp_logic
-        l = self.marks
-        while l is not None:
-            if eqp_logic(l.key, k):
-                l.val = v
-                return
-            l = l.next
+        # the frames above this one are garbage or belong to captured
+        # continuations, which keep seeing their cached marks
+        l = self.find_link(k)
+        if l is not None:
+            l.val = v
+            l.cached = False
+            return
         self.marks = Link(k, v, self.marks)
 
     def get_marks(self, key):
@@ -45,18 +61,37 @@ class BaseCont(object):
 
     def get_mark_first(self, key):
         p = self
-        while isinstance(p, Cont):
-            v = p.find_cm(key)
-            if v:
-                return v
-            elif p.prev:
-                p = p.prev
-        return p.find_cm(key)
+        depth = 0
+        while True:
+            l = p.find_link(key)
+            if l is not None:
+                v = l.val
+                break
+            if not isinstance(p, Cont) or p.prev is None:
+                v = None
+                break
+            p = p.prev
+            depth += 1
+        if depth >= MARK_CACHE_INTERVAL:
+            self._cache_mark(key, v, depth)
+        return v
+
+    def _cache_mark(self, key, v, depth):
+        p = self
+        for i in range(depth):
+            if i % MARK_CACHE_INTERVAL == 0:
+                p.marks = Link(key, v, p.marks, cached=True)
+            assert isinstance(p, Cont)
+            p = p.prev
 
 
     def plug_reduce(self, _vals, env):
         raise NotImplementedError("abstract method")
 
+    def get_ast(self):
+        # the AST whose evaluation this continuation continues, if any
+        return None
+
     def tostring(self):
         "NOT_RPYTHON"
         if not isinstance(self, NilCont) and self.prev:
@@ -1,11 +1,14 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 #
-from pycket.expand import load_json_ast_rpython, expand_to_ast, PermException
+from pycket.expand import (load_json_ast_rpython, expand_file_cached,
+                           parallel_expansion)
 from pycket.interpreter import interpret_one, ToplevelEnv, interpret_module, GlobalConfig
 from pycket.error import SchemeException
 from pycket.option_helper import parse_args, ensure_json_ast
-from pycket.values import W_String
+from pycket.values import W_String, W_FileOutputPort
+from pycket.profiler import profiler
+from pycket.jit_stats import jit_stats, pycket_jit_hooks
 
 from rpython.rlib import jit
 
@@ -15,6 +18,9 @@ def entry_point(argv):
     try:
         return actual_entry(argv)
     except SchemeException, e:
+        W_FileOutputPort.flush_all()
+        profiler.report()
+        jit_stats.write_report()
         print "ERROR:"
         print e.format_error()
         raise # to see interpreter-level traceback
@@ -28,16 +34,25 @@ def actual_entry(argv):
     args_w = [W_String(arg) for arg in args]
     module_name, json_ast = ensure_json_ast(config, names)
     if json_ast is None:
-        ast = expand_to_ast(module_name) 
+        parallel_expansion.expand_dependencies(module_name)
+        ast = expand_file_cached(module_name)
     else:
         ast = load_json_ast_rpython(json_ast)
     GlobalConfig.load(ast)
     env = ToplevelEnv()
     env.commandline_arguments = args_w
     env.module_env.add_module(module_name, ast)
+    profiler.start()
     val = interpret_module(ast, env)
+    W_FileOutputPort.flush_all()
+    profiler.report()
+    jit_stats.write_report()
     return 0
 
+def jitpolicy(driver):
+    from rpython.jit.codewriter.policy import JitPolicy
+    return JitPolicy(pycket_jit_hooks)
+
 def target(driver, args):
     if "--with-branch" in args:
         import subprocess
@@ -79,6 +79,13 @@ class ModuleEnv(object):
         assert isinstance(module, Module)
         self.modules[name] = module
 
+    def instantiate(self, name, module):
+        # runs the body of module in this namespace, once
+        if name in self.modules:
+            return
+        self.add_module(name, module)
+        module.interpret_mod(self.toplevel_env)
+
     @jit.elidable
     def _find_module(self, name):
         return self.modules.get(name, None)
@@ -99,15 +106,37 @@ class Env(W_Object):
         return self
 
 
-class Version(object):
-    pass
+class ToplevelBinding(object):
+    """ The binding of one top-level variable. A binding keeps its identity
+    for the lifetime of its ToplevelEnv, so the JIT can constant-fold finding
+    it. Its value is quasi-immutable until the variable is assigned a second
+    time, which only invalidates the code that reads this variable. After
+    that, the value is kept in a normal field. """
+    _immutable_fields_ = ["w_value?", "constant?"]
+
+    def __init__(self):
+        self.w_value = None
+        self.constant = True
+        self.w_mutable_value = None
+
+    def get(self):
+        if self.constant:
+            return self.w_value
+        return self.w_mutable_value
+
+    def set(self, w_val):
+        if self.constant:
+            if self.w_value is None:
+                self.w_value = w_val
+                return
+            self.constant = False
+        self.w_mutable_value = w_val
 
 
 class ToplevelEnv(Env):
-    _immutable_fields_ = ["version?", "module_env"]
+    _immutable_fields_ = ["module_env"]
     def __init__(self):
         self.bindings = {}
-        self.version = Version()
         self.module_env = ModuleEnv(self)
         self.commandline_arguments = []
 
@@ -115,27 +144,26 @@ class ToplevelEnv(Env):
         raise SchemeException("variable %s is unbound" % sym.variable_name())
 
     def toplevel_lookup(self, sym):
-        from pycket.values import W_Cell
         jit.promote(self)
-        w_res = self._lookup(sym, jit.promote(self.version))
-        if isinstance(w_res, W_Cell):
-            w_res = w_res.get_val()
+        w_res = self._binding(sym).get()
+        if w_res is None:
+            raise SchemeException("toplevel variable %s not found" % sym.variable_name())
         return w_res
 
     @jit.elidable
-    def _lookup(self, sym, version):
+    def _binding(self, sym):
+        # bindings are created on first use, also by lookups of variables
+        # that are not defined yet, so that the result never changes
         try:
             return self.bindings[sym]
         except KeyError:
-            raise SchemeException("toplevel variable %s not found" % sym.variable_name())
+            binding = ToplevelBinding()
+            self.bindings[sym] = binding
+            return binding
 
     def toplevel_set(self, sym, w_val):
-        from pycket.values import W_Cell
-        if sym in self.bindings:
-            self.bindings[sym].set_val(w_val)
-        else:
-            self.bindings[sym] = W_Cell(w_val)
-            self.version = Version()
+        jit.promote(self)
+        self._binding(sym).set(w_val)
 
 
 @inline_small_list(immutable=True, attrname="vals", factoryname="_make", unbox_num=True)
@@ -3,9 +3,11 @@
 #
 import os
 import sys
+import time
 
-from rpython.rlib import streamio
+from rpython.rlib import streamio, jit
 from rpython.rlib.rbigint import rbigint
+from rpython.rlib.listsort import make_timsort_class
 from rpython.rlib.objectmodel import specialize
 from rpython.rlib.rstring import ParseStringError, ParseStringOverflowError
 from rpython.rlib.rarithmetic import string_to_int
@@ -16,6 +18,8 @@ from pycket import values
 from pycket import vector
 from pycket import values_struct
 from pycket import values_hash
+from pycket import ast_serialize
+from pycket.simplify import simplify, inliner
 
 class ExpandException(SchemeException):
     pass
@@ -45,31 +49,24 @@ fn = "-l pycket/expand --"
 
 
 current_racket_proc = None
+current_racket_client = None
 
 def expand_string(s, reuse=True, srcloc=True):
     "NON_RPYTHON"
-    global current_racket_proc
+    global current_racket_proc, current_racket_client
     from subprocess import Popen, PIPE
 
-    cmd = "racket %s --loop --stdin --stdout %s" % (fn, "" if srcloc else "--omit-srcloc")
-    if current_racket_proc and reuse and current_racket_proc.poll() is None:
-        process = current_racket_proc
-    else:
-        process = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE)
-        if reuse:
-            current_racket_proc = process
     if reuse:
-        process.stdin.write(s)
-        ## I would like to write something so that Racket sees EOF without
-        ## closing the file. But I can't figure out how to do that. It
-        ## must be possible, though, because bash manages it.
-        #process.stdin.write(chr(4))
-        process.stdin.write("\n\0\n")
-        process.stdin.flush()
-        #import pdb; pdb.set_trace()
-        data = process.stdout.readline()
-    else:
-        (data, err) = process.communicate(s)
+        if current_racket_proc is None or current_racket_proc.poll() is not None:
+            cmd = "exec racket %s --loop" % fn
+            current_racket_proc = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE)
+            current_racket_client = ExpanderClient(
+                current_racket_proc.stdout.fileno(),
+                current_racket_proc.stdin.fileno())
+        return current_racket_client.expand_code(s, srcloc)
+    cmd = "racket %s --stdin --stdout %s" % (fn, "" if srcloc else "--omit-srcloc")
+    process = Popen(cmd, shell=True, stdin=PIPE, stdout=PIPE)
+    (data, err) = process.communicate(s)
     if len(data) == 0:
         raise ExpandException("Racket did not produce output. Probably racket is not installed, or it could not parse the input.")
     # if err:
@@ -89,6 +86,137 @@ def expand_file(fname):
         raise ExpandException("Racket produced an error")
     return data
 
+#### ========================== Persistent expander
+
+# Client side of the framed protocol of `expand.rkt --loop` and
+# `expand.rkt --socket <path>`, see there.
+class ExpanderClient(object):
+    def __init__(self, read_fd, write_fd, pid=-1, sock=None):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.pid = pid
+        self.sock = sock # keeps the socket (and thus the fds) alive
+
+    def _write_all(self, data):
+        while data:
+            n = os.write(self.write_fd, data)
+            assert n >= 0
+            data = data[n:]
+
+    def _read_exactly(self, n):
+        parts = []
+        while n > 0:
+            chunk = os.read(self.read_fd, n)
+            if not chunk:
+                raise ExpandException("The Racket expander went away")
+            parts.append(chunk)
+            n -= len(chunk)
+        return "".join(parts)
+
+    def _read_line(self):
+        chars = []
+        while True:
+            c = self._read_exactly(1)
+            if c == "\n":
+                return "".join(chars)
+            chars.append(c)
+
+    def request(self, command, payload, srcloc=True):
+        self._write_all("%s %s %s\n" % (command, "1" if srcloc else "0",
+                                         len(payload)))
+        self._write_all(payload)
+        header = self._read_line().split(" ")
+        if len(header) != 2 or not header[1].isdigit():
+            raise ExpandException("Malformed response from the Racket expander")
+        data = self._read_exactly(int(header[1]))
+        if header[0] != "ok":
+            raise ExpandException("Racket produced an error and said '%s'" % data)
+        return data
+
+    def expand_file(self, fname, srcloc=True):
+        return self.request("file", os.path.abspath(fname), srcloc)
+
+    def expand_code(self, code, srcloc=True):
+        return self.request("code", code, srcloc)
+
+def spawn_expander():
+    request_read, request_write = os.pipe()
+    response_read, response_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.dup2(request_read, 0)
+        os.dup2(response_write, 1)
+        for fd in [request_read, request_write, response_read, response_write]:
+            os.close(fd)
+        cmd = "exec racket %s --loop" % fn
+        try:
+            os.execv("/bin/sh", ["/bin/sh", "-c", cmd])
+        finally:
+            os._exit(127)
+    os.close(request_read)
+    os.close(response_write)
+    return ExpanderClient(response_read, request_write, pid=pid)
+
+def connect_expander(path):
+    from rpython.rlib import rsocket
+    sock = rsocket.RSocket(rsocket.AF_UNIX, rsocket.SOCK_STREAM)
+    sock.connect(rsocket.UNIXAddress(path))
+    return ExpanderClient(sock.fd, sock.fd, sock=sock)
+
+# With --expander-server, one `expand.rkt --loop` process is started on first
+# use and does all expansions of this process. With --expander-socket <path>
+# (or $PYCKET_EXPANDER_SOCKET), an expander already serving on that socket is
+# used instead.
+class ExpanderState(object):
+    socket_env_var = "PYCKET_EXPANDER_SOCKET"
+
+    def __init__(self):
+        self.spawn = False
+        self.socket_path = None
+        self.client = None
+        self.version = None
+
+    def get_socket_path(self):
+        if self.socket_path is None:
+            path = os.environ.get(ExpanderState.socket_env_var, None)
+            if not path:
+                return None
+            return path
+        return self.socket_path
+
+    def get_client(self):
+        """ The persistent expander, or None if every expansion should start
+        its own Racket process. """
+        from rpython.rlib import rsocket
+        if self.client is not None:
+            return self.client
+        path = self.get_socket_path()
+        if path is not None:
+            try:
+                self.client = connect_expander(path)
+                return self.client
+            except rsocket.SocketError:
+                pass
+        if self.spawn:
+            self.client = spawn_expander()
+        return self.client
+
+    def racket_version(self):
+        """ The version banner of the racket the expansions are done by. """
+        from rpython.rlib.rfile import create_popen_file
+        if self.version is None:
+            pipe = create_popen_file("racket --version </dev/null 2>&1", "r")
+            self.version = pipe.read()
+            pipe.close()
+        return self.version
+
+expander = ExpanderState()
+
+def _write_file(fname, data):
+    f = streamio.open_file_as_stream(fname, "w")
+    f.write(data)
+    f.close()
+
 # Call the Racket expander and read its output from STDOUT rather than producing an
 # intermediate (possibly cached) file.
 def expand_file_rpython(rkt_file):
@@ -96,6 +224,9 @@ def expand_file_rpython(rkt_file):
     cmd = "racket %s --stdout \"%s\" 2>&1" % (fn, rkt_file)
     if not os.access(rkt_file, os.R_OK):
         raise ValueError("Cannot access file %s" % rkt_file)
+    client = expander.get_client()
+    if client is not None:
+        return client.expand_file(rkt_file)
     pipe = create_popen_file(cmd, "r")
     out = pipe.read()
     err = os.WEXITSTATUS(pipe.close())
@@ -103,17 +234,345 @@ def expand_file_rpython(rkt_file):
         raise ExpandException("Racket produced an error and said '%s'" % out)
     return out
 
+def _ast_cache_name(file_name):
+    return file_name + '.ast'
+
+# A central directory for the AST caches, for sources that live in read-only
+# places. Entries are named by a hash of the source's path and contents, the
+# Racket version and the Pycket version, so they can be shared by several
+# processes. Changes to required modules are caught by the keys stored in the
+# entries. When the directory grows beyond max_size, the least recently used
+# entries are removed.
+class CacheEntry(object):
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+
+class CacheEntrySort(make_timsort_class()):
+    def lt(self, a, b):
+        # least recently used first
+        return a.mtime < b.mtime
+
+class CacheDirectory(object):
+    env_var = "PYCKET_CACHE_DIR"
+    default_max_size = 512 * 1024 * 1024
+
+    def __init__(self):
+        self.directory = None
+        self.max_size = CacheDirectory.default_max_size
+        # the size of all entries as of the last evict plus what was written
+        # since, -1 until the directory was listed
+        self.total_size = -1
+
+    def get_directory(self):
+        if self.directory is None:
+            directory = os.environ.get(CacheDirectory.env_var, None)
+            if not directory:
+                return None
+            return directory
+        return self.directory
+
+    def cache_name(self, file_name, source_hash):
+        directory = self.get_directory()
+        if directory is None:
+            return _ast_cache_name(file_name)
+        key = ast_serialize.source_hash("%s\0%s\0%s" % (
+            os.path.abspath(file_name), source_hash,
+            ast_serialize.PYCKET_VERSION))
+        return "%s/%s.ast" % (directory, key)
+
+    def used(self, cache_file):
+        # the mtime of an entry is its last use
+        if self.get_directory() is None:
+            return
+        try:
+            os.utime(cache_file, None)
+        except OSError:
+            pass
+
+    def ensure_directory(self):
+        directory = self.get_directory()
+        if directory is not None and not os.path.isdir(directory):
+            try:
+                os.mkdir(directory)
+            except OSError:
+                pass
+
+    def written(self, cache_file):
+        """ evicts entries if writing cache_file took the directory over
+        max_size. Entries written by other processes are only noticed by the
+        next evict. """
+        if self.get_directory() is None:
+            return
+        if self.total_size < 0:
+            self.evict()
+            return
+        try:
+            self.total_size += os.stat(cache_file).st_size
+        except OSError:
+            return
+        if self.total_size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        directory = self.get_directory()
+        if directory is None:
+            return
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return
+        entries = []
+        total = 0
+        for name in names:
+            if not name.endswith(".ast"):
+                continue
+            path = "%s/%s" % (directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append(CacheEntry(path, st.st_size, st.st_mtime))
+            total += st.st_size
+        if total > self.max_size:
+            CacheEntrySort(entries).sort()
+            for entry in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    # probably removed by another process already
+                    pass
+                total -= entry.size
+        self.total_size = total
+
+cache_directory = CacheDirectory()
+
+# The hash of the source that the cache of a module is keyed by. Expansions
+# by a different Racket and modules converted without inlining are cached
+# separately.
+def _cache_hash(fname):
+    data = readfile_rpython(fname) + "\0" + expander.racket_version()
+    if not inliner.enabled:
+        data += "\0no-inline"
+    return ast_serialize.source_hash(data)
+
+StringSort = make_timsort_class()
+
+# The key of a loaded module is the hash of its source together with the keys
+# of the modules it requires. The cache of a module records the keys of its
+# requires, since it holds code expanded against (and inlined from) them.
+class DependencyKeys(object):
+    def __init__(self):
+        self.keys = {}
+        self.loading = []
+
+    def start(self):
+        self.loading.append({})
+
+    def add(self, fname):
+        if self.loading and not fname.startswith("#%"):
+            self.loading[-1][fname] = None
+
+    def finish(self, fname, source_hash):
+        requires = self.loading.pop().keys()
+        # the requires are found in a different order when the module is
+        # loaded from its cache
+        StringSort(requires).sort()
+        parts = [source_hash]
+        for modname in requires:
+            parts.append("%s=%s" % (modname, self.keys.get(modname, "")))
+        self.keys[fname] = ast_serialize.source_hash("\0".join(parts))
+
+dependency_keys = DependencyKeys()
+
+# Load the module from its binary AST cache, if that is up to date, otherwise
+# expand it and (try to) write the cache for the next run.
 def expand_file_cached(rkt_file):
+    if not os.access(rkt_file, os.R_OK):
+        raise ValueError("Cannot access file %s" % rkt_file)
+    source_hash = _cache_hash(rkt_file)
+    dependency_keys.start()
     try:
-        json_file = ensure_json_ast_run(rkt_file)
-    except PermException:
-        return expand_to_ast(rkt_file)
-    return load_json_ast_rpython(json_file)
+        module = _load_or_expand(rkt_file, source_hash)
+    finally:
+        dependency_keys.finish(rkt_file, source_hash)
+    return module
+
+def _load_or_expand(rkt_file, source_hash):
+    cache_file = cache_directory.cache_name(rkt_file, source_hash)
+    module = ast_serialize.read_cache(cache_file, source_hash, _require_module,
+                                      dependency_keys.keys)
+    if module is not None:
+        cache_directory.used(cache_file)
+        return module
+    module = expand_to_ast(rkt_file)
+    if conversion_config.lazy_lambdas:
+        # serializing the module would convert all lambda bodies right away
+        return module
+    cache_directory.ensure_directory()
+    if ast_serialize.write_cache(cache_file, source_hash, module,
+                                 dependency_keys.keys):
+        cache_directory.written(cache_file)
+    return module
 
 # Expand and load the module without generating intermediate JSON files.
 def expand_to_ast(fname):
-    data = expand_file_rpython(fname)
-    return _to_module(pycket_json.loads(data)).assign_convert_module()
+    json_file = parallel_expansion.take(fname)
+    if json_file is not None:
+        try:
+            return load_json_ast_rpython(json_file)
+        finally:
+            _remove_file(json_file)
+    reader = pycket_json.ChunkedJsonReader(data=expand_file_rpython(fname))
+    return _to_module_streaming(reader).assign_convert_module()
+
+#### ========================== Parallel expansion of dependencies
+
+# Loading a module expands its requires one at a time, as they are found
+# while converting its JSON. With --expand-jobs <n>, a pre-pass walks the
+# require graph first: modules whose AST cache is up to date contribute the
+# requires recorded in the cache, all others are expanded by up to n Racket
+# processes at a time and contribute the requires found in their JSON. The
+# normal, serial load then picks up the expansions in dependency order.
+POLL_INTERVAL = 0.005
+
+class ParallelExpansion(object):
+    def __init__(self):
+        self.jobs = 1
+        self.expanded = {}
+        self.counter = 0
+
+    def take(self, fname):
+        """ returns the name of the JSON file fname was expanded to, which
+        the caller has to remove, or None """
+        json_file = self.expanded.get(fname, None)
+        if json_file is not None:
+            del self.expanded[fname]
+        return json_file
+
+    def _temp_json_name(self):
+        tmpdir = os.environ.get("TMPDIR", None)
+        if not tmpdir:
+            tmpdir = "/tmp"
+        self.counter += 1
+        return "%s/pycket-%s-%s.json" % (tmpdir, os.getpid(), self.counter)
+
+    def _start(self, rkt_file, json_file):
+        pid = os.fork()
+        if pid == 0:
+            cmd = "exec racket %s --output \"%s\" \"%s\" >/dev/null 2>&1" % (
+                fn, json_file, rkt_file)
+            try:
+                os.execv("/bin/sh", ["/bin/sh", "-c", cmd])
+            finally:
+                os._exit(127)
+        return pid
+
+    def _wait_any(self, running):
+        # only the expansions are waited for, the persistent expander is a
+        # child of this process, too
+        while True:
+            for pid in running:
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done == pid:
+                    return pid, status
+            time.sleep(POLL_INTERVAL)
+
+    def expand_dependencies(self, rkt_file):
+        if self.jobs <= 1:
+            return
+        pending = [rkt_file]
+        seen = {rkt_file: None}
+        running = {}
+        while pending or running:
+            while pending and len(running) < self.jobs:
+                fname = pending.pop()
+                requires = _cached_requires(fname)
+                if requires is None:
+                    json_file = self._temp_json_name()
+                    running[self._start(fname, json_file)] = (fname, json_file)
+                    continue
+                _add_requires(requires, pending, seen)
+            if not running:
+                continue
+            pid, status = self._wait_any(running)
+            fname, json_file = running[pid]
+            del running[pid]
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                # only the file name is kept, the module is read from it
+                # when the serial load gets to it
+                self.expanded[fname] = json_file
+                _add_requires(_json_file_requires(json_file), pending, seen)
+                continue
+            # on errors, the serial load expands the module again and reports
+            # what went wrong
+            _remove_file(json_file)
+
+parallel_expansion = ParallelExpansion()
+
+def _remove_file(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+def _cached_requires(fname):
+    if not os.access(fname, os.R_OK):
+        return []
+    source_hash = _cache_hash(fname)
+    cache_file = cache_directory.cache_name(fname, source_hash)
+    return ast_serialize.read_cache_requires(cache_file, source_hash)
+
+def _add_requires(requires, pending, seen):
+    for fname in requires:
+        if fname.startswith("#%") or fname in seen:
+            continue
+        seen[fname] = None
+        pending.append(fname)
+
+def _json_file_requires(json_file):
+    # decodes one body form at a time, like _to_module_streaming
+    result = []
+    reader = pycket_json.ChunkedJsonReader(
+        streamio.open_file_as_stream(json_file))
+    try:
+        reader.expect("{")
+        while not reader.skip("}"):
+            key = reader.read_value().value_string()
+            reader.expect(":")
+            if key == "body-forms":
+                reader.expect("[")
+                while not reader.skip("]"):
+                    _find_requires(reader.read_value(), result)
+                    reader.skip(",")
+            elif key == "language":
+                l = reader.read_value().value_string()
+                if l != "":
+                    result.append(l)
+            else:
+                _find_requires(reader.read_value(), result)
+            reader.skip(",")
+    finally:
+        reader.close()
+    return result
+
+def _find_requires(json, result):
+    if json.is_object:
+        for key, value in json.value_object().iteritems():
+            if key == "require" and value.is_array:
+                for path in value.value_array():
+                    result.append(path.value_string())
+            elif key == "language" and value.is_string:
+                if value.value_string() != "":
+                    result.append(value.value_string())
+            else:
+                _find_requires(value, result)
+    elif json.is_array:
+        for value in json.value_array():
+            _find_requires(value, result)
 
 def expand(s, wrap=False, stdlib=False):
     data = expand_string(s)
@@ -133,6 +592,10 @@ def expand_file_to_json(rkt_file, json_file):
     except OSError:
         pass
     print "Expanding %s to %s" % (rkt_file, json_file)
+    client = expander.get_client()
+    if client is not None:
+        _write_file(json_file, client.expand_file(rkt_file))
+        return json_file
     cmd = "racket %s --output \"%s\" \"%s\" 2>&1" % (
         fn,
         json_file, rkt_file)
@@ -153,6 +616,11 @@ def expand_code_to_json(code, json_file, stdlib=True, mcons=False, wrap=True):
         pass
     except OSError:
         pass
+    client = expander.get_client()
+    if client is not None:
+        source = "#lang s-exp pycket%s%s" % (" #:stdlib" if stdlib else "", code)
+        _write_file(json_file, client.expand_code(source))
+        return json_file
     cmd = "racket %s --output \"%s\" --stdin" % (
         fn,
         json_file)
@@ -205,8 +673,9 @@ def load_json_ast(fname):
     return _to_module(pycket_json.loads(data)).assign_convert_module()
 
 def load_json_ast_rpython(fname):
-    data = readfile_rpython(fname)
-    return _to_module(pycket_json.loads(data)).assign_convert_module()
+    stream = streamio.open_file_as_stream(fname)
+    reader = pycket_json.ChunkedJsonReader(stream)
+    return _to_module_streaming(reader).assign_convert_module()
 
 def parse_ast(json_string):
     json = pycket_json.loads(json_string)
@@ -292,10 +761,51 @@ def _to_module(json):
     else:
         assert 0
 
-# A global table listing all the module files that have been loaded.
-# A module need only be loaded once.
-# Modules (aside from builtins like #%kernel) are listed in the table
-# as paths to their implementing files which are assumed to be normalized.
+# Like _to_module, but decodes the module from reader one body form at a time
+# and converts each form as soon as it is decoded, so that the JSON of the
+# whole module never exists at once. expand.rkt writes the body forms last;
+# forms that arrive before the language are kept as JSON until it is known,
+# since the language has to be required first.
+def _to_module_streaming(reader):
+    name = None
+    lang = None
+    config = {}
+    body = []
+    early_forms = []
+    reader.expect("{")
+    while not reader.skip("}"):
+        key = reader.read_value().value_string()
+        reader.expect(":")
+        if key == "body-forms":
+            reader.expect("[")
+            while not reader.skip("]"):
+                form = reader.read_value()
+                if lang is None:
+                    early_forms.append(form)
+                else:
+                    body.append(_to_ast(form))
+                reader.skip(",")
+        elif key == "language":
+            l = reader.read_value().value_string()
+            lang = [_to_require(l)] if l != "" else []
+            body = lang + [_to_ast(x) for x in early_forms] + body
+            early_forms = []
+        elif key == "module-name":
+            name = reader.read_value().value_string()
+        elif key == "config":
+            for (k, _v) in reader.read_value().value_object().iteritems():
+                config[k] = _v.value_string()
+        else:
+            reader.read_value()
+        reader.skip(",")
+    if name is None or lang is None:
+        assert 0
+    return Module(name, body, config)
+
+# A global table of all the module files that have been loaded, keyed by the
+# paths to their implementing files, which are assumed to be normalized.
+# A module need only be loaded once; it is instantiated once per namespace
+# (see ModuleEnv.instantiate). Builtins like #%kernel are not in the table.
 class ModTable(object):
 
     class TableState(object):
@@ -305,9 +815,13 @@ class ModTable(object):
     _state = TableState()
 
     @staticmethod
-    def add_module(fname):
-        #print "Adding module '%s'\n\t\tbecause of '%s'" % (fname, ModTable.current_module or "")
-        ModTable._state.table[fname] = None
+    def add_module(fname, module=None):
+        # module is None while it is being loaded
+        ModTable._state.table[fname] = module
+
+    @staticmethod
+    def get_module(fname):
+        return ModTable._state.table.get(fname, None)
 
     @staticmethod
     def reset():
@@ -333,14 +847,22 @@ class ModTable(object):
     def has_module(fname):
         return fname.startswith("#%") or fname in ModTable._state.table
 
-def _to_require(fname):
+# Returns the module to instantiate for a require of fname, loading it the
+# first time, or None for builtin modules and modules that are still being
+# loaded.
+def _require_module(fname):
+    dependency_keys.add(fname)
     if ModTable.has_module(fname):
-        return Quote(values.w_void)
+        return ModTable.get_module(fname)
     ModTable.add_module(fname)
     ModTable.push(fname)
     module = expand_file_cached(fname)
     ModTable.pop()
-    return Require(fname, module)
+    ModTable.add_module(fname, module)
+    return module
+
+def _to_require(fname):
+    return Require(fname, _require_module(fname))
 
 def get_srcloc(o):
     pos = o["position"].value_int() if "position" in o else -1
@@ -360,8 +882,202 @@ def get_srcloc(o):
 def to_lambda(o):
     fmls, rest = to_formals(o["lambda"])
     pos, sourcefile = get_srcloc(o)
-    return make_lambda(fmls, rest, [_to_ast(x) for x in o["body"].value_array()],
-                       pos, sourcefile)
+    body_json = o["body"].value_array()
+    if conversion_config.lazy_lambdas:
+        body = [LazyLambdaBody.make(body_json, ModTable.current_mod())]
+    else:
+        body = [_to_ast(x) for x in body_json]
+    return make_lambda(fmls, rest, body, pos, sourcefile)
+
+def to_set_target(json):
+    target = json.value_object()
+    var = None
+    if "source-name" in target:
+        srcname = values.W_Symbol.make(target["source-name"].value_string())
+        if "source-module" in target:
+            srcmod = target["source-module"].value_string() if target["source-module"].is_string else None
+        else:
+            srcmod = "#%kernel"
+        modname = values.W_Symbol.make(target["module"].value_string()) if "module" in target else srcname
+        var = ModuleVar(modname, srcmod, srcname)
+    elif "lexical" in target:
+        var = CellRef(values.W_Symbol.make(target["lexical"].value_string()))
+    elif "toplevel" in target:
+        var = ToplevelVar(values.W_Symbol.make(target["toplevel"].value_string()))
+    return var
+
+#### ========================== Lazy conversion of lambda bodies
+
+class ConversionConfig(object):
+    def __init__(self):
+        # keep lambda bodies as JSON until the closure is first called
+        self.lazy_lambdas = False
+
+conversion_config = ConversionConfig()
+
+# Forms that _to_ast turns into (void) without looking at their subforms.
+IGNORED_FORMS = ["begin-for-syntax", "define-syntaxes", "#%require", "#%provide"]
+
+def _analyze_formals(formals, bound):
+    fmls, rest = to_formals(formals)
+    for sym in fmls:
+        bound[sym] = None
+    if rest is not None:
+        bound[rest] = None
+
+def _analyze_json(json, bound, frees, mvars):
+    """ Computes, without converting json, what the analysis of the AST that
+    _to_ast would produce needs: the lexical variables that json refers to and
+    that are not in bound are added to frees, the variables that json assigns
+    to are added to mvars. The set of mutated variables may be larger than
+    the one of the converted AST, which is safe: such variables only end up
+    in cells. """
+    if json.is_array:
+        arr = json.value_array()
+        form = arr[0].value_object()["source-name"].value_string()
+        if form in IGNORED_FORMS:
+            return
+        if form == "set!":
+            var = to_set_target(arr[1])
+            if isinstance(var, CellRef):
+                mvars[LexicalVar(var.sym)] = None
+                if var.sym not in bound:
+                    frees[var.sym] = None
+            elif isinstance(var, ModuleVar):
+                mvars[to_modvar(var)] = None
+            _analyze_json(arr[2], bound, frees, mvars)
+            return
+        for i in range(1, len(arr)):
+            _analyze_json(arr[i], bound, frees, mvars)
+        return
+    if not json.is_object:
+        return
+    obj = json.value_object()
+    if "lexical" in obj:
+        sym = values.W_Symbol.make(obj["lexical"].value_string())
+        if sym not in bound:
+            frees[sym] = None
+    elif "begin0" in obj:
+        _analyze_json(obj["begin0"], bound, frees, mvars)
+        _analyze_jsons(obj["begin0-rest"].value_array(), bound, frees, mvars)
+    elif "wcm-key" in obj:
+        _analyze_json(obj["wcm-key"], bound, frees, mvars)
+        _analyze_json(obj["wcm-val"], bound, frees, mvars)
+        _analyze_json(obj["wcm-body"], bound, frees, mvars)
+    elif "define-values" in obj:
+        _analyze_json(obj["define-values-body"], bound, frees, mvars)
+    elif "letrec-bindings" in obj or "let-bindings" in obj:
+        is_letrec = "letrec-bindings" in obj
+        prefix = "letrec" if is_letrec else "let"
+        bindings = obj[prefix + "-bindings"].value_array()
+        inner = bound.copy()
+        for b in bindings:
+            for x in b.value_array()[0].value_array():
+                sym = values.W_Symbol.make(x.value_string())
+                inner[sym] = None
+                if is_letrec:
+                    # Letrec always keeps its variables in cells
+                    mvars[LexicalVar(sym)] = None
+        for b in bindings:
+            rhs = b.value_array()[1]
+            _analyze_json(rhs, inner if is_letrec else bound, frees, mvars)
+        _analyze_jsons(obj[prefix + "-body"].value_array(), inner, frees, mvars)
+    elif "lambda" in obj:
+        _analyze_lambda(obj, bound, frees, mvars)
+    elif "case-lambda" in obj:
+        for lam in obj["case-lambda"].value_array():
+            _analyze_lambda(lam.value_object(), bound, frees, mvars)
+    elif "operator" in obj:
+        _analyze_json(obj["operator"], bound, frees, mvars)
+        _analyze_jsons(obj["operands"].value_array(), bound, frees, mvars)
+    elif "test" in obj:
+        _analyze_json(obj["test"], bound, frees, mvars)
+        _analyze_json(obj["then"], bound, frees, mvars)
+        _analyze_json(obj["else"], bound, frees, mvars)
+    # quote, quote-syntax, variable-reference (which has no free variables,
+    # see VariableReference.direct_children), module and top-level variables
+    # do not contribute
+
+def _analyze_jsons(jsons, bound, frees, mvars):
+    for json in jsons:
+        _analyze_json(json, bound, frees, mvars)
+
+def _analyze_lambda(obj, bound, frees, mvars):
+    inner = bound.copy()
+    _analyze_formals(obj["lambda"], inner)
+    _analyze_jsons(obj["body"].value_array(), inner, frees, mvars)
+
+class LazyLambdaBody(AST):
+    """ The body of a lambda that is converted from JSON (and assignment
+    converted) only when the closure is called for the first time. The
+    results of the free and mutated variable analysis, which the enclosing
+    forms need right away, are computed directly from the JSON. """
+    _immutable_fields_ = ["frees", "lazy_mvars", "current_mod", "forced?"]
+
+    def __init__(self, json_body, current_mod, frees, lazy_mvars,
+                 vars=None, env_structure=None):
+        self.json_body = json_body
+        self.current_mod = current_mod
+        self.frees = frees
+        self.lazy_mvars = lazy_mvars
+        self.vars = vars
+        self.env_structure = env_structure
+        self.forced = None
+
+    @staticmethod
+    def make(json_body, current_mod):
+        frees = {}
+        mvars = variable_set()
+        _analyze_jsons(json_body, {}, frees, mvars)
+        return LazyLambdaBody(json_body, current_mod, frees, mvars)
+
+    def assign_convert(self, vars, env_structure):
+        return LazyLambdaBody(self.json_body, self.current_mod, self.frees,
+                              self.lazy_mvars, vars.copy(), env_structure)
+
+    def force(self):
+        forced = self.forced
+        if forced is None:
+            forced = self._force()
+        return forced
+
+    @jit.dont_look_inside
+    def _force(self):
+        # variable-reference forms record the module they appear in
+        ModTable.push(self.current_mod)
+        try:
+            asts = [simplify(_to_ast(x)) for x in self.json_body]
+        finally:
+            ModTable.pop()
+        if self.vars is None:
+            forced = Begin.make(asts)
+        else:
+            forced = Begin.make([a.assign_convert(self.vars, self.env_structure)
+                                 for a in asts])
+        if self.surrounding_lambda is not None:
+            forced.set_surrounding_lambda(self.surrounding_lambda)
+        self.forced = forced
+        self.json_body = None
+        self.vars = None
+        return forced
+
+    def interpret(self, env, cont):
+        return self.force(), env, cont
+
+    def set_surrounding_lambda(self, lam):
+        self.surrounding_lambda = lam
+        # the body is converted later
+
+    def free_vars(self):
+        return self.frees.copy()
+
+    def _mutated_vars(self):
+        return self.lazy_mvars.copy()
+
+    def tostring(self):
+        if self.forced is not None:
+            return self.forced.tostring()
+        return "#<lazy-body>"
 
 
 def _to_ast(json):
@@ -376,21 +1092,7 @@ def _to_ast(json):
             if ast_elem == "#%expression":
                 return _to_ast(arr[1])
             if ast_elem == "set!":
-                target = arr[1].value_object()
-                var = None
-                if "source-name" in target:
-                    srcname = values.W_Symbol.make(target["source-name"].value_string())
-                    if "source-module" in target:
-                        srcmod = target["source-module"].value_string() if target["source-module"].is_string else None
-                    else:
-                        srcmod = "#%kernel"
-                    modname = values.W_Symbol.make(target["module"].value_string()) if "module" in target else srcname
-                    var = ModuleVar(modname, srcmod, srcname)
-                elif "lexical" in target:
-                    var = CellRef(values.W_Symbol.make(target["lexical"].value_string()))
-                elif "toplevel" in target:
-                    var = ToplevelVar(values.W_Symbol.make(target["toplevel"].value_string()))
-                return SetBang(var, _to_ast(arr[2]))
+                return SetBang(to_set_target(arr[1]), _to_ast(arr[2]))
             if ast_elem == "#%top":
                 assert 0
                 return CellRef(values.W_Symbol.make(arr[1].value_object()["symbol"].value_string()))
@@ -552,7 +1254,7 @@ def to_value(json):
         if "char" in obj:
             return values.W_Character.make(unichr(int(obj["char"].value_string())))
         if "hash-keys" in obj and "hash-vals" in obj:
-            return values_hash.W_EqualHashTable(
+            return values_hash.empty_immutable_equal_hash.from_lists(
                     [to_value(i) for i in obj["hash-keys"].value_array()],
                     [to_value(i) for i in obj["hash-vals"].value_array()])
         if "regexp" in obj:
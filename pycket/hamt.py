@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# A persistent hash array mapped trie, used for immutable hash tables and
+# parameterizations. Every inner node consumes HAMT_BITS bits of the hash
+# code of a key. Keys with the same full hash code end up in the same
+# bucket, which is the only place where keys are compared. Updates copy the
+# path from the root to the changed bucket and share everything else. Nodes
+# know how many entries they hold, which makes it cheap to find the entry at
+# a position of the iteration order.
+
+HAMT_BITS = 5
+HAMT_MASK = (1 << HAMT_BITS) - 1
+
+def _popcount(x):
+    count = 0
+    while x:
+        x &= x - 1
+        count += 1
+    return count
+
+class HAMTEntry(object):
+    _attrs_ = []
+    _settled_ = True
+
+class HAMTBucket(HAMTEntry):
+    _immutable_fields_ = ["hash", "keys[*]", "vals[*]"]
+    def __init__(self, hash, keys, vals):
+        self.hash = hash
+        self.keys = keys
+        self.vals = vals
+
+class HAMTNode(HAMTEntry):
+    _immutable_fields_ = ["bitmap", "children[*]", "count"]
+    def __init__(self, bitmap, children, count):
+        self.bitmap = bitmap
+        self.children = children
+        self.count = count
+
+    def index(self, bit):
+        return _popcount(self.bitmap & (bit - 1))
+
+empty_hamt_node = HAMTNode(0, [], 0)
+
+def _entry_count(entry):
+    if entry is None:
+        return 0
+    if isinstance(entry, HAMTBucket):
+        return len(entry.keys)
+    assert isinstance(entry, HAMTNode)
+    return entry.count
+
+def hamt_find(node, h):
+    shift = 0
+    while True:
+        bit = 1 << ((h >> shift) & HAMT_MASK)
+        if not node.bitmap & bit:
+            return None
+        child = node.children[node.index(bit)]
+        if isinstance(child, HAMTBucket):
+            if child.hash == h:
+                return child
+            return None
+        assert isinstance(child, HAMTNode)
+        node = child
+        shift += HAMT_BITS
+
+def _hamt_merge(b1, b2, shift):
+    # two buckets with different hashes that share a slot at `shift`
+    bit1 = 1 << ((b1.hash >> shift) & HAMT_MASK)
+    bit2 = 1 << ((b2.hash >> shift) & HAMT_MASK)
+    count = len(b1.keys) + len(b2.keys)
+    if bit1 == bit2:
+        return HAMTNode(bit1, [_hamt_merge(b1, b2, shift + HAMT_BITS)], count)
+    if bit1 < bit2:
+        return HAMTNode(bit1 | bit2, [b1, b2], count)
+    return HAMTNode(bit1 | bit2, [b2, b1], count)
+
+def hamt_replace(node, h, bucket, shift=0):
+    """ return a copy of node where the bucket for hash h is replaced by
+    bucket, or removed if bucket is None """
+    bit = 1 << ((h >> shift) & HAMT_MASK)
+    index = node.index(bit)
+    children = node.children
+    if not node.bitmap & bit:
+        if bucket is None:
+            return node
+        new_children = children[:index] + [bucket] + children[index:]
+        return HAMTNode(node.bitmap | bit, new_children,
+                        node.count + len(bucket.keys))
+    child = children[index]
+    if isinstance(child, HAMTNode):
+        new_child = hamt_replace(child, h, bucket, shift + HAMT_BITS)
+        if not new_child.bitmap:
+            new_child = None
+    else:
+        assert isinstance(child, HAMTBucket)
+        if child.hash == h:
+            new_child = bucket
+        elif bucket is None:
+            return node
+        else:
+            new_child = _hamt_merge(child, bucket, shift + HAMT_BITS)
+    count = node.count - _entry_count(child) + _entry_count(new_child)
+    if new_child is None:
+        new_children = children[:index] + children[index + 1:]
+        return HAMTNode(node.bitmap & ~bit, new_children, count)
+    new_children = children[:]
+    new_children[index] = new_child
+    return HAMTNode(node.bitmap, new_children, count)
+
+def hamt_nth(node, i):
+    """ the bucket holding the entry at position i of the iteration order,
+    and the index of the entry in it. i has to be smaller than node.count """
+    while True:
+        j = 0
+        while True:
+            child = node.children[j]
+            n = _entry_count(child)
+            if i < n:
+                break
+            i -= n
+            j += 1
+        if isinstance(child, HAMTBucket):
+            return child, i
+        assert isinstance(child, HAMTNode)
+        node = child
+
+def hamt_items(node, result):
+    for child in node.children:
+        if isinstance(child, HAMTBucket):
+            for i, k in enumerate(child.keys):
+                result.append((k, child.vals[i]))
+        else:
+            assert isinstance(child, HAMTNode)
+            hamt_items(child, result)
+    return result
+
+def hamt_buckets(node, result):
+    for child in node.children:
+        if isinstance(child, HAMTBucket):
+            result.append(child)
+        else:
+            assert isinstance(child, HAMTNode)
+            hamt_buckets(child, result)
+    return result
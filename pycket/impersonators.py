@@ -497,9 +497,34 @@ class W_InterposeHashTable(values_hash.W_HashTable):
     def post_set_cont(self, key, val, env, cont):
         raise NotImplementedError("abstract method")
 
+    def post_key_cont(self, key, env, cont):
+        raise NotImplementedError("abstract method")
+
     def hash_keys(self):
         return get_base_object(self.inner).hash_keys()
 
+    def get_item(self, i):
+        # the keys and values have to go through key_proc and ref_proc,
+        # see hash_iterate_key and hash_iterate_pair
+        raise SchemeException("%s: cannot access the entries of an "
+                              "impersonated hash directly" % self.errorname)
+
+    def hash_iterate_next(self, pos):
+        return get_base_object(self.inner).hash_iterate_next(pos)
+
+    @label
+    def hash_iterate_key(self, pos, env, cont):
+        after = imp_hash_table_iterate_key_cont(self, env, cont)
+        return self.inner.hash_iterate_key(pos, env, after)
+
+    @label
+    def hash_iterate_pair(self, pos, env, cont):
+        after = imp_hash_table_iterate_ref_cont(self, env, cont)
+        return self.hash_iterate_key(pos, env, after)
+
+    def length(self):
+        return get_base_object(self.inner).length()
+
     @label
     def hash_set(self, key, val, env, cont):
         raise NotImplementedError("abstract method")
@@ -509,6 +534,27 @@ class W_InterposeHashTable(values_hash.W_HashTable):
         after = self.post_ref_cont(key, env, cont)
         return self.ref_proc.call([self.inner, key], env, after)
 
+@continuation
+def imp_hash_table_iterate_key_cont(ht, env, cont, _vals):
+    from pycket.interpreter import check_one_val
+    key = check_one_val(_vals)
+    after = ht.post_key_cont(key, env, cont)
+    return ht.key_proc.call([ht.inner, key], env, after)
+
+@continuation
+def imp_hash_table_iterate_ref_cont(ht, env, cont, _vals):
+    from pycket.interpreter import check_one_val
+    key = check_one_val(_vals)
+    return ht.hash_ref(key, env, imp_hash_table_iterate_pair_cont(key, env, cont))
+
+@continuation
+def imp_hash_table_iterate_pair_cont(key, env, cont, _vals):
+    from pycket.interpreter import check_one_val, return_multi_vals
+    val = check_one_val(_vals)
+    if val is None:
+        raise SchemeException("hash-iterate: no value found for key %s" % key.tostring())
+    return return_multi_vals(values.Values.make([key, val]), env, cont)
+
 @continuation
 def imp_hash_table_ref_cont(ht, old, env, cont, _vals):
     from pycket.interpreter import return_value
@@ -545,6 +591,9 @@ class W_ImpHashTable(W_InterposeHashTable):
     def post_ref_cont(self, key, env, cont):
         return imp_hash_table_ref_cont(self.inner, key, env, cont)
 
+    def post_key_cont(self, key, env, cont):
+        return cont
+
 @make_chaperone
 class W_ChpHashTable(W_InterposeHashTable):
 
@@ -554,6 +603,9 @@ class W_ChpHashTable(W_InterposeHashTable):
     def post_ref_cont(self, key, env, cont):
         return chp_hash_table_ref_cont(self.inner, key, env, cont)
 
+    def post_key_cont(self, key, env, cont):
+        return check_chaperone_results([key], env, cont)
+
 class W_ImpPropertyDescriptor(values.W_Object):
     errorname = "chaperone-property"
     _immutable_fields_ = ["name"]
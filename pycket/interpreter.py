@@ -3,8 +3,9 @@ from pycket                   import values
 from pycket                   import vector
 from pycket.prims.expose      import prim_env, make_call_method
 from pycket.error             import SchemeException
-from pycket.cont              import Cont, nil_continuation, label
+from pycket.cont              import BaseCont, Cont, nil_continuation, label
 from pycket.env               import SymList, ConsEnv, ToplevelEnv
+from pycket.profiler          import profiler
 from rpython.rlib             import jit, debug, objectmodel
 from rpython.rlib.objectmodel import r_dict, compute_hash, specialize
 from small_list               import inline_small_list
@@ -30,11 +31,6 @@ class GlobalConfig(object):
         GlobalConfig.instance.config.update(ast.config)
 GlobalConfig.instance = GlobalConfig()
 
-class ModuleCache(object):
-    modules = {}
-
-ModuleCache.instance = ModuleCache()
-
 class Done(Exception):
     def __init__(self, vals):
         self.values = vals
@@ -78,6 +74,9 @@ class LetrecCont(Cont):
         Cont.__init__(self, env, prev)
         self.counting_ast = counting_ast
 
+    def get_ast(self):
+        return self.counting_ast.ast
+
     @jit.unroll_safe
     def plug_reduce(self, _vals, env):
         vals = _vals._get_full_list()
@@ -105,6 +104,9 @@ class LetCont(Cont):
         Cont.__init__(self, env, prev)
         self.counting_ast  = counting_ast
 
+    def get_ast(self):
+        return self.counting_ast.ast
+
     @staticmethod
     @jit.unroll_safe
     def make(vals_w, ast, rhsindex, env, prev, fuse=True, pruning_done=False):
@@ -161,9 +163,7 @@ class LetCont(Cont):
             env = ConsEnv.make(vals_w, prev)
             return ast.make_begin_cont(env, self.prev)
         else:
-            return (ast.rhss[rhsindex + 1], self.env,
-                    LetCont.make(vals_w, ast, rhsindex + 1,
-                                 self.env, self.prev))
+            return ast.interpret_rhss(vals_w, rhsindex + 1, self.env, self.prev)
 
 
 class FusedLet0Let0Cont(Cont):
@@ -207,6 +207,9 @@ class CellCont(Cont):
         Cont.__init__(self, env, prev)
         self.ast = ast
 
+    def get_ast(self):
+        return self.ast
+
     @jit.unroll_safe
     def plug_reduce(self, vals, env):
         ast = jit.promote(self.ast)
@@ -223,6 +226,10 @@ class SetBangCont(Cont):
     def __init__(self, ast, env, prev):
         Cont.__init__(self, env, prev)
         self.ast = ast
+
+    def get_ast(self):
+        return self.ast
+
     def plug_reduce(self, vals, env):
         w_val = check_one_val(vals)
         self.ast.var._set(w_val, self.env)
@@ -234,6 +241,9 @@ class BeginCont(Cont):
         Cont.__init__(self, env, prev)
         self.counting_ast = counting_ast
 
+    def get_ast(self):
+        return self.counting_ast.ast
+
     def plug_reduce(self, vals, env):
         ast, i = self.counting_ast.unpack(SequencedBodyAST)
         return ast.make_begin_cont(self.env, self.prev, i)
@@ -244,6 +254,10 @@ class Begin0Cont(Cont):
     def __init__(self, ast, env, prev):
         Cont.__init__(self, env, prev)
         self.ast = ast
+
+    def get_ast(self):
+        return self.ast
+
     def plug_reduce(self, vals, env):
         return self.ast.body, self.env, Begin0FinishCont(self.ast, vals, self.env, self.prev)
 
@@ -253,6 +267,10 @@ class Begin0FinishCont(Cont):
         Cont.__init__(self, env, prev)
         self.ast = ast
         self.vals = vals
+
+    def get_ast(self):
+        return self.ast
+
     def plug_reduce(self, vals, env):
         return return_multi_vals(self.vals, self.env, self.prev)
 
@@ -261,6 +279,10 @@ class WCMKeyCont(Cont):
     def __init__(self, ast, env, prev):
         Cont.__init__(self, env, prev)
         self.ast = ast
+
+    def get_ast(self):
+        return self.ast
+
     def plug_reduce(self, vals, env):
         key = check_one_val(vals)
         return self.ast.value, self.env, WCMValCont(self.ast, key, self.env, self.prev)
@@ -271,6 +293,10 @@ class WCMValCont(Cont):
         Cont.__init__(self, env, prev)
         self.ast = ast
         self.key = key
+
+    def get_ast(self):
+        return self.ast
+
     def plug_reduce(self, vals, env):
         val = check_one_val(vals)
         if isinstance(self.key, values.W_ContinuationMarkKey):
@@ -280,26 +306,48 @@ class WCMValCont(Cont):
         return self.ast.body, self.env, self.prev
 
 class Module(object):
-    _immutable_fields_ = ["name", "body"]
-    def __init__(self, name, body, config):
+    _immutable_fields_ = ["name", "body", "slots", "define_slots[*]"]
+    def __init__(self, name, body, config, inlinable=None):
         self.name = name
         self.body = body
         self.env = None
         self.config = config
-        defs = {}
+        # the procedures that calls in other modules can inline, see
+        # pycket.simplify.Inliner
+        self.inlinable = inlinable
+        # every variable the module defines gets a slot in defs_w, and every
+        # define-values gets the slots of its variables
+        slots = {}
+        define_slots = []
         for b in body:
-            defs.update(b.defined_vars())
-        self.defs = defs
+            indices = []
+            if isinstance(b, DefineValues):
+                for sym in b.names:
+                    if sym not in slots:
+                        slots[sym] = len(slots)
+                    indices.append(slots[sym])
+            define_slots.append(indices)
+        self.slots = slots
+        self.define_slots = define_slots
+        # None is the sentinel for variables that are not defined yet
+        self.defs_w = [None] * len(slots)
 
     @jit.elidable
-    def lookup(self, sym):
-        if sym not in self.defs:
+    def slot_index(self, sym):
+        try:
+            return self.slots[sym]
+        except KeyError:
             raise SchemeException("unknown module variable %s" % (sym.tostring()))
-        v = self.defs[sym]
-        if not v:
+
+    def lookup_slot(self, index, sym):
+        v = self.defs_w[index]
+        if v is None:
             raise SchemeException("use of module variable before definition %s" % (sym.tostring()))
         return v
 
+    def lookup(self, sym):
+        return self.lookup_slot(self.slot_index(sym), sym)
+
     # all the module-bound variables that are mutated
     def mod_mutated_vars(self):
         x = variable_set()
@@ -308,9 +356,11 @@ class Module(object):
         return x
 
     def assign_convert_module(self):
-        local_muts = self.mod_mutated_vars()
-        new_body = [b.assign_convert(local_muts, None) for b in self.body]
-        return Module(self.name, new_body, self.config)
+        from pycket.simplify import simplify_module
+        module = simplify_module(self)
+        local_muts = module.mod_mutated_vars()
+        new_body = [b.assign_convert(local_muts, None) for b in module.body]
+        return Module(self.name, new_body, self.config, module.inlinable)
 
     def tostring(self):
         return "(module %s %s)"%(self.name," ".join([s.tostring() for s in self.body]))
@@ -328,15 +378,17 @@ class Module(object):
         module_env = env.toplevel_env().module_env
         old = module_env.current_module
         module_env.current_module = self
-        for f in self.body:
+        for i in range(len(self.body)):
+            f = self.body[i]
             # FIXME: this is wrong -- the continuation barrier here is around the RHS,
             # whereas in Racket it's around the whole `define-values`
             if isinstance(f, DefineValues):
                 e = f.rhs
                 vs = interpret_one(e, self.env)._get_full_list()
-                if len(f.names) == len(vs):
+                slots = self.define_slots[i]
+                if len(slots) == len(vs):
                     for n in range(len(vs)):
-                        self.defs[f.names[n]] = vs[n]
+                        self.defs_w[slots[n]] = vs[n]
                 else:
                     raise SchemeException("wrong number of values for define-values")
             else: # FIXME modules can have other things, assuming expression
@@ -358,11 +410,13 @@ class Require(AST):
     def assign_convert(self, vars, env_structure):
         return self
 
-    # Interpret the module and add it to the module environment
+    # Instantiate the module in the namespace of env, unless an earlier
+    # require did already. module is None for builtin modules.
     def interpret_simple(self, env):
+        if self.module is None:
+            return values.w_void
         top = env.toplevel_env()
-        top.module_env.add_module(self.modname, self.module)
-        self.module.interpret_mod(top)
+        top.module_env.instantiate(self.modname, self.module)
         return values.w_void
 
     def tostring(self):
@@ -526,8 +580,103 @@ class WithContinuationMark(AST):
     def interpret(self, env, cont):
         return self.key, env, WCMKeyCont(self, env, cont)
 
+class CallSiteStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.polymorphic = 0
+        self.megamorphic = 0
+
+call_site_stats = CallSiteStats()
+
+POLYMORPHIC_LIMIT = 4
+
+class CallSiteCache(object):
+    """ Inline cache of an App, used by the interpreter to skip arity
+    matching for closures. It maps the CaseLambdas called at the site to the
+    index of the clause the call selected. The cache starts monomorphic,
+    becomes polymorphic when a second CaseLambda is called and megamorphic,
+    ie. it stops caching, after POLYMORPHIC_LIMIT of them. """
+    def __init__(self):
+        self.caselams = None
+        self.indices = None
+        self.megamorphic = False
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, caselam):
+        caselams = self.caselams
+        if caselams is not None:
+            for i in range(len(caselams)):
+                if caselams[i] is caselam:
+                    self.hits += 1
+                    call_site_stats.hits += 1
+                    return self.indices[i]
+        self.misses += 1
+        call_site_stats.misses += 1
+        return -1
+
+    def record(self, caselam, index):
+        if self.megamorphic:
+            return
+        if self.caselams is None:
+            self.caselams = [caselam]
+            self.indices = [index]
+        elif len(self.caselams) < POLYMORPHIC_LIMIT:
+            if len(self.caselams) == 1:
+                call_site_stats.polymorphic += 1
+            self.caselams.append(caselam)
+            self.indices.append(index)
+        else:
+            self.megamorphic = True
+            self.caselams = None
+            self.indices = None
+            call_site_stats.megamorphic += 1
+
+# Direct-style evaluation. An AST with a direct_depth >= 0 only calls simple
+# primitives, which can neither capture the continuation nor look at
+# continuation marks, so it is evaluated recursively on the host stack by
+# interpret_direct, without allocating a continuation frame or returning to
+# the trampoline. Lets, begins and set!s evaluate their direct parts that way
+# and only materialize a continuation for the first part that needs one.
+# Nests deeper than MAX_DIRECT_DEPTH are not direct, so their outer parts are
+# interpreted with continuations again.
+
+MAX_DIRECT_DEPTH = 32
+
+class DirectConfig(object):
+    def __init__(self):
+        self.enabled = True
+
+direct_config = DirectConfig()
+
+def direct_depth(asts):
+    if not direct_config.enabled:
+        return -1
+    depth = 0
+    for ast in asts:
+        if ast.simple:
+            continue
+        if ast.direct_depth < 0:
+            return -1
+        depth = max(depth, ast.direct_depth)
+    if depth >= MAX_DIRECT_DEPTH:
+        return -1
+    return depth + 1
+
+class DirectCont(BaseCont):
+    """ receives the values of a simple primitive called by
+    App.interpret_direct """
+    def __init__(self):
+        BaseCont.__init__(self)
+        self.vals = None
+
+    def plug_reduce(self, vals, env):
+        self.vals = vals
+        return None, env, self
+
 class App(AST):
-    _immutable_fields_ = ["rator", "rands[*]", "env_structure"]
+    _immutable_fields_ = ["rator", "rands[*]", "env_structure", "cache"]
 
     def __init__ (self, rator, rands, env_structure=None):
         assert rator.simple
@@ -536,7 +685,17 @@ class App(AST):
         self.rator = rator
         self.rands = rands
         self.env_structure = env_structure
+        self.cache = CallSiteCache()
         self.should_enter = isinstance(rator, ModuleVar) and not rator.is_primitive()
+        if self._calls_simple_primitive():
+            self.direct_depth = direct_depth(rands)
+
+    def _calls_simple_primitive(self):
+        rator = self.rator
+        if not isinstance(rator, ModuleVar) or not rator.is_primitive():
+            return False
+        w_prim = prim_env.get(rator.srcsym, None)
+        return isinstance(w_prim, values.W_Prim) and w_prim.simple
 
     @staticmethod
     def make_let_converted(rator, rands):
@@ -569,8 +728,17 @@ class App(AST):
             return App(rator, rands)
 
     def assign_convert(self, vars, env_structure):
-        return App(self.rator.assign_convert(vars, env_structure),
-                   [e.assign_convert(vars, env_structure) for e in self.rands],
+        rator = self.rator
+        rands = self.rands
+        if isinstance(rator, CaseLambda):
+            # immediately applied recursive lambda, eg. a named let
+            lifted, extra = lambda_lift(rator, vars)
+            if (lifted is not None and
+                    len(rands) + len(extra) == len(lifted.lams[0].formals)):
+                rator = lifted
+                rands = rands + [LexicalVar(v) for v in extra]
+        return App(rator.assign_convert(vars, env_structure),
+                   [e.assign_convert(vars, env_structure) for e in rands],
                    env_structure=env_structure)
 
     def direct_children(self):
@@ -592,6 +760,19 @@ class App(AST):
             args_w[i] = rand.interpret_simple(env)
         return w_callable.call_with_extra_info(args_w, env, cont, self)
 
+    @jit.unroll_safe
+    def interpret_direct(self, env):
+        w_prim = self.rator.interpret_simple(env)
+        args_w = [None] * len(self.rands)
+        for i, rand in enumerate(self.rands):
+            args_w[i] = rand.interpret_simple(env)
+        cont = DirectCont()
+        ast, env, k = w_prim.call(args_w, env, cont)
+        # several values are returned through the return_multi_vals label
+        while cont.vals is None:
+            ast, env, k = ast.interpret(env, k)
+        return cont.vals
+
     def tostring(self):
         return "(%s %s)"%(self.rator.tostring(), " ".join([r.tostring() for r in self.rands]))
 
@@ -607,15 +788,26 @@ class SequencedBodyAST(AST):
             CombinedAstAndIndex(self, i)
                 for i in range(counts_needed)]
 
+    @jit.unroll_safe
     def make_begin_cont(self, env, prev, i=0):
         jit.promote(self)
         jit.promote(i)
+        # the values of these are dropped, they don't need a BeginCont
+        while i < len(self.body) - 1 and self.body[i].is_direct():
+            self.body[i].interpret_direct(env)
+            i += 1
         if i == len(self.body) - 1:
             return self.body[i], env, prev
         else:
             return self.body[i], env, BeginCont(
                     self.counting_asts[i + 1], env, prev)
 
+    @jit.unroll_safe
+    def interpret_body_direct(self, env):
+        for i in range(len(self.body) - 1):
+            self.body[i].interpret_direct(env)
+        return self.body[-1].interpret_direct(env)
+
 
 class Begin0(AST):
     _immutable_fields_ = ["first", "body"]
@@ -659,6 +851,10 @@ class Begin(SequencedBodyAST):
         else:
             return Begin(body)
 
+    def __init__(self, body):
+        SequencedBodyAST.__init__(self, body)
+        self.direct_depth = direct_depth(body)
+
     def assign_convert(self, vars, env_structure):
         return Begin.make([e.assign_convert(vars, env_structure) for e in self.body])
 
@@ -674,6 +870,9 @@ class Begin(SequencedBodyAST):
     def interpret(self, env, cont):
         return self.make_begin_cont(env, cont)
 
+    def interpret_direct(self, env):
+        return self.interpret_body_direct(env)
+
     def tostring(self):
         return "(begin %s)" % (" ".join([e.tostring() for e in self.body]))
 
@@ -749,13 +948,16 @@ class LexicalVar(Var):
             return LexicalVar(self.sym, env_structure)
 
 class ModuleVar(Var):
-    _immutable_fields_ = ["modenv?", "sym", "srcmod", "srcsym", "w_value?"]
+    _immutable_fields_ = ["modenv?", "sym", "srcmod", "srcsym", "w_value?",
+                          "module?", "slot?"]
     def __init__(self, sym, srcmod, srcsym):
         Var.__init__(self, sym)
         self.srcmod = srcmod
         self.srcsym = srcsym
         self.modenv = None
         self.w_value = None
+        self.module = None
+        self.slot = -1
 
     def free_vars(self):
         return {}
@@ -765,7 +967,7 @@ class ModuleVar(Var):
         if w_res is None:
             if self.modenv is None:
                 self.modenv = env.toplevel_env().module_env
-            self.w_value = w_res = self._elidable_lookup()
+            self.w_value = w_res = self._lookup_uncached()
 
         if type(w_res) is values.W_Cell:
             return w_res.get_val()
@@ -776,31 +978,40 @@ class ModuleVar(Var):
     def is_mutable(self, env):
         if self.modenv is None:
             self.modenv = env.toplevel_env().module_env
-        v = self._elidable_lookup()
+        v = self._lookup_uncached()
         return isinstance(v, values.W_Cell)
 
     @jit.elidable
     def is_primitive(self):
         return self.srcmod in ["#%kernel", "#%unsafe", "#%paramz", "#%flfxnum", "#%utils", "#%place"]
 
-    @jit.elidable
-    def _elidable_lookup(self):
+    def _lookup_uncached(self):
         assert self.modenv
-        modenv = self.modenv
-        if self.srcmod is None:
-            mod = modenv.current_module
-        elif self.is_primitive():
+        if self.is_primitive():
             # we don't separate these the way racket does
             # but maybe we should
             try:
                 return prim_env[self.srcsym]
             except KeyError:
                 raise SchemeException("can't find primitive %s" % (self.srcsym.tostring()))
+        self._resolve_slot()
+        return self.module.lookup_slot(self.slot, self.srcsym)
+
+    # Finds the module that defines the variable and the variable's slot in
+    # it. The module is only known once it has been instantiated, so this
+    # happens on the first lookup rather than in assign_convert.
+    def _resolve_slot(self):
+        if self.module is not None:
+            return
+        modenv = self.modenv
+        if self.srcmod is None:
+            mod = modenv.current_module
         else:
             mod = modenv._find_module(self.srcmod)
             if mod is None:
                 raise SchemeException("can't find module %s for %s" % (self.srcmod, self.srcsym.tostring()))
-        return mod.lookup(self.srcsym)
+        self.slot = mod.slot_index(self.srcsym)
+        self.module = mod
 
     def assign_convert(self, vars, env_structure):
         return self
@@ -814,7 +1025,7 @@ class ModuleVar(Var):
     def _set(self, w_val, env):
         if self.modenv is None:
             self.modenv = env.toplevel_env().module_env
-        v = self._elidable_lookup()
+        v = self._lookup_uncached()
         assert isinstance(v, values.W_Cell)
         v.set_val(w_val)
 
@@ -864,10 +1075,19 @@ class SetBang(AST):
     def __init__(self, var, rhs):
         self.var = var
         self.rhs = rhs
+        self.direct_depth = direct_depth([rhs])
 
     def interpret(self, env, cont):
+        if self.rhs.is_direct():
+            self.interpret_direct(env)
+            return return_value_direct(values.w_void, env, cont)
         return self.rhs, env, SetBangCont(self, env, cont)
 
+    def interpret_direct(self, env):
+        w_val = check_one_val(self.rhs.interpret_direct(env))
+        self.var._set(w_val, env)
+        return values.Values.make1(values.w_void)
+
     def assign_convert(self, vars, env_structure):
         return SetBang(self.var.assign_convert(vars, env_structure),
                        self.rhs.assign_convert(vars, env_structure))
@@ -897,6 +1117,7 @@ class If(AST):
         self.tst = tst
         self.thn = thn
         self.els = els
+        self.direct_depth = direct_depth([thn, els])
 
     @staticmethod
     def make_let_converted(tst, thn, els):
@@ -916,6 +1137,13 @@ class If(AST):
         else:
             return self.thn, env, cont
 
+    def interpret_direct(self, env):
+        w_val = self.tst.interpret_simple(env)
+        if w_val is values.w_false:
+            return self.els.interpret_direct(env)
+        else:
+            return self.thn.interpret_direct(env)
+
     def assign_convert(self, vars, env_structure):
         sub_env_structure = env_structure
         return If(self.tst.assign_convert(vars, env_structure),
@@ -959,11 +1187,13 @@ class CaseLambda(AST):
         ## TODO: drop lams whose arity is redundant
         ## (case-lambda [x 0] [(y) 1]) == (lambda x 0)
         self.lams = lams
+        # a lambda whose only free variable is itself is closed as well
         self.any_frees = False
         for l in lams:
-            if l.frees.elems:
-                self.any_frees = True
-                break
+            for v in l.frees.elems:
+                if v is not recursive_sym:
+                    self.any_frees = True
+                    break
         self.w_closure_if_no_frees = None
         self.recursive_sym = recursive_sym
 
@@ -1063,6 +1293,24 @@ class Lambda(SequencedBodyAST):
         else:
             return len(self.formals)
 
+    def srcloc_label(self):
+        file, pos = self.srcfile, self.srcpos
+        if file and (pos >= 0):
+            return "%s:%s" % (file, pos)
+        if file:
+            return file
+        return "lambda"
+
+    def compact_srcloc(self):
+        file = self.srcfile
+        if not file:
+            return "lambda"
+        i = file.rfind("/") + 1
+        assert i >= 0
+        if self.srcpos >= 0:
+            return "%s:%s" % (file[i:], self.srcpos)
+        return file[i:]
+
     def interpret_simple(self, env):
         assert False # unreachable
 
@@ -1319,6 +1567,136 @@ def make_letrec(varss, rhss, body):
     symlist, counts = _make_symlist_counts(varss)
     return Letrec(symlist, counts, rhss, body)
 
+# Lambda lifting: a recursive local procedure that is only ever called
+# directly, such as the loop of a named let, takes its free variables as
+# extra arguments instead. The lifted procedure is closed, so evaluating it
+# returns the cached closure of its CaseLambda instead of allocating one and
+# copying the free variables into it.
+
+LAMBDA_LIFT_MAX_FREES = 4
+
+def lambda_lift(caselam, vars):
+    """ Returns the lifted copy of a recursive caselam and the variables to
+    pass as extra arguments to it, or (None, None) if it cannot be lifted.
+    vars are the mutated variables in scope, which have to stay free. The
+    callers check that the procedure does not escape outside of its body. """
+    sym = caselam.recursive_sym
+    if sym is None or len(caselam.lams) != 1:
+        return None, None
+    lam = caselam.lams[0]
+    if lam.rest:
+        return None, None
+    extra = [v for v in lam.frees.elems if v is not sym]
+    if not extra or len(extra) > LAMBDA_LIFT_MAX_FREES:
+        return None, None
+    for v in extra:
+        if LexicalVar(v) in vars:
+            return None, None
+    body = []
+    for b in lam.body:
+        new_b = lift_calls(b, sym, len(lam.formals), extra)
+        if new_b is None:
+            return None, None
+        body.append(new_b)
+    new_lam = make_lambda(lam.formals + extra, None, body, lam.srcpos,
+                          lam.srcfile)
+    return CaseLambda([new_lam], recursive_sym=sym), extra
+
+def _binds_any(args, sym, extra):
+    for v in args.elems:
+        if v is sym or v in extra:
+            return True
+    return False
+
+def _lift_calls_list(asts, sym, nargs, extra):
+    result = []
+    for ast in asts:
+        new_ast = lift_calls(ast, sym, nargs, extra)
+        if new_ast is None:
+            return None
+        result.append(new_ast)
+    return result
+
+def lift_calls(ast, sym, nargs, extra):
+    """ Returns a copy of ast in which the calls of sym pass the variables
+    in extra as additional arguments, or None if sym escapes, ie. it is used
+    other than as the operator of calls with nargs arguments (or a binding
+    shadows it or one of the extra variables). """
+    if isinstance(ast, App):
+        rator = ast.rator
+        if isinstance(rator, LexicalVar) and rator.sym is sym:
+            if len(ast.rands) != nargs:
+                return None
+            tail = [LexicalVar(v) for v in extra]
+        else:
+            rator = lift_calls(rator, sym, nargs, extra)
+            if rator is None:
+                return None
+            tail = []
+        rands = _lift_calls_list(ast.rands, sym, nargs, extra)
+        if rands is None:
+            return None
+        return App(rator, rands + tail)
+    elif isinstance(ast, If):
+        parts = _lift_calls_list([ast.tst, ast.thn, ast.els], sym, nargs, extra)
+        if parts is None:
+            return None
+        return If(parts[0], parts[1], parts[2])
+    elif isinstance(ast, Begin):
+        body = _lift_calls_list(ast.body, sym, nargs, extra)
+        if body is None:
+            return None
+        return Begin.make(body)
+    elif isinstance(ast, Begin0):
+        parts = _lift_calls_list([ast.first, ast.body], sym, nargs, extra)
+        if parts is None:
+            return None
+        return Begin0(parts[0], parts[1])
+    elif isinstance(ast, WithContinuationMark):
+        parts = _lift_calls_list([ast.key, ast.value, ast.body], sym, nargs, extra)
+        if parts is None:
+            return None
+        return WithContinuationMark(parts[0], parts[1], parts[2])
+    elif isinstance(ast, SetBang):
+        if ast.var.sym is sym:
+            return None
+        rhs = lift_calls(ast.rhs, sym, nargs, extra)
+        if rhs is None:
+            return None
+        return SetBang(ast.var, rhs)
+    elif isinstance(ast, Let) or isinstance(ast, Letrec):
+        if _binds_any(ast.args, sym, extra):
+            return None
+        rhss = _lift_calls_list(ast.rhss, sym, nargs, extra)
+        body = _lift_calls_list(ast.body, sym, nargs, extra)
+        if rhss is None or body is None:
+            return None
+        if isinstance(ast, Let):
+            return Let(ast.args, ast.counts, rhss, body)
+        return Letrec(ast.args, ast.counts, rhss, body)
+    elif isinstance(ast, CaseLambda):
+        if ast.recursive_sym is sym or ast.recursive_sym in extra:
+            return None
+        lams = []
+        for lam in ast.lams:
+            new_lam = lift_calls(lam, sym, nargs, extra)
+            if new_lam is None:
+                return None
+            assert isinstance(new_lam, Lambda)
+            lams.append(new_lam)
+        return CaseLambda(lams, recursive_sym=ast.recursive_sym)
+    elif isinstance(ast, Lambda):
+        if _binds_any(ast.args, sym, extra):
+            return None
+        body = _lift_calls_list(ast.body, sym, nargs, extra)
+        if body is None:
+            return None
+        return make_lambda(ast.formals, ast.rest, body, ast.srcpos, ast.srcfile)
+    # everything else has to leave sym alone
+    if sym in ast.free_vars():
+        return None
+    return ast
+
 class Let(SequencedBodyAST):
     _immutable_fields_ = ["rhss[*]", "args", "counts[*]", "env_speculation_works?", "remove_num_envs[*]"]
 
@@ -1333,6 +1711,7 @@ class Let(SequencedBodyAST):
         if remove_num_envs is None:
             remove_num_envs = [0] * (len(rhss) + 1)
         self.remove_num_envs = remove_num_envs
+        self.direct_depth = direct_depth(rhss + body)
 
     def replace_innermost_with_app(self, newsym, rator, rands):
         assert len(self.body) == 1
@@ -1366,8 +1745,35 @@ class Let(SequencedBodyAST):
 
     def interpret(self, env, cont):
         env = self._prune_env(env, 0)
-        return self.rhss[0], env, LetCont.make(
-                [], self, 0, env, cont)
+        return self.interpret_rhss([], 0, env, cont)
+
+    @jit.unroll_safe
+    def interpret_rhss(self, vals_w, i, env, cont):
+        """ evaluates the rhss from i on, env is pruned for rhs i. the
+        leading direct rhss are evaluated right away, a LetCont is only made
+        for the first one that is not direct """
+        while i < len(self.rhss):
+            rhs = self.rhss[i]
+            if not rhs.is_direct():
+                return rhs, env, LetCont.make(vals_w, self, i, env, cont)
+            vals_w = self._add_vals(vals_w, rhs.interpret_direct(env), i)
+            i += 1
+            env = self._prune_env(env, i)
+        return self.make_begin_cont(ConsEnv.make(vals_w, env), cont)
+
+    def _add_vals(self, vals_w, vals, i):
+        if self.counts[i] != vals._get_size_list():
+            raise SchemeException("wrong number of values")
+        return vals_w + vals._get_full_list()
+
+    @jit.unroll_safe
+    def interpret_direct(self, env):
+        vals_w = []
+        for i, rhs in enumerate(self.rhss):
+            env = self._prune_env(env, i)
+            vals_w = self._add_vals(vals_w, rhs.interpret_direct(env), i)
+        env = self._prune_env(env, len(self.rhss))
+        return self.interpret_body_direct(ConsEnv.make(vals_w, env))
 
     def direct_children(self):
         return self.body + self.rhss
@@ -1395,7 +1801,29 @@ class Let(SequencedBodyAST):
             x.update(b.free_vars())
         return x
 
+    def _lambda_lift(self, vars):
+        if len(self.rhss) != 1 or self.counts[0] != 1:
+            return None
+        rhs = self.rhss[0]
+        sym = self.args.elems[0]
+        if not isinstance(rhs, CaseLambda) or rhs.recursive_sym is not sym:
+            return None
+        lifted, extra = lambda_lift(rhs, vars)
+        if lifted is None:
+            return None
+        nargs = len(rhs.lams[0].formals)
+        body = []
+        for b in self.body:
+            new_b = lift_calls(b, sym, nargs, extra)
+            if new_b is None:
+                return None
+            body.append(new_b)
+        return Let(self.args, self.counts, [lifted], body)
+
     def assign_convert(self, vars, env_structure):
+        lifted = self._lambda_lift(vars)
+        if lifted is not None:
+            return lifted.assign_convert(vars, env_structure)
         sub_env_structure = SymList(self.args.elems, env_structure)
         local_muts = variable_set()
         for b in self.body:
@@ -1554,10 +1982,17 @@ class DefineValues(AST):
         return "(define-values %s %s)" % (
             self.display_names, self.rhs.tostring())
 
+LOCATION_LENGTH = 60
+
 def get_printable_location(green_ast):
     if green_ast is None:
         return 'Green_Ast is None'
-    return green_ast.tostring()
+    lam = green_ast.surrounding_lambda
+    location = lam.compact_srcloc() if lam is not None else "<module>"
+    code = green_ast.tostring()
+    if len(code) > LOCATION_LENGTH:
+        code = code[:LOCATION_LENGTH - 3] + "..."
+    return "%s %s" % (location, code)
 
 driver = jit.JitDriver(reds=["env", "cont"],
                        greens=["ast"],
@@ -1572,6 +2007,8 @@ def interpret_one(ast, env=None):
         while True:
             driver.jit_merge_point(ast=ast, env=env, cont=cont)
             ast, env, cont = ast.interpret(env, cont)
+            if profiler.active:
+                profiler.step(ast, cont)
             if ast.should_enter:
                 #print ast.tostring()
                 driver.can_enter_jit(ast=ast, env=env, cont=cont)
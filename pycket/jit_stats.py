@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# JIT statistics (--jit-stats and pycket:jit-stats). The JIT hooks count the
+# loops compiled for every green AST, labelled with get_printable_location,
+# the bridges and the aborted traces. The JIT's own counters contribute the
+# time spent tracing and, since --jit-stats turns on the JIT's debug
+# counters, how often guards failed into bridges.
+#
+import os
+
+from rpython.rlib import jit_hooks
+from rpython.rlib.jit import JitHookInterface, Counters
+from rpython.rlib.objectmodel import we_are_translated
+
+from pycket.profiler import sorted_entries
+
+ABORT_REASONS = [(Counters.ABORT_TOO_LONG, "trace too long"),
+                 (Counters.ABORT_BRIDGE, "bridge"),
+                 (Counters.ABORT_BAD_LOOP, "bad loop"),
+                 (Counters.ABORT_ESCAPE, "escape"),
+                 (Counters.ABORT_FORCE_QUASIIMMUT, "quasi-immutable forced")]
+
+def abort_reason_name(reason):
+    for (r, name) in ABORT_REASONS:
+        if r == reason:
+            return name
+    return "other"
+
+class JitStats(object):
+    def __init__(self):
+        self.enabled = False
+        self.loops = {}
+        self.bridges = 0
+        self.aborts = {}
+        self.too_long = {}
+
+    def enable(self):
+        self.enabled = True
+        if we_are_translated():
+            jit_hooks.stats_set_debug(None, True)
+
+    def record_loop(self, label):
+        self.loops[label] = self.loops.get(label, 0) + 1
+
+    def record_bridge(self):
+        self.bridges += 1
+
+    def record_abort(self, reason, label):
+        name = abort_reason_name(reason)
+        self.aborts[name] = self.aborts.get(name, 0) + 1
+        if reason == Counters.ABORT_TOO_LONG:
+            self.too_long[label] = self.too_long.get(label, 0) + 1
+
+    def guard_failures(self):
+        if not we_are_translated():
+            return 0
+        failures = 0
+        run_times = jit_hooks.stats_get_loop_run_times(None)
+        for i in range(len(run_times)):
+            if run_times[i].type == 'b':
+                failures += run_times[i].counter
+        return failures
+
+    def tracing_time(self):
+        if not we_are_translated():
+            return 0.0
+        return jit_hooks.stats_get_times_value(None, Counters.TRACING)
+
+    def report(self):
+        loops = 0
+        for count in self.loops.itervalues():
+            loops += count
+        aborts = 0
+        for count in self.aborts.itervalues():
+            aborts += count
+        lines = ["JIT statistics:\n",
+                 "loops compiled: %d\n" % loops,
+                 "bridges compiled: %d\n" % self.bridges,
+                 "guard failures into bridges: %d\n" % self.guard_failures(),
+                 "aborted traces: %d\n" % aborts]
+        for entry in sorted_entries(self.aborts):
+            lines.append("  %s: %d\n" % (entry.label, entry.time))
+        lines.append("tracing time: %s s\n" % self.tracing_time())
+        if self.loops:
+            lines.append("loops by green AST:\n")
+            for entry in sorted_entries(self.loops):
+                lines.append("  %d %s\n" % (entry.time, entry.label))
+        if self.too_long:
+            lines.append("traces too long by green AST:\n")
+            for entry in sorted_entries(self.too_long):
+                lines.append("  %d %s\n" % (entry.time, entry.label))
+        return "".join(lines)
+
+    def write_report(self):
+        if self.enabled:
+            os.write(2, self.report())
+
+jit_stats = JitStats()
+
+class PycketJitHooks(JitHookInterface):
+    def on_abort(self, reason, jitdriver, greenkey, greenkey_repr, logops,
+                 operations):
+        jit_stats.record_abort(reason, greenkey_repr)
+
+    def after_compile(self, debug_info):
+        jit_stats.record_loop(debug_info.get_greenkey_repr())
+
+    def after_compile_bridge(self, debug_info):
+        jit_stats.record_bridge()
+
+pycket_jit_hooks = PycketJitHooks()
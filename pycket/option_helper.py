@@ -5,7 +5,14 @@ import os
 
 from .expand import (expand_file_to_json, expand_code_to_json,
                      ensure_json_ast_eval, ensure_json_ast_run,
-                     PermException, SchemeException)
+                     PermException, SchemeException, cache_directory,
+                     expander, parallel_expansion, conversion_config)
+
+from pycket.values import file_output_state
+from pycket.profiler import profiler
+from pycket.jit_stats import jit_stats
+from pycket.simplify import inliner
+from pycket.interpreter import direct_config
 
 from rpython.rlib import jit
 
@@ -40,9 +47,33 @@ def print_help(argv):
   -u <file>, --require-script <file> : Same as -t <file> -N <file> --
  Configuration options:
   --stdlib: Use Pycket's version of stdlib (only applicable for -e)
+  --output-buffer-size <bytes> : Buffer size of file output ports, including
+                                 the standard output
+  --cache-dir <dir> : Keep expanded modules in <dir> instead of next to the
+                      sources (default: $PYCKET_CACHE_DIR, if set)
+  --cache-size <bytes> : Maximum size of the cache directory
+  --expand-jobs <n> : Expand the modules a program requires with up to <n>
+                      Racket processes in parallel before loading it
+  --lazy-lambdas : Convert the body of a lambda only when it is first called;
+                   modules loaded this way are not written to the cache
+  --no-inline : Do not inline calls of small module-level procedures
+  --no-direct : Always interpret with continuations, also code that only
+                calls simple primitives
+  --expander-server : Start one Racket expander process and use it for all
+                      expansions
+  --expander-socket <path> : Use the Racket expander serving on the Unix socket
+                             <path> (default: $PYCKET_EXPANDER_SOCKET, if set)
+ Profiling options:
+  --profile <file> : Sample the running program and write the time spent in
+                     each call path to <file> in collapsed-stack format; a
+                     per-function summary is printed to stderr at exit
+  --profile-interval <n> : Take a sample every <n> interpreter steps
+                           (default: 10000)
  Meta options:
   --jit <jitargs> : Set RPython JIT options may be 'default', 'off',
                     or 'param=value,param=value' list
+  --jit-stats : Print statistics about the loops the JIT compiled, labelled
+                by source location, to stderr at exit
   -- : No argument following this switch is used as a switch
   -h, --help : Show this information and exits, ignoring other options
 Default options:
@@ -75,6 +106,9 @@ def parse_args(argv):
             i += 1
             jitarg = argv[i]
             jit.set_user_param(None, jitarg)
+        elif argv[i] == "--jit-stats":
+            jit_stats.enable()
+            i += 1
         elif argv[i] in ["-h", "--help", "/?", "-?", "/h", "/help"]:
             print_help(argv)
             return (None, None, None, 0)
@@ -84,6 +118,74 @@ def parse_args(argv):
         elif argv[i] == "--stdlib":
             config['stdlib'] = True
             i += 1
+        elif argv[i] == "--output-buffer-size":
+            if to <= i + 1 or not argv[i + 1].isdigit():
+                print "missing or invalid argument after --output-buffer-size"
+                retval = 2
+                break
+            i += 1
+            file_output_state.buffer_size = int(argv[i])
+            i += 1
+        elif argv[i] == "--cache-dir":
+            if to <= i + 1:
+                print "missing argument after --cache-dir"
+                retval = 2
+                break
+            i += 1
+            cache_directory.directory = argv[i]
+            i += 1
+        elif argv[i] == "--cache-size":
+            if to <= i + 1 or not argv[i + 1].isdigit():
+                print "missing or invalid argument after --cache-size"
+                retval = 2
+                break
+            i += 1
+            cache_directory.max_size = int(argv[i])
+            i += 1
+        elif argv[i] == "--expand-jobs":
+            if to <= i + 1 or not argv[i + 1].isdigit():
+                print "missing or invalid argument after --expand-jobs"
+                retval = 2
+                break
+            i += 1
+            parallel_expansion.jobs = int(argv[i])
+            i += 1
+        elif argv[i] == "--lazy-lambdas":
+            conversion_config.lazy_lambdas = True
+            i += 1
+        elif argv[i] == "--no-inline":
+            inliner.enabled = False
+            i += 1
+        elif argv[i] == "--no-direct":
+            direct_config.enabled = False
+            i += 1
+        elif argv[i] == "--expander-server":
+            expander.spawn = True
+            i += 1
+        elif argv[i] == "--expander-socket":
+            if to <= i + 1:
+                print "missing argument after --expander-socket"
+                retval = 2
+                break
+            i += 1
+            expander.socket_path = argv[i]
+            i += 1
+        elif argv[i] == "--profile":
+            if to <= i + 1:
+                print "missing argument after --profile"
+                retval = 2
+                break
+            i += 1
+            profiler.output = argv[i]
+            i += 1
+        elif argv[i] == "--profile-interval":
+            if to <= i + 1 or not argv[i + 1].isdigit() or int(argv[i + 1]) == 0:
+                print "missing or invalid argument after --profile-interval"
+                retval = 2
+                break
+            i += 1
+            profiler.interval = int(argv[i])
+            i += 1
         elif argv[i] == "-e":
             if to <= i + 1:
                 print "missing argument after -e"
@@ -164,10 +266,8 @@ def ensure_json_ast(config, names):
         if file_name.endswith('.json'):
             json_file = file_name
         else:
-            try:
-                json_file = ensure_json_ast_run(file_name)
-            except PermException:
-                json_file = None
+            # loaded through the binary AST cache
+            json_file = None
     else:
         raise SchemeException("unknown mode %s" % config["mode"])
     return os.path.abspath(file_name), json_file
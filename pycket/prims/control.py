@@ -0,0 +1,134 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Prompts and aborts. A prompt is a PromptCont frame in the continuation, so
+# installing one is a single allocation and aborting to it only walks the
+# continuation up to the frame. The bottom of every continuation acts as the
+# prompt for the default tag that Racket puts around module-level forms.
+#
+from pycket import values
+from pycket.cont import Cont, continuation, nil_continuation
+from pycket.error import SchemeException
+from pycket.prims.expose import default, expose
+
+class PromptCont(Cont):
+    _immutable_fields_ = ["tag", "handler", "env", "prev"]
+    def __init__(self, tag, handler, env, prev):
+        Cont.__init__(self, env, prev)
+        self.tag = tag
+        self.handler = handler
+
+    def plug_reduce(self, vals, env):
+        from pycket.interpreter import return_multi_vals
+        return return_multi_vals(vals, env, self.prev)
+
+def find_prompt(tag, cont):
+    while isinstance(cont, Cont):
+        if isinstance(cont, PromptCont) and cont.tag is tag:
+            return cont
+        cont = cont.prev
+    return None
+
+@expose("make-continuation-prompt-tag", [default(values.W_Symbol, None)])
+def mcpt(s):
+    from pycket.interpreter import Gensym
+    s = Gensym.gensym("cm") if s is None else s
+    return values.W_ContinuationPromptTag(s)
+
+@expose("default-continuation-prompt-tag", [])
+def default_cpt():
+    return values.w_default_continuation_prompt_tag
+
+@expose("continuation-prompt-tag?", [values.W_Object])
+def cont_prompt_tag(v):
+    return values.W_Bool.make(isinstance(v, values.W_ContinuationPromptTag))
+
+@expose("continuation-prompt-available?",
+        [values.W_ContinuationPromptTag, default(values.W_Object, None)],
+        simple=False)
+def cont_prompt_avail(tag, k, env, cont):
+    from pycket.interpreter import return_value
+    the_cont = cont
+    if k is not None:
+        if not isinstance(k, values.W_Continuation):
+            raise SchemeException(
+                "continuation-prompt-available?: expected continuation")
+        the_cont = k.cont
+    available = (tag is values.w_default_continuation_prompt_tag or
+                 find_prompt(tag, the_cont) is not None)
+    return return_value(values.W_Bool.make(available), env, cont)
+
+@expose("call-with-continuation-prompt", simple=False, arity=([], 1))
+def call_with_prompt(args, env, cont):
+    if not args:
+        raise SchemeException("call-with-continuation-prompt: expected procedure")
+    proc = args[0]
+    tag = values.w_default_continuation_prompt_tag
+    handler = values.w_false
+    if len(args) > 1:
+        tag = args[1]
+        if not isinstance(tag, values.W_ContinuationPromptTag):
+            raise SchemeException(
+                "call-with-continuation-prompt: expected continuation-prompt-tag")
+    if len(args) > 2:
+        handler = args[2]
+    args = args[3:] if len(args) > 3 else []
+    return proc.call(args, env, PromptCont(tag, handler, env, cont))
+
+@expose("abort-current-continuation", simple=False, arity=([], 1))
+def abort_current_continuation(args, env, cont):
+    if not args:
+        raise SchemeException(
+            "abort-current-continuation: expected continuation-prompt-tag")
+    tag = args[0]
+    if not isinstance(tag, values.W_ContinuationPromptTag):
+        raise SchemeException(
+            "abort-current-continuation: expected continuation-prompt-tag")
+    vals_w = args[1:]
+    prompt = find_prompt(tag, cont)
+    if prompt is not None:
+        handler = prompt.handler
+        cont = prompt.prev
+    elif tag is values.w_default_continuation_prompt_tag:
+        handler = values.w_false
+        cont = nil_continuation
+    else:
+        raise SchemeException(
+            "abort-current-continuation: no such prompt exists")
+    if handler is values.w_false:
+        # the default handler calls the thunk it is given in place of the
+        # call-with-continuation-prompt
+        if len(vals_w) != 1:
+            raise SchemeException(
+                "abort-current-continuation: default handler expects a thunk")
+        return vals_w[0].call([], env, cont)
+    return handler.call(vals_w, env, cont)
+
+# used by with-handlers, there are no breaks to check for
+@expose("check-for-break", [])
+def check_for_break():
+    return values.w_void
+
+@continuation
+def raise_handler_cont(env, cont, vals):
+    raise SchemeException("raise: exception handler returned")
+
+def raise_exn(w_exn, env, cont):
+    """ calls the innermost exception handler installed with
+    exception-handler-key on w_exn, with the next outer handler installed
+    while it runs """
+    k = cont
+    while True:
+        w_handler = k.find_cm(values.exn_handler_key)
+        if w_handler is not None or not isinstance(k, Cont):
+            break
+        k = k.prev
+    if w_handler is None or w_handler is values.w_false:
+        raise SchemeException("uncaught exception: %s" % w_exn.tostring())
+    w_outer = None
+    if isinstance(k, Cont):
+        w_outer = k.prev.get_mark_first(values.exn_handler_key)
+    handler_cont = raise_handler_cont(env, cont)
+    handler_cont.update_cm(values.exn_handler_key,
+                           values.w_false if w_outer is None else w_outer)
+    return w_handler.call([w_exn], env, handler_cont)
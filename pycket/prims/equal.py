@@ -5,7 +5,8 @@ from pycket              import values
 from pycket              import values_struct
 from pycket.cont         import continuation, label, loop_label
 from pycket.prims.expose import expose, procedure
-from rpython.rlib import jit, objectmodel
+from pycket.values_hash  import UndecidedEqual
+from rpython.rlib import jit, objectmodel, rarithmetic
 
 # All of my hate...
 # Configuration table for information about how to perform equality checks.
@@ -169,6 +170,70 @@ def equal_func(a, b, info, env, cont):
 
         return return_value(values.w_false, env, cont)
 
+# equal? for code that cannot run Racket code, like the constructors of hash
+# tables. Returns 1 or 0, or -1 if the comparison involves impersonators or
+# structs with prop:equal+hash and has to be done by equal_func.
+def equal_nocont(a, b):
+    while True:
+        if a.eqv(b):
+            return 1
+        if a.is_proxy() or b.is_proxy():
+            return -1
+        if isinstance(a, values.W_String) and isinstance(b, values.W_String):
+            return 1 if a.equal(b) else 0
+        if isinstance(a, values.W_Bytes) and isinstance(b, values.W_Bytes):
+            return 1 if a.equal(b) else 0
+        if isinstance(a, values.W_Cons) and isinstance(b, values.W_Cons):
+            cmp = equal_nocont(a.car(), b.car())
+            if cmp != 1:
+                return cmp
+            a, b = a.cdr(), b.cdr()
+            continue
+        if isinstance(a, values.W_Box) and isinstance(b, values.W_Box):
+            a, b = _box_value(a), _box_value(b)
+            continue
+        if (isinstance(a, values_vector.W_Vector) and
+                isinstance(b, values_vector.W_Vector)):
+            if a.length() != b.length():
+                return 0
+            return _equal_nocont_lists(
+                [a.ref(i) for i in range(a.length())],
+                [b.ref(i) for i in range(b.length())])
+        if (isinstance(a, values_struct.W_Struct) and
+                isinstance(b, values_struct.W_Struct)):
+            a_type = a.struct_type()
+            b_type = b.struct_type()
+            for w_car, _ in a_type.props:
+                if w_car.isinstance(values_struct.w_prop_equal_hash):
+                    return -1
+            for w_car, _ in b_type.props:
+                if w_car.isinstance(values_struct.w_prop_equal_hash):
+                    return -1
+            if a_type is not b_type or a_type.isopaque:
+                return 0
+            return _equal_nocont_lists(a.vals(), b.vals())
+        return 0
+
+def _box_value(w_box):
+    if isinstance(w_box, values.W_MBox):
+        return w_box.value
+    assert isinstance(w_box, values.W_IBox)
+    return w_box.value
+
+def _equal_nocont_lists(a_vals, b_vals):
+    if len(a_vals) != len(b_vals):
+        return 0
+    for i in range(len(a_vals)):
+        w_a, w_b = a_vals[i], b_vals[i]
+        if isinstance(w_a, values.W_Cell):
+            w_a = w_a.get_val()
+        if isinstance(w_b, values.W_Cell):
+            w_b = w_b.get_val()
+        cmp = equal_nocont(w_a, w_b)
+        if cmp != 1:
+            return cmp
+    return 1
+
 def eqp_logic(a, b):
     if a is b:
         return True
@@ -197,3 +262,81 @@ def eqvp(a, b):
         assert a.hash_eqv() == b.hash_eqv()
     return values.W_Bool.make(res)
 
+
+# Structural hashing compatible with `equal?`: two values that are `equal?`
+# always produce the same hash code. Like Racket, only a bounded part of the
+# value is traversed, which makes the function total for cyclic data and
+# keeps it cheap for large keys.
+EQUAL_HASH_BUDGET = 64
+
+class HashBudget(object):
+    def __init__(self, remaining):
+        self.remaining = remaining
+
+def combine_hash(x, y):
+    return rarithmetic.intmask((1000003 * x) ^ y)
+
+def equal_hash_code(w_obj):
+    """ the hash code hash tables use. Raises UndecidedEqual if w_obj
+    contains an impersonator: what is equal? to it depends on the values its
+    interposition procedures produce, which cannot be run here. """
+    return _equal_hash(w_obj, HashBudget(EQUAL_HASH_BUDGET), True)
+
+def equal_hash_code_of_base(w_obj):
+    """ like equal_hash_code, but hashes the objects impersonators wrap """
+    return _equal_hash(w_obj, HashBudget(EQUAL_HASH_BUDGET), False)
+
+def _has_impersonator(w_obj):
+    # the values chaperones produce are equal? to the ones they wrap, so
+    # those can be hashed through
+    while w_obj.is_proxy():
+        if not w_obj.is_chaperone():
+            return True
+        w_obj = w_obj.get_proxied()
+    return False
+
+def _equal_hash(w_obj, budget, strict):
+    budget.remaining -= 1
+    if budget.remaining < 0:
+        return 0
+    if w_obj.is_proxy():
+        if strict and _has_impersonator(w_obj):
+            raise UndecidedEqual
+        w_obj = imp.get_base_object(w_obj)
+    if isinstance(w_obj, values.W_Cons):
+        x = 0x345678
+        while isinstance(w_obj, values.W_Cons) and budget.remaining > 0:
+            x = combine_hash(x, _equal_hash(w_obj.car(), budget, strict))
+            w_obj = w_obj.cdr()
+        return combine_hash(x, _equal_hash(w_obj, budget, strict))
+    if isinstance(w_obj, values.W_String):
+        return objectmodel.compute_hash(w_obj.value)
+    if isinstance(w_obj, values.W_Bytes) or isinstance(w_obj, values.W_Number):
+        return w_obj.hash_equal()
+    if isinstance(w_obj, values_vector.W_Vector):
+        x = combine_hash(0x27d4eb2f, w_obj.length())
+        for i in range(w_obj.length()):
+            if budget.remaining <= 0:
+                break
+            x = combine_hash(x, _equal_hash(w_obj.ref(i), budget, strict))
+        return x
+    if isinstance(w_obj, values.W_MBox) or isinstance(w_obj, values.W_IBox):
+        return combine_hash(0x1b873593, _equal_hash(w_obj.value, budget, strict))
+    if isinstance(w_obj, values_struct.W_Struct):
+        w_type = w_obj.struct_type()
+        for w_car, _ in w_type.props:
+            if w_car.isinstance(values_struct.w_prop_equal_hash):
+                # the user-supplied equality can relate arbitrary instances,
+                # so all of them share one hash code
+                return objectmodel.compute_hash(w_type.name)
+        if w_type.isopaque:
+            return objectmodel.compute_hash(w_obj)
+        x = objectmodel.compute_hash(w_type.name)
+        for w_val in w_obj.vals():
+            if budget.remaining <= 0:
+                break
+            if isinstance(w_val, values.W_Cell):
+                w_val = w_val.get_val()
+            x = combine_hash(x, _equal_hash(w_val, budget, strict))
+        return x
+    return w_obj.hash_eqv()
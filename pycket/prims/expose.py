@@ -129,7 +129,7 @@ def make_procedure(n="<procedure>", argstypes=None, simple=True, arity=None):
             func_arg_unwrap = func
             _arity = arity or ([], 0)
         func_result_handling = _make_result_handling_func(func_arg_unwrap, simple)
-        return values.W_Prim(name, func_result_handling, _arity)
+        return values.W_Prim(name, func_result_handling, _arity, simple)
     return wrapper
 
 def expose(n, argstypes=None, simple=True, arity=None, nyi=False):
@@ -151,7 +151,7 @@ def expose(n, argstypes=None, simple=True, arity=None, nyi=False):
             _arity = arity or ([], 0)
         func_result_handling = _make_result_handling_func(func_arg_unwrap, simple)
         cls = values.W_Prim
-        p = cls(name, func_result_handling, _arity)
+        p = cls(name, func_result_handling, _arity, simple)
         for nam in names:
             sym = values.W_Symbol.make(nam)
             if sym in prim_env:
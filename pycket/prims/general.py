@@ -18,6 +18,7 @@ from rpython.rlib.rsre import rsre_re as re
 
 # import for side effects
 from pycket.prims import continuation_marks
+from pycket.prims import control
 from pycket.prims import equal as eq_prims
 from pycket.prims import hash
 from pycket.prims import impersonator
@@ -563,15 +564,6 @@ def time_apply_cont(initial, env, cont, vals):
                                   ms, ms, values.W_Fixnum(0)])
     return return_multi_vals(results, env, cont)
 
-@expose("continuation-prompt-available?")
-def cont_prompt_avail(args):
-    return values.w_false
-
-# FIXME: this is a data type
-@expose("continuation-prompt-tag?")
-def cont_prompt_tag(args):
-    return values.w_false
-
 # FIXME: implementation
 define_nyi("dynamic-wind")
 # def dynamic_wind(args):
@@ -1143,12 +1135,6 @@ def current_preserved_thread_cell_values(v):
 def do_is_place_enabled(args):
     return values.w_false
 
-@expose("make-continuation-prompt-tag", [default(values.W_Symbol, None)])
-def mcpt(s):
-    from pycket.interpreter import Gensym
-    s = Gensym.gensym("cm") if s is None else s
-    return values.W_ContinuationPromptTag(s)
-
 @expose("extend-parameterization",
         [values.W_Object, values.W_Object, values.W_Object])
 def extend_paramz(paramz, key, val):
@@ -1233,10 +1219,10 @@ def cur_env_vars():
 def env_var_ref(set, name):
     return values.w_false
 
-@expose("raise", [values.W_Object, default(values.W_Object, values.w_true)])
-def do_raise(v, barrier):
-    # TODO:
-    raise SchemeException("uncaught exception: %s" % v.tostring())
+@expose("raise", [values.W_Object, default(values.W_Object, values.w_true)],
+        simple=False)
+def do_raise(v, barrier, env, cont):
+    return control.raise_exn(v, env, cont)
 
 @expose("raise-argument-error",
         [values.W_Symbol, values.W_String, values.W_Object])
@@ -1344,6 +1330,21 @@ def system_path_convetion_type():
     else:
         return w_unix_sym
 
+@expose("pycket:jit-stats", [])
+@jit.dont_look_inside
+def pycket_jit_stats():
+    from pycket.jit_stats import jit_stats
+    return values.W_String(jit_stats.report())
+
+@expose("pycket:call-site-stats", [])
+@jit.dont_look_inside
+def pycket_call_site_stats():
+    from pycket.interpreter import call_site_stats
+    return values.Values.make([values.W_Fixnum(call_site_stats.hits),
+                               values.W_Fixnum(call_site_stats.misses),
+                               values.W_Fixnum(call_site_stats.polymorphic),
+                               values.W_Fixnum(call_site_stats.megamorphic)])
+
 @expose("collect-garbage", [])
 @jit.dont_look_inside
 def do_collect_garbage():
@@ -3,7 +3,9 @@
 from pycket              import impersonators as imp
 from pycket              import values
 from pycket.values_hash  import (
-    W_HashTable, W_EqvHashTable, W_EqualHashTable, W_EqHashTable)
+    W_HashTable, W_EqvHashTable, W_EqualHashTable, W_EqHashTable,
+    W_ImmutableHashTable, empty_immutable_eq_hash, empty_immutable_eqv_hash,
+    empty_immutable_equal_hash, build_immutable_hash, build_equal_hash)
 from pycket.cont         import continuation
 from pycket.error        import SchemeException
 from pycket.prims.expose import default, expose, procedure, define_nyi
@@ -17,16 +19,16 @@ def hash_for_each(h, f, env, cont):
 @continuation
 def hash_for_each_cont(f, ht, index, env, cont, _vals):
     from pycket.interpreter import return_value
-    nextindex = index + 1
-    try:
-        w_key, w_value = ht.get_item(index)
-    except KeyError:
-        return return_value(values.w_void, env,
-                hash_for_each_cont(f, ht, nextindex, env, cont))
-    except IndexError:
+    index = ht.hash_iterate_next(index)
+    if index < 0:
         return return_value(values.w_void, env, cont)
-    after = hash_for_each_cont(f, ht, nextindex, env, cont)
-    return f.call([w_key, w_value], env, after)
+    after = hash_for_each_cont(f, ht, index + 1, env, cont)
+    return ht.hash_iterate_pair(index, env, hash_call_cont(f, env, after))
+
+@continuation
+def hash_call_cont(f, env, cont, _vals):
+    # calls f with the key and the value from hash_iterate_pair
+    return f.call(_vals._get_full_list(), env, cont)
 
 
 @expose("hash-map", [W_HashTable, procedure], simple=False)
@@ -45,16 +47,11 @@ def hash_map_cont(f, ht, index, w_acc, env, cont, vals):
     w_val, = vals
     if w_val is not None:
         w_acc = values.W_Cons.make(w_val, w_acc)
-    nextindex = index + 1
-    try:
-        w_key, w_value = ht.get_item(index)
-    except KeyError:
-        return return_value(None, env,
-                hash_map_cont(f, ht, nextindex, w_acc, env, cont))
-    except IndexError:
+    index = ht.hash_iterate_next(index)
+    if index < 0:
         return return_value(w_acc, env, cont)
-    after = hash_map_cont(f, ht, nextindex, w_acc, env, cont)
-    return f.call([w_key, w_value], env, after)
+    after = hash_map_cont(f, ht, index + 1, w_acc, env, cont)
+    return ht.hash_iterate_pair(index, env, hash_call_cont(f, env, after))
 
 
 @expose("make-weak-hasheq", [])
@@ -62,26 +59,42 @@ def make_weak_hasheq():
     # FIXME: not actually weak
     return W_EqvHashTable([], [])
 
-@expose("make-immutable-hash", [default(values.W_Object, values.w_null)])
-def make_immutable_hash(assocs):
-    # FIXME: Not annotated as immutable
+def _assocs_to_lists(name, assocs):
     lsts = values.from_list(assocs)
     keys = []
     vals = []
     for lst in lsts:
         if not isinstance(lst, values.W_Cons):
-            raise SchemeException("make-hash: expected list of pairs")
+            raise SchemeException("%s: expected list of pairs" % name)
         keys.append(lst.car())
         vals.append(lst.cdr())
-    return W_EqualHashTable(keys, vals)
-
-@expose("hash")
-def hash(args):
+    return keys, vals
+
+@expose("make-immutable-hash", [default(values.W_Object, values.w_null)],
+        simple=False)
+def make_immutable_hash(assocs, env, cont):
+    keys, vals = _assocs_to_lists("make-immutable-hash", assocs)
+    return build_immutable_hash(empty_immutable_equal_hash, keys, vals,
+                                env, cont)
+
+@expose("make-immutable-hasheq", [default(values.W_Object, values.w_null)])
+def make_immutable_hasheq(assocs):
+    keys, vals = _assocs_to_lists("make-immutable-hasheq", assocs)
+    return empty_immutable_eq_hash.from_lists(keys, vals)
+
+@expose("make-immutable-hasheqv", [default(values.W_Object, values.w_null)])
+def make_immutable_hasheqv(assocs):
+    keys, vals = _assocs_to_lists("make-immutable-hasheqv", assocs)
+    return empty_immutable_eqv_hash.from_lists(keys, vals)
+
+@expose("hash", simple=False)
+def hash(args, env, cont):
     if len(args) % 2 != 0:
         raise SchemeException("hash: key does not have a corresponding value")
     keys = [args[i] for i in range(0, len(args), 2)]
     vals = [args[i] for i in range(1, len(args), 2)]
-    return W_EqualHashTable(keys, vals)
+    return build_immutable_hash(empty_immutable_equal_hash, keys, vals,
+                                env, cont)
 
 @expose("hasheq")
 def hasheq(args):
@@ -89,7 +102,7 @@ def hasheq(args):
         raise SchemeException("hasheq: key does not have a corresponding value")
     keys = [args[i] for i in range(0, len(args), 2)]
     vals = [args[i] for i in range(1, len(args), 2)]
-    return W_EqHashTable(keys, vals)
+    return empty_immutable_eq_hash.from_lists(keys, vals)
 
 @expose("hasheqv")
 def hasheqv(args):
@@ -97,10 +110,10 @@ def hasheqv(args):
         raise SchemeException("hasheqv: key does not have a corresponding value")
     keys = [args[i] for i in range(0, len(args), 2)]
     vals = [args[i] for i in range(1, len(args), 2)]
-    return W_EqvHashTable(keys, vals)
+    return empty_immutable_eqv_hash.from_lists(keys, vals)
 
-@expose("make-hash", [default(values.W_List, values.w_null)])
-def make_hash(pairs):
+@expose("make-hash", [default(values.W_List, values.w_null)], simple=False)
+def make_hash(pairs, env, cont):
     lsts = values.from_list(pairs)
     keys = []
     vals = []
@@ -109,7 +122,7 @@ def make_hash(pairs):
             raise SchemeException("make-hash: expected list of pairs")
         keys.append(lst.car())
         vals.append(lst.cdr())
-    return W_EqualHashTable(keys, vals)
+    return build_equal_hash(keys, vals, env, cont)
 
 @expose("make-hasheq", [default(values.W_List, values.w_null)])
 def make_hasheq(pairs):
@@ -139,11 +152,11 @@ def make_hasheqv(pairs):
 def hash_set_bang(ht, k, v, env, cont):
     return ht.hash_set(k, v, env, cont)
 
-define_nyi("hash-set", [W_HashTable, values.W_Object, values.W_Object], simple=False)
-# def hash_set(ht, k, v, env, cont):
-#     raise NotImplementedError()
-#     return ht.hash_set(k, v, env, cont)
-#     #return ht
+@expose("hash-set", [W_HashTable, values.W_Object, values.W_Object], simple=False)
+def hash_set(ht, k, v, env, cont):
+    if not isinstance(ht, W_ImmutableHashTable):
+        raise SchemeException("hash-set: contract violation, expected an immutable hash table")
+    return ht.hash_iset(k, v, env, cont)
 
 @continuation
 def hash_ref_cont(default, env, cont, _vals):
@@ -166,10 +179,11 @@ define_nyi("hash-remove!", [W_HashTable, values.W_Object])
 #     raise NotImplementedError()
 #     return hash
 
-define_nyi("hash-remove", [W_HashTable, values.W_Object])
-# def hash_remove(hash, key):
-#     raise NotImplementedError()
-#     return hash
+@expose("hash-remove", [W_HashTable, values.W_Object], simple=False)
+def hash_remove(ht, k, env, cont):
+    if not isinstance(ht, W_ImmutableHashTable):
+        raise SchemeException("hash-remove: contract violation, expected an immutable hash table")
+    return ht.hash_iremove(k, env, cont)
 
 define_nyi("hash-clear!", [W_HashTable])
 # def hash_clear_bang(hash):
@@ -185,33 +199,34 @@ define_nyi("hash-clear", [W_HashTable])
 def hash_count(hash):
     return values.W_Fixnum(hash.length())
 
-define_nyi("hash-iterate-first", [W_HashTable])
-# def hash_iterate_first(hash):
-#     raise NotImplementedError()
-#     # if not hash.data:
-#     #     return values.w_false
-#     # else:
-#     #     return hash.ref(0)
-#     return values.w_false
-
-define_nyi("hash-iterate-next", [W_HashTable, values.W_Fixnum])
-# def hash_iterate_next(hash, pos):
-#     raise NotImplementedError()
-#     # next_pos = pos.value + 1
-#     # return hash.ref(next_pos) if hash.ref(next_pos) is not None else values.w_false
-#     return values.w_false
+@expose("hash-iterate-first", [W_HashTable])
+def hash_iterate_first(ht):
+    pos = ht.hash_iterate_next(0)
+    if pos < 0:
+        return values.w_false
+    return values.W_Fixnum(pos)
+
+@expose("hash-iterate-next", [W_HashTable, values.W_Fixnum])
+def hash_iterate_next(ht, pos):
+    if pos.value < 0:
+        raise SchemeException("hash-iterate-next: expected a valid index")
+    next = ht.hash_iterate_next(pos.value + 1)
+    if next < 0:
+        return values.w_false
+    return values.W_Fixnum(next)
+
+@expose("hash-iterate-key", [W_HashTable, values.W_Fixnum], simple=False)
+def hash_iterate_key(ht, pos, env, cont):
+    return ht.hash_iterate_key(pos.value, env, cont)
+
+@expose("hash-iterate-value", [W_HashTable, values.W_Fixnum], simple=False)
+def hash_iterate_value(ht, pos, env, cont):
+    return ht.hash_iterate_pair(pos.value, env, hash_value_cont(env, cont))
 
-define_nyi("hash-iterate-key", [W_HashTable, values.W_Fixnum])
-# def hash_iterate_key(hash, pos):
-#     raise NotImplementedError()
-#     # return hash.ref(pos.value)
-#     return values.w_false
-
-define_nyi("hash-iterate-value", [W_HashTable, values.W_Fixnum])
-# def hash_iterate_value(hash, pos):
-#     raise NotImplementedError()
-#     # return hash.ref(pos.value)
-#     return values.w_false
+@continuation
+def hash_value_cont(env, cont, _vals):
+    from pycket.interpreter import return_value
+    return return_value(_vals._get_list(1), env, cont)
 
 define_nyi("hash-copy", [W_HashTable])
 # def hash_iterate_value(hash):
@@ -219,12 +234,13 @@ define_nyi("hash-copy", [W_HashTable])
 #     # FIXME: implementation
 #     return hash
 
-define_nyi("equal-hash-code", [values.W_Object])
-# def equal_hash_code(v):
-#     raise NotImplementedError()
-#     return values.W_Fixnum(0)
+@expose("equal-hash-code", [values.W_Object])
+def equal_hash_code(v):
+    # FIXME: the interposition procedures of impersonators are not run
+    from pycket.prims.equal import equal_hash_code_of_base
+    return values.W_Fixnum(equal_hash_code_of_base(v))
 
-define_nyi("equal-secondary-hash-code", [values.W_Object])
-# def equal_hash_code(v):
-#     raise NotImplementedError()
-#     return values.W_Fixnum(0)
+@expose("equal-secondary-hash-code", [values.W_Object])
+def equal_secondary_hash_code(v):
+    from pycket.prims.equal import equal_hash_code_of_base, combine_hash
+    return values.W_Fixnum(combine_hash(equal_hash_code_of_base(v), 0x5bd1e995))
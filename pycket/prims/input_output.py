@@ -177,6 +177,16 @@ def open_output_file(str, mode, exists):
 def port_closedp(p):
     return values.W_Bool.make(p.closed)
 
+@expose("close-input-port", [values.W_InputPort])
+def close_input_port(port):
+    port.close()
+    return values.w_void
+
+@expose("close-output-port", [values.W_OutputPort])
+def close_output_port(port):
+    port.close()
+    return values.w_void
+
 @expose("eof-object?", [values.W_Object])
 def eofp(e):
     return values.W_Bool.make(e is values.eof_object)
@@ -184,7 +194,7 @@ def eofp(e):
 @continuation
 def close_cont(port, env, cont, vals):
     from pycket.interpreter import return_multi_vals
-    port.file.close()
+    port.close()
     return return_multi_vals(vals, env, cont)
 
 def open_infile(str, mode):
@@ -360,6 +370,30 @@ def do_fprintf(args, env, cont):
 #     port = current_out_param.get(cont)
 #     return do_fprintf([port] + args, env, cont)
 
+none_sym  = values.W_Symbol.make("none")
+line_sym  = values.W_Symbol.make("line")
+block_sym = values.W_Symbol.make("block")
+
+@expose("file-stream-buffer-mode", [values.W_Port, default(values.W_Symbol, None)])
+def file_stream_buffer_mode(port, mode):
+    if isinstance(port, values.W_FileInputPort):
+        return block_sym if mode is None else values.w_void
+    if not isinstance(port, values.W_FileOutputPort):
+        if mode is None:
+            return values.w_false
+        raise SchemeException("file-stream-buffer-mode: cannot set buffer mode of %s" % port.tostring())
+    if mode is None:
+        return values.W_Symbol.make(port.buffer_mode)
+    if mode is none_sym:
+        port.set_buffer_mode(values.W_FileOutputPort.BUFFER_NONE)
+    elif mode is line_sym:
+        port.set_buffer_mode(values.W_FileOutputPort.BUFFER_LINE)
+    elif mode is block_sym:
+        port.set_buffer_mode(values.W_FileOutputPort.BUFFER_BLOCK)
+    else:
+        raise SchemeException("file-stream-buffer-mode: expected 'none, 'line or 'block, got %s" % mode.tostring())
+    return values.w_void
+
 def return_void(env, cont):
     from pycket.interpreter import return_value
     return return_value(values.w_void, env, cont)
@@ -536,7 +570,8 @@ expose_val("eof", values.eof_object)
 current_print_param = values.W_Parameter(standard_printer)
 expose_val("current-print", current_print_param)
 
-stdout_port = values.W_FileOutputPort(sio.fdopen_as_stream(1, "wb"))
+stdout_port = values.W_FileOutputPort(sio.fdopen_as_stream(1, "wb"),
+                                      values.W_FileOutputPort.BUFFER_LINE)
 stdin_port = values.W_FileInputPort(sio.fdopen_as_stream(0, "rb"))
 current_out_param = values.W_Parameter(stdout_port)
 current_error_param = values.W_Parameter(stdout_port)
@@ -0,0 +1,129 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# A sampling profiler for Racket code (--profile). Every `interval` steps of
+# the interpreter loop, the profiler attributes the time elapsed since the
+# previous sample to the lambda that contains the current AST and to the
+# lambdas of the non-tail calls found along the continuation. Lambdas are
+# identified by their source location.
+#
+# At exit, a per-function report (self and total time, sorted by total time)
+# is written to stderr and the samples are written to the profile file in the
+# collapsed-stack format used by flame graph tools: one line per call path,
+# outermost function first, separated by ';', followed by the time in
+# microseconds.
+#
+import os
+import time
+
+from rpython.rlib import jit, streamio
+from rpython.rlib.listsort import make_timsort_class
+
+TOPLEVEL = "<module>"
+
+class ProfileEntry(object):
+    def __init__(self, label, time):
+        self.label = label
+        self.time = time
+
+BaseSort = make_timsort_class()
+
+class ProfileEntrySort(BaseSort):
+    def lt(self, a, b):
+        # larger times first
+        return a.time > b.time
+
+def sorted_entries(times):
+    entries = [ProfileEntry(label, t) for (label, t) in times.iteritems()]
+    ProfileEntrySort(entries).sort()
+    return entries
+
+class Profiler(object):
+    _immutable_fields_ = ["active?"]
+
+    def __init__(self):
+        self.active = False
+        self.output = None
+        self.interval = 10000
+        self.max_depth = 256
+        self.countdown = 0
+        self.last_sample = 0.0
+        self.samples = 0
+        self.self_time = {}
+        self.total_time = {}
+        self.paths = {}
+
+    def start(self):
+        if self.output is None:
+            return
+        self.active = True
+        self.countdown = self.interval
+        self.samples = 0
+        self.self_time = {}
+        self.total_time = {}
+        self.paths = {}
+        self.last_sample = time.time()
+
+    def step(self, ast, cont):
+        self.countdown -= 1
+        if self.countdown <= 0:
+            self.countdown = self.interval
+            self.sample(ast, cont)
+
+    @jit.dont_look_inside
+    def sample(self, ast, cont):
+        from pycket.cont import Cont
+        now = time.time()
+        weight = int((now - self.last_sample) * 1000000)
+        self.last_sample = now
+        self.samples += 1
+        # innermost first
+        frames = []
+        lam = ast.surrounding_lambda
+        if lam is not None:
+            frames.append(lam.srcloc_label())
+        depth = 0
+        while isinstance(cont, Cont) and depth < self.max_depth:
+            cont_ast = cont.get_ast()
+            if cont_ast is not None and cont_ast.surrounding_lambda is not None:
+                label = cont_ast.surrounding_lambda.srcloc_label()
+                if not frames or frames[-1] != label:
+                    frames.append(label)
+            cont = cont.prev
+            depth += 1
+        frames.append(TOPLEVEL)
+        self.self_time[frames[0]] = self.self_time.get(frames[0], 0) + weight
+        seen = {}
+        for label in frames:
+            if label not in seen:
+                seen[label] = None
+                self.total_time[label] = self.total_time.get(label, 0) + weight
+        frames.reverse()
+        path = ";".join(frames)
+        self.paths[path] = self.paths.get(path, 0) + weight
+
+    def report(self):
+        if not self.active:
+            return
+        self.active = False
+        self._write_paths()
+        self._write_summary()
+
+    def _write_paths(self):
+        f = streamio.open_file_as_stream(self.output, "w")
+        try:
+            for path, t in self.paths.iteritems():
+                f.write("%s %d\n" % (path, t))
+        finally:
+            f.close()
+
+    def _write_summary(self):
+        lines = ["profile: %d samples, call paths written to %s\n" % (
+                     self.samples, self.output),
+                 "self (us)\ttotal (us)\tfunction\n"]
+        for entry in sorted_entries(self.total_time):
+            lines.append("%d\t%d\t%s\n" % (
+                self.self_time.get(entry.label, 0), entry.time, entry.label))
+        os.write(2, "".join(lines))
+
+profiler = Profiler()
@@ -275,3 +275,110 @@ def loads(s):
     finally:
         decoder.close()
 
+
+
+# Reads a JSON document from a stream in chunks and hands out the text of
+# one value at a time, so that a large document (like the body of an expanded
+# module) can be decoded piece by piece: only the current chunk and the
+# current value need to be kept in memory.
+class ChunkedJsonReader(object):
+    chunk_size = 64 * 1024
+
+    def __init__(self, stream=None, data=""):
+        self.stream = stream
+        self.buf = data
+        self.pos = 0
+
+    def _fill(self):
+        # returns False at the end of the input. drops the consumed part of
+        # the buffer, which moves everything after self.pos to the front
+        if self.stream is None:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.stream.close()
+            self.stream = None
+            return False
+        pos = self.pos
+        assert pos >= 0
+        self.buf = self.buf[pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _char_at(self, i):
+        # the character at self.pos + i, or "" at the end of the input
+        while self.pos + i >= len(self.buf):
+            if not self._fill():
+                return ""
+        return self.buf[self.pos + i]
+
+    def peek(self):
+        """ skips whitespace and returns the next character, or "" at the end
+        of the input """
+        while True:
+            c = self._char_at(0)
+            if c not in " \t\r\n" or c == "":
+                return c
+            self.pos += 1
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError("Expected '%s' at char %d" % (c, self.pos))
+        self.pos += 1
+
+    def skip(self, c):
+        """ consumes the next character if it is c """
+        if self.peek() == c:
+            self.pos += 1
+            return True
+        return False
+
+    def read_value_text(self):
+        """ returns the text of the next complete JSON value """
+        c = self.peek()
+        if c == "":
+            raise ValueError("Unexpected end of JSON input")
+        i = 0
+        depth = 0
+        in_string = False
+        while True:
+            c = self._char_at(i)
+            if c == "":
+                if depth or in_string:
+                    raise ValueError("Unexpected end of JSON input")
+                break
+            if in_string:
+                if c == "\\":
+                    i += 1
+                elif c == '"':
+                    in_string = False
+                    if depth == 0:
+                        i += 1
+                        break
+            elif c == '"':
+                in_string = True
+            elif c == "{" or c == "[":
+                depth += 1
+            elif c == "}" or c == "]":
+                if depth == 0:
+                    break
+                depth -= 1
+                if depth == 0:
+                    i += 1
+                    break
+            elif depth == 0 and c in " \t\r\n,:":
+                break
+            i += 1
+        start = self.pos
+        stop = start + i
+        assert start >= 0 and stop >= 0
+        self.pos = stop
+        return self.buf[start:stop]
+
+    def read_value(self):
+        return loads(self.read_value_text())
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
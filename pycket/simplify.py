@@ -0,0 +1,486 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Constant folding and simplification of the AST, run on every module (and
+# on lazily converted lambda bodies) before assignment conversion, so its
+# result is stored in the AST cache together with the rest of the module.
+#
+#   - applications of the primitives in FOLDABLE to constants are replaced by
+#     their result, unless the primitive raises an error, which is left for
+#     the program to raise at run time
+#   - if with a constant test is replaced by the branch that is taken
+#   - let-bound constants, and let-bound variables that are never assigned,
+#     are substituted into the body of the let, unless the variable bound by
+#     the let is mutated
+#   - let bindings whose variable is unused and whose right-hand side has no
+#     effects are removed, and so are the forms of a begin (apart from the
+#     last one) that have no effects
+#   - calls of small module-level procedures, of the same module or of a
+#     required one, are inlined (see Inliner)
+#
+from pycket                   import values
+from pycket.cont              import nil_continuation
+from pycket.error             import SchemeException
+from pycket.prims.expose      import prim_env
+from pycket.env               import SymList
+from pycket.interpreter       import (App, Begin, Begin0, CaseLambda, CellRef,
+                                      DefineValues, Done, Gensym, If, Lambda,
+                                      Let, Letrec, LexicalVar, ModuleVar,
+                                      Module, Quote, QuoteSyntax, SetBang,
+                                      VariableReference, WithContinuationMark,
+                                      make_lambda, make_let, variable_set)
+
+# Primitives without side effects (and implemented as simple primitives)
+# that are applied at load time when all their arguments are constants.
+FOLDABLE = {}
+for _name in ["+", "-", "*", "/", "quotient", "remainder", "modulo", "add1",
+              "sub1", "abs", "max", "min", "=", "<", ">", "<=", ">=",
+              "zero?", "positive?", "negative?", "even?", "odd?",
+              "exact->inexact", "inexact->exact", "bitwise-and",
+              "bitwise-ior", "bitwise-xor", "arithmetic-shift",
+              "fx+", "fx-", "fx*", "fx=", "fx<", "fx>", "fx<=", "fx>=",
+              "fl+", "fl-", "fl*", "fl/", "fl=", "fl<", "fl>", "fl<=", "fl>=",
+              "not", "eq?", "eqv?", "null?", "pair?", "number?", "integer?",
+              "real?", "rational?", "exact?", "inexact?", "fixnum?",
+              "flonum?", "exact-nonnegative-integer?", "symbol?", "string?",
+              "char?", "boolean?", "void?", "procedure?", "vector?",
+              "char->integer"]:
+    FOLDABLE[_name] = None
+
+def is_pure(ast):
+    """ the evaluation of ast has no effects and cannot fail """
+    if (isinstance(ast, Quote) or isinstance(ast, QuoteSyntax) or
+            isinstance(ast, LexicalVar) or isinstance(ast, CaseLambda) or
+            isinstance(ast, VariableReference)):
+        return True
+    if isinstance(ast, ModuleVar):
+        return ast.is_primitive()
+    return False
+
+def fold_app(rator, rands):
+    """ the constant result of applying rator to rands, or None """
+    if not isinstance(rator, ModuleVar) or not rator.is_primitive():
+        return None
+    if rator.srcsym.value not in FOLDABLE:
+        return None
+    w_prim = prim_env.get(rator.srcsym, None)
+    if not isinstance(w_prim, values.W_Prim):
+        return None
+    args_w = [None] * len(rands)
+    for i, rand in enumerate(rands):
+        if not isinstance(rand, Quote):
+            return None
+        args_w[i] = rand.w_val
+    try:
+        w_prim.call(args_w, None, nil_continuation)
+    except Done, e:
+        if e.values._get_size_list() == 1:
+            return Quote(e.values._get_list(0))
+    except SchemeException:
+        pass
+    return None
+
+class Inliner(object):
+    """ Inlining of calls of small module-level procedures. A procedure can
+    be inlined if it is a lambda with a fixed number of arguments and a body
+    of at most max_size AST nodes that is defined (before the call, in the
+    same module) by a define-values of one variable, which is never mutated
+    and which the body does not refer to. The procedures of a module that can
+    be inlined are kept in Module.inlinable, so that calls in other modules
+    can be inlined as well, unless the body refers to variables of its own
+    module. Every module may grow by at most module_budget AST nodes, and
+    calls inside inlined bodies are inlined up to max_depth levels deep. """
+    def __init__(self):
+        self.enabled = True
+        self.max_size = 16
+        self.module_budget = 2000
+        self.max_depth = 2
+        self.budget = 0
+        self.depth = 0
+        # the inlinable procedures of the module being simplified
+        self.candidates = None
+
+inliner = Inliner()
+
+class SimplifierState(object):
+    def __init__(self):
+        # the lexical variables assigned by set! in the module being
+        # simplified, None when they are not known
+        self.assigned = None
+
+simplifier_state = SimplifierState()
+
+def is_assigned(sym):
+    assigned = simplifier_state.assigned
+    return assigned is None or sym in assigned
+
+def simplify_module(module):
+    mutated = module.mod_mutated_vars()
+    assigned = {}
+    for b in module.body:
+        collect_assigned(b, assigned)
+    old_candidates = inliner.candidates
+    old_assigned = simplifier_state.assigned
+    candidates = {}
+    inliner.candidates = candidates
+    inliner.budget = inliner.module_budget
+    simplifier_state.assigned = assigned
+    try:
+        body = []
+        for b in module.body:
+            new_b = simplify(b)
+            if isinstance(new_b, DefineValues):
+                add_candidate(candidates, new_b, mutated)
+            body.append(new_b)
+    finally:
+        inliner.candidates = old_candidates
+        simplifier_state.assigned = old_assigned
+    return Module(module.name, body, module.config, candidates)
+
+def simplify_body(body):
+    result = []
+    last = len(body) - 1
+    for i, b in enumerate(body):
+        new_b = simplify(b)
+        if i == last or not is_pure(new_b):
+            result.append(new_b)
+    return result
+
+def simplify(ast):
+    if isinstance(ast, App):
+        rator = simplify(ast.rator)
+        rands = [simplify(rand) for rand in ast.rands]
+        folded = fold_app(rator, rands)
+        if folded is not None:
+            return folded
+        inlined = inline_call(rator, rands)
+        if inlined is not None:
+            return inlined
+        return App(rator, rands)
+    elif isinstance(ast, If):
+        tst = simplify(ast.tst)
+        if isinstance(tst, Quote):
+            if tst.w_val is values.w_false:
+                return simplify(ast.els)
+            return simplify(ast.thn)
+        return If(tst, simplify(ast.thn), simplify(ast.els))
+    elif isinstance(ast, Begin):
+        return Begin.make(simplify_body(ast.body))
+    elif isinstance(ast, Begin0):
+        return Begin0(simplify(ast.first), simplify(ast.body))
+    elif isinstance(ast, WithContinuationMark):
+        return WithContinuationMark(simplify(ast.key), simplify(ast.value),
+                                    simplify(ast.body))
+    elif isinstance(ast, SetBang):
+        return SetBang(ast.var, simplify(ast.rhs))
+    elif isinstance(ast, DefineValues):
+        return DefineValues(ast.names, simplify(ast.rhs), ast.display_names)
+    elif isinstance(ast, CaseLambda):
+        lams = []
+        for lam in ast.lams:
+            new_lam = simplify(lam)
+            assert isinstance(new_lam, Lambda)
+            lams.append(new_lam)
+        return CaseLambda(lams, recursive_sym=ast.recursive_sym)
+    elif isinstance(ast, Lambda):
+        return make_lambda(ast.formals, ast.rest, simplify_body(ast.body),
+                           ast.srcpos, ast.srcfile)
+    elif isinstance(ast, Letrec):
+        return Letrec(ast.args, ast.counts, [simplify(r) for r in ast.rhss],
+                      simplify_body(ast.body))
+    elif isinstance(ast, Let):
+        return simplify_let(ast)
+    return ast
+
+def simplify_let(ast):
+    rhss = [simplify(rhs) for rhs in ast.rhss]
+    body = ast.body
+    mutated = variable_set()
+    for b in body:
+        mutated.update(b.mutated_vars())
+    j = 0
+    for i, count in enumerate(ast.counts):
+        rhs = rhss[i]
+        if count == 1 and (isinstance(rhs, Quote) or
+                           (isinstance(rhs, LexicalVar) and
+                            not is_assigned(rhs.sym))):
+            sym = ast.args.elems[j]
+            if LexicalVar(sym) not in mutated:
+                body = [substitute(b, sym, rhs) for b in body]
+        j += count
+    body = simplify_body(body)
+    frees = {}
+    for b in body:
+        frees.update(b.free_vars())
+    varss = []
+    new_rhss = []
+    j = 0
+    for i, count in enumerate(ast.counts):
+        vars = ast.args.elems[j:j + count]
+        j += count
+        if count == 1 and vars[0] not in frees and is_pure(rhss[i]):
+            continue
+        varss.append(vars)
+        new_rhss.append(rhss[i])
+    return make_let(varss, new_rhss, body)
+
+def _captures(elems, sym, new):
+    # a binding of sym or of the variable new refers to hides the variable
+    # that is substituted or the one it is replaced by
+    for v in elems:
+        if v is sym or (isinstance(new, LexicalVar) and v is new.sym):
+            return True
+    return False
+
+def substitute(ast, sym, new):
+    """ a copy of ast in which the references to the variable sym are
+    replaced by new, a constant or a variable that is never assigned """
+    if isinstance(ast, LexicalVar):
+        if ast.sym is sym:
+            return new
+        return ast
+    elif isinstance(ast, App):
+        return App(substitute(ast.rator, sym, new),
+                   [substitute(rand, sym, new) for rand in ast.rands])
+    elif isinstance(ast, If):
+        return If(substitute(ast.tst, sym, new),
+                  substitute(ast.thn, sym, new),
+                  substitute(ast.els, sym, new))
+    elif isinstance(ast, Begin):
+        return Begin.make([substitute(b, sym, new) for b in ast.body])
+    elif isinstance(ast, Begin0):
+        return Begin0(substitute(ast.first, sym, new),
+                      substitute(ast.body, sym, new))
+    elif isinstance(ast, WithContinuationMark):
+        return WithContinuationMark(substitute(ast.key, sym, new),
+                                    substitute(ast.value, sym, new),
+                                    substitute(ast.body, sym, new))
+    elif isinstance(ast, SetBang):
+        return SetBang(ast.var, substitute(ast.rhs, sym, new))
+    elif isinstance(ast, CaseLambda):
+        if ast.recursive_sym is not None and _captures([ast.recursive_sym], sym, new):
+            return ast
+        lams = []
+        for lam in ast.lams:
+            new_lam = substitute(lam, sym, new)
+            assert isinstance(new_lam, Lambda)
+            lams.append(new_lam)
+        return CaseLambda(lams, recursive_sym=ast.recursive_sym)
+    elif isinstance(ast, Lambda):
+        if _captures(ast.args.elems, sym, new):
+            return ast
+        return make_lambda(ast.formals, ast.rest,
+                           [substitute(b, sym, new) for b in ast.body],
+                           ast.srcpos, ast.srcfile)
+    elif isinstance(ast, Let):
+        rhss = [substitute(rhs, sym, new) for rhs in ast.rhss]
+        if _captures(ast.args.elems, sym, new):
+            body = ast.body
+        else:
+            body = [substitute(b, sym, new) for b in ast.body]
+        return Let(ast.args, ast.counts, rhss, body)
+    elif isinstance(ast, Letrec):
+        if _captures(ast.args.elems, sym, new):
+            return ast
+        return Letrec(ast.args, ast.counts,
+                      [substitute(rhs, sym, new) for rhs in ast.rhss],
+                      [substitute(b, sym, new) for b in ast.body])
+    return ast
+
+def collect_assigned(ast, assigned):
+    from pycket.expand import LazyLambdaBody
+    if isinstance(ast, SetBang) and isinstance(ast.var, CellRef):
+        assigned[ast.var.sym] = None
+    elif isinstance(ast, LazyLambdaBody):
+        # not converted yet, but it knows what it assigns
+        for v in ast.mutated_vars():
+            if isinstance(v, LexicalVar):
+                assigned[v.sym] = None
+        return
+    for child in ast.direct_children():
+        collect_assigned(child, assigned)
+
+def ast_size(ast):
+    size = 1
+    for child in ast.direct_children():
+        size += ast_size(child)
+    return size
+
+def refers_to(ast, name):
+    """ whether ast refers to the variable name of its own module """
+    if isinstance(ast, ModuleVar):
+        return ast.srcmod is None and ast.srcsym is name
+    for child in ast.direct_children():
+        if refers_to(child, name):
+            return True
+    return False
+
+def add_candidate(candidates, define, mutated):
+    if len(define.names) != 1:
+        return
+    name = define.names[0]
+    rhs = define.rhs
+    if (not isinstance(rhs, CaseLambda) or len(rhs.lams) != 1 or
+            rhs.recursive_sym is not None):
+        return
+    lam = rhs.lams[0]
+    if lam.rest or lam.frees.elems:
+        return
+    if ModuleVar(name, None, name) in mutated:
+        return
+    if ast_size(lam) > inliner.max_size or refers_to(lam, name):
+        return
+    candidates[name] = rhs
+
+def find_candidate(rator):
+    if not isinstance(rator, ModuleVar) or rator.is_primitive():
+        return None
+    if rator.srcmod is None:
+        candidates = inliner.candidates
+    else:
+        from pycket.expand import ModTable
+        module = ModTable.get_module(rator.srcmod)
+        if module is None:
+            return None
+        candidates = module.inlinable
+    if candidates is None:
+        return None
+    return candidates.get(rator.srcsym, None)
+
+def inline_call(rator, rands):
+    """ the body of the procedure called by rator, bound to the arguments
+    rands, or None if the call is not inlined """
+    if not inliner.enabled or inliner.depth >= inliner.max_depth:
+        return None
+    caselam = find_candidate(rator)
+    if caselam is None:
+        return None
+    lam = caselam.lams[0]
+    if len(rands) != len(lam.formals):
+        return None
+    size = ast_size(lam)
+    if size > inliner.budget:
+        return None
+    renames = {}
+    params = []
+    for v in lam.formals:
+        fresh = Gensym.gensym(v.variable_name() + "_")
+        renames[v] = fresh
+        params.append([fresh])
+    # the variables of another module are not known here
+    body = copy_renamed_list(lam.body, renames, rator.srcmod is not None)
+    if body is None:
+        return None
+    inliner.budget -= size
+    inliner.depth += 1
+    try:
+        return simplify(make_let(params, rands, body))
+    finally:
+        inliner.depth -= 1
+
+def _fresh_symlist(args, renames):
+    elems = []
+    for v in args.elems:
+        fresh = Gensym.gensym(v.variable_name() + "_")
+        renames[v] = fresh
+        elems.append(fresh)
+    return SymList(elems)
+
+def copy_renamed_list(asts, renames, foreign):
+    result = []
+    for ast in asts:
+        new_ast = copy_renamed(ast, renames, foreign)
+        if new_ast is None:
+            return None
+        result.append(new_ast)
+    return result
+
+def copy_renamed(ast, renames, foreign):
+    """ A copy of ast with fresh names for all the variables it binds, whose
+    references are renamed according to renames. Returns None for forms that
+    cannot be copied, and, if the copy is for another module (foreign), for
+    references to variables of the module the ast is from. """
+    if isinstance(ast, LexicalVar):
+        return LexicalVar(renames.get(ast.sym, ast.sym))
+    elif isinstance(ast, CellRef):
+        sym = renames.get(ast.sym, ast.sym)
+        if simplifier_state.assigned is not None:
+            simplifier_state.assigned[sym] = None
+        return CellRef(sym)
+    elif isinstance(ast, ModuleVar):
+        if foreign and ast.srcmod is None:
+            return None
+        return ModuleVar(ast.sym, ast.srcmod, ast.srcsym)
+    elif isinstance(ast, Quote) or isinstance(ast, QuoteSyntax):
+        return ast
+    elif isinstance(ast, App):
+        parts = copy_renamed_list([ast.rator] + ast.rands, renames, foreign)
+        if parts is None:
+            return None
+        return App(parts[0], parts[1:])
+    elif isinstance(ast, If):
+        parts = copy_renamed_list([ast.tst, ast.thn, ast.els], renames, foreign)
+        if parts is None:
+            return None
+        return If(parts[0], parts[1], parts[2])
+    elif isinstance(ast, Begin):
+        body = copy_renamed_list(ast.body, renames, foreign)
+        if body is None:
+            return None
+        return Begin.make(body)
+    elif isinstance(ast, Begin0):
+        parts = copy_renamed_list([ast.first, ast.body], renames, foreign)
+        if parts is None:
+            return None
+        return Begin0(parts[0], parts[1])
+    elif isinstance(ast, WithContinuationMark):
+        parts = copy_renamed_list([ast.key, ast.value, ast.body], renames, foreign)
+        if parts is None:
+            return None
+        return WithContinuationMark(parts[0], parts[1], parts[2])
+    elif isinstance(ast, SetBang):
+        parts = copy_renamed_list([ast.var, ast.rhs], renames, foreign)
+        if parts is None:
+            return None
+        return SetBang(parts[0], parts[1])
+    elif isinstance(ast, Let):
+        rhss = copy_renamed_list(ast.rhss, renames, foreign)
+        inner = renames.copy()
+        args = _fresh_symlist(ast.args, inner)
+        body = copy_renamed_list(ast.body, inner, foreign)
+        if rhss is None or body is None:
+            return None
+        return Let(args, ast.counts, rhss, body)
+    elif isinstance(ast, Letrec):
+        inner = renames.copy()
+        args = _fresh_symlist(ast.args, inner)
+        rhss = copy_renamed_list(ast.rhss, inner, foreign)
+        body = copy_renamed_list(ast.body, inner, foreign)
+        if rhss is None or body is None:
+            return None
+        return Letrec(args, ast.counts, rhss, body)
+    elif isinstance(ast, CaseLambda):
+        inner = renames
+        recursive_sym = ast.recursive_sym
+        if recursive_sym is not None:
+            inner = renames.copy()
+            recursive_sym = Gensym.gensym(recursive_sym.variable_name() + "_")
+            inner[ast.recursive_sym] = recursive_sym
+        lams = []
+        for lam in ast.lams:
+            new_lam = copy_renamed(lam, inner, foreign)
+            if new_lam is None:
+                return None
+            assert isinstance(new_lam, Lambda)
+            lams.append(new_lam)
+        return CaseLambda(lams, recursive_sym=recursive_sym)
+    elif isinstance(ast, Lambda):
+        inner = renames.copy()
+        args = _fresh_symlist(ast.args, inner)
+        formals = args.elems[:len(ast.formals)]
+        rest = args.elems[len(ast.formals)] if ast.rest else None
+        body = copy_renamed_list(ast.body, inner, foreign)
+        if body is None:
+            return None
+        return make_lambda(formals, rest, body, ast.srcpos, ast.srcfile)
+    return None
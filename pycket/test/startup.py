@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Measures how long converting expanded modules to ASTs takes, with lambda
+# bodies converted eagerly and with --lazy-lambdas. The default inputs are the
+# largest benchmark programs; pass the paths of other modules (such as the
+# files implementing racket/base, see `collection-file-path`) to measure
+# those instead:
+#
+#   python pycket/test/startup.py [-n <runs>] [<file.rkt> ...]
+#
+
+import os
+import sys
+import time
+
+from pycket import pycket_json
+from pycket.expand import (expand_file_to_json, readfile, _to_module,
+                           conversion_config)
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FILES = ["nucleic2.rkt", "earley.rkt", "struct-test.rkt"]
+
+def convert(json):
+    return _to_module(json).assign_convert_module()
+
+def best_time(json, lazy, runs):
+    conversion_config.lazy_lambdas = lazy
+    try:
+        best = None
+        for i in range(runs):
+            start = time.time()
+            convert(json)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+    finally:
+        conversion_config.lazy_lambdas = False
+
+def main(argv):
+    runs = 5
+    if len(argv) > 2 and argv[1] == "-n":
+        runs = int(argv[2])
+        argv = argv[2:]
+    files = argv[1:] or [os.path.join(TEST_DIR, f) for f in DEFAULT_FILES]
+    total_eager = total_lazy = 0.0
+    print "%-30s %10s %10s %8s" % ("module", "eager (s)", "lazy (s)", "saved")
+    for fname in files:
+        json_file = fname + ".bench.json"
+        expand_file_to_json(fname, json_file)
+        try:
+            json = pycket_json.loads(readfile(json_file))
+        finally:
+            os.unlink(json_file)
+        # the first conversion loads the required modules
+        convert(json)
+        eager = best_time(json, False, runs)
+        lazy = best_time(json, True, runs)
+        total_eager += eager
+        total_lazy += lazy
+        print "%-30s %10.4f %10.4f %7.1f%%" % (
+            os.path.basename(fname), eager, lazy, 100 * (eager - lazy) / eager)
+    print "%-30s %10.4f %10.4f %7.1f%%" % (
+        "total", total_eager, total_lazy,
+        100 * (total_eager - total_lazy) / total_eager)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -1,12 +1,12 @@
 import pytest
 from pycket.expand import expand, expand_string
-from pycket.values import W_Symbol
+from pycket.values import W_Symbol, w_true
 from pycket.expand import _to_ast, to_ast, parse_module
 from pycket.interpreter import (LexicalVar, ModuleVar, Done, CaseLambda,
                                 variable_set, variables_equal,
                                 Lambda, Letrec, Let, Quote, App, If,
                                 )
-from pycket.test.testhelper import format_pycket_mod
+from pycket.test.testhelper import format_pycket_mod, run_mod
 
 def make_symbols(d):
     v = variable_set()
@@ -53,32 +53,56 @@ def test_remove_let():
     p = expr_ast("(let ([g cons]) (g 5 5))")
     assert isinstance(p, App)
 
-    p = expr_ast("(let ([a 1]) (if a + -))")
+    p = expr_ast("(let ([a x]) (if a + -))")
     assert isinstance(p, If)
 
 def test_let_remove_num_envs():
-    p = expr_ast("(let ([b 1]) (let ([a (+ b 1)]) (sub1 a)))")
+    p = expr_ast("(let ([b x]) (let ([a (+ b 1)]) (sub1 a)))")
     assert isinstance(p, Let)
     assert p.remove_num_envs == [0, 0]
     assert p.body[0].remove_num_envs == [0, 1]
 
-    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (+ a d))))")
+    p = expr_ast("(let ([c x]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (+ a d))))")
     assert p.body[0].body[0].remove_num_envs == [0, 1, 2]
 
+def test_simplify():
+    p = expr_ast("(+ 1 (* 2 3))")
+    assert isinstance(p, Quote) and p.w_val.value == 7
+    p = expr_ast("(if (zero? 0) 'yes 'no)")
+    assert isinstance(p, Quote) and p.w_val.tostring() == "yes"
+    p = expr_ast("(not (eq? 'a 'b))")
+    assert isinstance(p, Quote) and p.w_val.tostring() == "#t"
+    # let-bound constants are substituted and their bindings removed
+    p = expr_ast("(lambda (y) (let ([a 2] [b 3]) (+ y (* a b))))")
+    body = p.lams[0].body[0]
+    assert isinstance(body, App)
+    assert isinstance(body.rands[1], Quote) and body.rands[1].w_val.value == 6
+    # pure forms that are not the result of a body are removed
+    p = expr_ast("(lambda (y) 1 y (car y))")
+    assert len(p.lams[0].body) == 1
+    # errors are left for run time, and so are impure primitives
+    p = expr_ast("(lambda () (/ 1 0))")
+    assert isinstance(p.lams[0].body[0], App)
+    p = expr_ast("(lambda () (vector 1 2))")
+    assert isinstance(p.lams[0].body[0], App)
+    # mutated variables are not substituted
+    p = expr_ast("(lambda () (let ([a 1]) (set! a 2) a))")
+    assert isinstance(p.lams[0].body[0], Let)
+
 def test_copy_to_env():
-    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (+ a b))))")
+    p = expr_ast("(let ([c x]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (+ a b))))")
     inner_let = p.body[0].body[0]
     assert inner_let.remove_num_envs == [0, 0, 1, 2]
     assert len(inner_let.args.elems) == 3
     assert str(inner_let.args.elems[-2]).startswith('b')
 
     # can't copy env, because of the mutation
-    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (set! b (+ b 1)) (+ a b))))")
+    p = expr_ast("(let ([c x]) (let ([b (+ c 1)]) (let ([a (b + 1)] [d (- c 5)]) (set! b (+ b 1)) (+ a b))))")
     inner_let = p.body[0].body[0]
     assert inner_let.remove_num_envs == [0, 0, 0]
 
     # can't copy env, because of the mutation
-    p = expr_ast("(let ([c 7]) (let ([b (+ c 1)]) (set! b (+ b 1)) (let ([a (b + 1)] [d (- c 5)]) (+ a b))))")
+    p = expr_ast("(let ([c x]) (let ([b (+ c 1)]) (set! b (+ b 1)) (let ([a (b + 1)] [d (- c 5)]) (+ a b))))")
     inner_let = p.body[0].body[1]
     assert inner_let.remove_num_envs == [0, 0, 0]
 
@@ -105,6 +129,47 @@ def test_reclambda():
     assert isinstance(p.rhss[0], CaseLambda)
     assert p.rhss[0].recursive_sym is not None
 
+def test_lambda_lifting():
+    # the loop only uses n and k directly, they become extra arguments
+    p = expr_ast("(lambda (n k) (let loop ([i 0]) (if (= i n) k (loop (+ i 1)))))")
+    app = p.lams[0].body[0]
+    assert isinstance(app, App)
+    assert isinstance(app.rator, CaseLambda)
+    assert not app.rator.any_frees
+    assert len(app.rator.lams[0].formals) == 3
+    assert len(app.rands) == 3
+
+    # the loop escapes
+    p = expr_ast("(lambda (n) (let loop ([i 0]) (if (= i n) loop (loop (+ i 1)))))")
+    app = p.lams[0].body[0]
+    assert app.rator.any_frees
+    assert len(app.rands) == 1
+
+    # the free variable is mutated
+    p = expr_ast("(lambda (n) (let loop ([i 0]) (set! n (- n 1)) (if (= i n) i (loop (+ i 1)))))")
+    cells = p.lams[0].body[0]
+    assert isinstance(cells, Let)
+    app = cells.body[0]
+    assert app.rator.any_frees
+    assert len(app.rands) == 1
+
+def test_lambda_lifting_run():
+    m = run_mod("""
+    #lang pycket
+    (define (count-to n step)
+      (letrec ([loop (lambda (i acc) (if (>= i n) acc (loop (+ i step) (+ acc 1))))])
+        (+ (loop 0 0) (loop n 0))))
+    (define a (count-to 10 2))
+    (define (sum-list l)
+      (let loop ([l l])
+        (if (null? l) 0 (+ (car l) (loop (cdr l))))))
+    (define b (sum-list '(1 2 3)))
+    (define c (letrec ([self (lambda () self)]) (eq? self (self))))
+    """)
+    assert m.lookup(W_Symbol.make("a")).value == 5
+    assert m.lookup(W_Symbol.make("b")).value == 6
+    assert m.lookup(W_Symbol.make("c")) is w_true
+
 def test_asts_know_surrounding_lambda():
     from pycket.interpreter import ToplevelEnv
     caselam = expr_ast("(lambda (y a b) (if y a b))")
@@ -183,3 +248,308 @@ def test_bottom_up_let_conversion_bug_append():
         assert let.rhss[0].rator.sym is fn
         let = let.body[0]
     assert let.rator.sym is cons
+
+def test_ast_serialization_roundtrip():
+    from pycket import ast_serialize
+    m = parse_module(expand_string(format_pycket_mod("""
+        (define (f x [y 2] . z) (set! x (+ x y)) (list x z))
+        (define v (vector 1 2.5 -3/4 "str" #"bytes" #\\a 'sym #:kw))
+        (define h #hash((1 . 2) ("a" . b)))
+        (define (loop n acc) (if (zero? n) acc (loop (- n 1) (cons n acc))))
+        (letrec ([even? (lambda (n) (if (zero? n) #t (odd? (- n 1))))]
+                 [odd? (lambda (n) (if (zero? n) #f (even? (- n 1))))])
+          (even? 10))
+    """)))
+    data = ast_serialize.serialize_module(m, "hash", {})
+    def load_require(modname):
+        assert 0, "no requires expected"
+    m2 = ast_serialize.deserialize_module(data, "hash", load_require, {})
+    assert m2.name == m.name
+    assert m2.tostring() == m.tostring()
+    # data written for a different source is not used
+    assert ast_serialize.deserialize_module(data, "other", load_require, {}) is None
+    corrupted = data[:-1] + chr((ord(data[-1]) + 1) % 256)
+    assert ast_serialize.deserialize_module(corrupted, "hash", load_require, {}) is None
+
+def test_ast_serialization_preserves_sharing():
+    from pycket import ast_serialize
+    from pycket.interpreter import Module
+    lam = expr_ast("(lambda (x) (x (+ x 1)))")
+    m = Module("m", [lam], {})
+    m2 = ast_serialize.deserialize_module(
+            ast_serialize.serialize_module(m, "", {}), "", None, {})
+    let = m2.body[0].lams[0].body[0]
+    assert isinstance(let, Let)
+    app = let.body[0]
+    assert isinstance(app, App)
+    # the uninterned symbol introduced by let conversion is still the one
+    # bound by the let
+    sym = let.args.elems[0]
+    assert not sym.is_interned()
+    assert app.rands[0].sym is sym
+
+def test_cache_directory(tmpdir):
+    import os
+    from pycket.expand import CacheDirectory
+    cache = CacheDirectory()
+    cache.directory = str(tmpdir)
+    name1 = cache.cache_name("/a/b.rkt", "1234")
+    assert name1.startswith(str(tmpdir))
+    assert cache.cache_name("/a/b.rkt", "1234") == name1
+    assert cache.cache_name("/a/b.rkt", "5678") != name1
+    assert cache.cache_name("/a/c.rkt", "1234") != name1
+
+    cache.max_size = 25
+    for i in range(4):
+        f = tmpdir.join("entry%s.ast" % i)
+        f.write("x" * 10)
+        os.utime(str(f), (i, i))
+    # entry 0 was used most recently
+    cache.used(str(tmpdir.join("entry0.ast")))
+    cache.evict()
+    assert sorted(p.basename for p in tmpdir.listdir()) == ["entry0.ast", "entry3.ast"]
+    assert cache.total_size == 20
+
+    # writes only list the directory again once they exceed max_size
+    f = tmpdir.join("entry4.ast")
+    f.write("x" * 5)
+    os.utime(str(f), (4, 4))
+    cache.written(str(f))
+    assert cache.total_size == 25
+    assert len(tmpdir.listdir()) == 3
+    f = tmpdir.join("entry5.ast")
+    f.write("x" * 5)
+    cache.written(str(f))
+    assert sorted(p.basename for p in tmpdir.listdir()) == [
+        "entry0.ast", "entry4.ast", "entry5.ast"]
+    assert cache.total_size == 20
+
+def test_cache_hash_racket_version(tmpdir):
+    from pycket.expand import expander, _cache_hash
+    f = tmpdir.join("m.rkt")
+    f.write("#lang pycket\n(define x 1)\n")
+    assert "Racket" in expander.racket_version()
+    hash1 = _cache_hash(str(f))
+    old = expander.version
+    expander.version = "Welcome to Racket v0.0.\n"
+    try:
+        assert _cache_hash(str(f)) != hash1
+    finally:
+        expander.version = old
+
+def test_expander_client_protocol():
+    import os
+    from pycket.expand import ExpanderClient, ExpandException
+    request_read, request_write = os.pipe()
+    response_read, response_write = os.pipe()
+    client = ExpanderClient(response_read, request_write)
+    os.write(response_write, 'ok 7\n{"a":1}error 4\noops')
+    assert client.expand_code("(module m '#%kernel)") == '{"a":1}'
+    assert os.read(request_read, 100) == "code 1 20\n(module m '#%kernel)"
+    with pytest.raises(ExpandException):
+        client.expand_code("x", srcloc=False)
+    assert os.read(request_read, 100) == "code 0 1\nx"
+    for fd in [request_read, request_write, response_read, response_write]:
+        os.close(fd)
+
+def test_find_requires():
+    from pycket import pycket_json
+    from pycket.expand import _find_requires, _add_requires
+    json = pycket_json.loads("""
+        {"module-name": "m", "language": "/lang.rkt",
+         "body-forms": [{"require": ["/a.rkt", "#%kernel"]},
+                        {"let-bindings": [],
+                         "let-body": [{"require": ["/b.rkt", "/a.rkt"]}]}]}
+    """)
+    requires = []
+    _find_requires(json, requires)
+    assert sorted(requires) == ["#%kernel", "/a.rkt", "/a.rkt", "/b.rkt", "/lang.rkt"]
+    pending = []
+    seen = {"/b.rkt": None}
+    _add_requires(requires, pending, seen)
+    assert sorted(pending) == ["/a.rkt", "/lang.rkt"]
+
+def test_parallel_expansion_waits_for_own_children():
+    import os, time
+    from pycket.expand import ParallelExpansion
+    def spawn(seconds, code):
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(seconds)
+            os._exit(code)
+        return pid
+    # stands in for the persistent expander, which exits first
+    other = spawn(0, 0)
+    job = spawn(0.2, 3)
+    pid, status = ParallelExpansion()._wait_any({job: None})
+    assert pid == job
+    assert os.WEXITSTATUS(status) == 3
+    # the other child was not reaped
+    assert os.waitpid(other, 0)[0] == other
+
+def test_json_file_requires(tmpdir):
+    from pycket.expand import _json_file_requires
+    json_file = tmpdir.join("m.json")
+    json_file.write('{"module-name": "m", "language": "/lang.rkt", '
+                    '"body-forms": [{"require": ["/a.rkt"]}, {"quote": 1}, '
+                    '{"begin0": {"require": ["/b.rkt", "#%kernel"]}, '
+                    '"begin0-rest": []}]}')
+    assert _json_file_requires(str(json_file)) == [
+        "/lang.rkt", "/a.rkt", "/b.rkt", "#%kernel"]
+
+def test_lazy_lambda_analysis():
+    from pycket import pycket_json
+    from pycket.expand import conversion_config, to_lambda, LazyLambdaBody
+    expr = """
+        (lambda (c d)
+          (lambda (a)
+            (let ([b (car a)])
+              (letrec ([f (lambda (n) (if (zero? n) c (f (- n 1))))])
+                (set! b (f a))
+                (set! x b)
+                (list (quote c) d (lambda (d) d))))))
+    """
+    json = pycket_json.loads(expand(format_pycket_mod(expr, extra="(define x 0)")))
+    outer = json.value_object()["body-forms"].value_array()[-1]
+    inner = outer.value_object()["body"].value_array()[0].value_object()
+    eager = to_lambda(inner)
+    conversion_config.lazy_lambdas = True
+    try:
+        lazy = to_lambda(inner)
+    finally:
+        conversion_config.lazy_lambdas = False
+    body = lazy.body[0]
+    assert isinstance(body, LazyLambdaBody)
+    assert body.forced is None
+    assert set(lazy.frees.elems) == set(eager.frees.elems)
+    assert len(lazy.frees.elems) == 2 # c and d
+    for v in eager.mutated_vars():
+        assert v in lazy.mutated_vars()
+    body.force()
+    assert body.json_body is None
+
+def test_lazy_lambda_run():
+    from pycket.expand import conversion_config
+    from pycket.test.testhelper import run_fix
+    conversion_config.lazy_lambdas = True
+    try:
+        run_fix("""
+            (let ([count 0])
+              (define (inc! n) (set! count (+ count n)) count)
+              (letrec ([loop (lambda (i) (if (= i 0) count (begin (inc! i) (loop (- i 1)))))])
+                (loop 10)))
+        """, 55)
+        run_fix("((case-lambda [(x) x] [(x y) (+ x y)]) 1 2)", 3)
+        # the set! in the lazy body keeps x from being replaced by y
+        run_fix("(let ([y 1]) (let ([x y]) ((lambda () (set! y 2))) x))", 1)
+    finally:
+        conversion_config.lazy_lambdas = False
+
+def test_printable_location():
+    from pycket.interpreter import get_printable_location
+    p = expr_ast("(lambda (y) (list %s))" % " ".join(["y"] * 40))
+    lam = p.lams[0]
+    lam.srcfile = "/some/dir/file.rkt"
+    lam.srcpos = 42
+    location = get_printable_location(lam.body[0])
+    assert location.startswith("file.rkt:42 ")
+    assert location.endswith("...")
+    assert get_printable_location(p).startswith("<module> ")
+
+def test_toplevel_bindings():
+    from pycket.interpreter import ToplevelEnv
+    from pycket.error import SchemeException
+    from pycket.values import W_Fixnum
+    env = ToplevelEnv()
+    x = W_Symbol.make("x")
+    with pytest.raises(SchemeException):
+        env.toplevel_lookup(x)
+    binding = env._binding(x)
+    env.toplevel_set(x, W_Fixnum(1))
+    assert env.toplevel_lookup(x).value == 1
+    assert binding.constant
+    # defining other variables does not touch the binding of x
+    env.toplevel_set(W_Symbol.make("y"), W_Fixnum(2))
+    assert env._binding(x) is binding
+    assert binding.constant
+    # assigning x again stops treating its value as a constant
+    env.toplevel_set(x, W_Fixnum(3))
+    assert env._binding(x) is binding
+    assert not binding.constant
+    assert env.toplevel_lookup(x).value == 3
+
+def test_call_site_cache():
+    from pycket.interpreter import CallSiteCache, POLYMORPHIC_LIMIT
+    cache = CallSiteCache()
+    caselams = [object() for i in range(POLYMORPHIC_LIMIT + 1)]
+    assert cache.lookup(caselams[0]) == -1
+    cache.record(caselams[0], 1)
+    assert cache.lookup(caselams[0]) == 1
+    for i in range(1, POLYMORPHIC_LIMIT):
+        cache.record(caselams[i], 0)
+    assert cache.lookup(caselams[POLYMORPHIC_LIMIT - 1]) == 0
+    assert (cache.hits, cache.misses) == (2, 1)
+    # one more CaseLambda makes the site megamorphic
+    cache.record(caselams[POLYMORPHIC_LIMIT], 0)
+    assert cache.megamorphic
+    assert cache.lookup(caselams[0]) == -1
+    cache.record(caselams[0], 1)
+    assert cache.lookup(caselams[0]) == -1
+
+def test_call_site_cache_clauses():
+    # the call in g selects the second clause of f and then a closure of
+    # another CaseLambda
+    m = run_mod("""
+    #lang pycket
+    (define f (case-lambda [(x) 1] [(x y) 2]))
+    (define (g h) (h 0 0))
+    (define a (for/sum ([i 10]) (g f)))
+    (define b (g (lambda (x y) 3)))
+    """)
+    assert m.lookup(W_Symbol.make("a")).value == 20
+    assert m.lookup(W_Symbol.make("b")).value == 3
+
+def test_direct_depth():
+    lam = expr_ast("(lambda (y) (let ([a (+ y 1)]) (if a (* a 2) (car y))))").lams[0]
+    let = lam.body[0]
+    assert isinstance(let, Let)
+    assert let.rhss[0].direct_depth == 1
+    assert let.body[0].direct_depth == 2
+    assert let.direct_depth == 3
+    # closure calls need continuations
+    lam = expr_ast("(lambda (y) (let ([a (y 1)]) (+ a 1)))").lams[0]
+    let = lam.body[0]
+    assert let.rhss[0].direct_depth == -1
+    assert let.body[0].direct_depth == 1
+    assert let.direct_depth == -1
+
+def test_direct_depth_limit():
+    from pycket.interpreter import MAX_DIRECT_DEPTH
+    from pycket.values import w_true
+    plus = W_Symbol.make("+")
+    ast = App(ModuleVar(plus, "#%kernel", plus), [Quote(w_true)])
+    for i in range(MAX_DIRECT_DEPTH + 5):
+        ast = If(Quote(w_true), ast, Quote(w_true))
+    # the outer ifs are interpreted with continuations again
+    assert ast.direct_depth == -1
+    while ast.direct_depth < 0:
+        ast = ast.thn
+    assert ast.direct_depth == MAX_DIRECT_DEPTH
+
+def test_direct_evaluation():
+    m = run_mod("""
+    #lang pycket
+    (define total 0)
+    (define (f x)
+      (let-values ([(q r) (quotient/remainder x 7)]
+                   [(s) (+ x 1)])
+        (set! total (+ total q))
+        (set! x (* r s))
+        (set! total (+ total x))
+        (if (< q 2) (+ q r) (let ([t (- s 1)]) (* t 2)))))
+    (define a (f 9))
+    (define b (f 30))
+    """)
+    assert m.lookup(W_Symbol.make("a")).value == 3
+    assert m.lookup(W_Symbol.make("b")).value == 60
+    assert m.lookup(W_Symbol.make("total")).value == 1 + 20 + 4 + 62
@@ -231,6 +231,46 @@ def test_callwithcurrentcontinuation():
     run_fix ("(+ 1 (call-with-current-continuation (lambda (k) (k 1))))", 2)
     run_fix ("(+ 1 (call-with-current-continuation (lambda (k) (+ 5 (k 1)))))", 2)
 
+def test_prompts():
+    run_fix("(call-with-continuation-prompt (lambda () 1))", 1)
+    run_fix("""
+    (+ 1 (call-with-continuation-prompt
+           (lambda (x)
+             (+ 5 (abort-current-continuation
+                    (default-continuation-prompt-tag) (lambda () x))))
+           (default-continuation-prompt-tag) #f 2))""", 3)
+    run_fix("""
+    (let ([tag (make-continuation-prompt-tag 'tag)])
+      (+ 1 (call-with-continuation-prompt
+             (lambda () (+ 5 (abort-current-continuation tag 2 3)))
+             tag
+             (lambda (a b) (* a b)))))""", 7)
+    run("(continuation-prompt-tag? (default-continuation-prompt-tag))", w_true)
+    run("(continuation-prompt-available? (make-continuation-prompt-tag))", w_false)
+    run("""
+    (let ([tag (make-continuation-prompt-tag)])
+      (call-with-continuation-prompt
+        (lambda () (continuation-prompt-available? tag))
+        tag))""", w_true)
+    with pytest.raises(SchemeException):
+        run("(abort-current-continuation (make-continuation-prompt-tag) 1)")
+
+def test_raise_handler():
+    # the handler runs with the outer handler installed
+    run_fix("""
+    (let ([tag (make-continuation-prompt-tag)])
+      (call-with-continuation-prompt
+        (lambda ()
+          (with-continuation-mark exception-handler-key
+            (lambda (e) (abort-current-continuation tag (+ e 1)))
+            (+ 0 (with-continuation-mark exception-handler-key
+                   (lambda (e) (raise (* e 10)))
+                   (+ 1 (raise 4))))))
+        tag
+        (lambda (e) e)))""", 41, extra="(require '#%paramz)")
+    with pytest.raises(SchemeException):
+        run("(raise 1)")
+
 
 def test_values():
     run_fix("(values 1)", 1)
@@ -414,8 +454,8 @@ def test_with_continuation_mark():
             key))))
     """)
     sym = W_Symbol.make("result")
-    assert isinstance(m.defs[sym], W_String)
-    assert m.defs[sym].value == "ham"
+    assert isinstance(m.lookup(sym), W_String)
+    assert m.lookup(sym).value == "ham"
 
 def test_with_continuation_mark_impersonator():
     m = run_mod(
@@ -433,8 +473,8 @@ def test_with_continuation_mark_impersonator():
          mark-key)))
     """)
     sym = W_Symbol.make("result")
-    assert isinstance(m.defs[sym], W_Character)
-    assert m.defs[sym].value == 'q'
+    assert isinstance(m.lookup(sym), W_Character)
+    assert m.lookup(sym).value == 'q'
 
 def test_impersonator_application_mark():
     m = run_mod(
@@ -453,8 +493,53 @@ def test_impersonator_application_mark():
     (define result (wrapped))
     """)
     sym = W_Symbol.make("result")
-    assert isinstance(m.defs[sym], W_Fixnum)
-    assert m.defs[sym].value == 42
+    assert isinstance(m.lookup(sym), W_Fixnum)
+    assert m.lookup(sym).value == 42
+
+def test_mark_cache():
+    from pycket.cont import Cont, MARK_CACHE_INTERVAL
+    key = W_Symbol.make("key")
+    bottom = Cont(None, nil_continuation)
+    bottom.update_cm(key, W_Fixnum(1))
+    k = bottom
+    frames = []
+    for i in range(4 * MARK_CACHE_INTERVAL):
+        k = Cont(None, k)
+        frames.append(k)
+    assert k.get_mark_first(key).value == 1
+    # the frames in between cache the value, but have no marks of their own
+    cached = frames[-1 - MARK_CACHE_INTERVAL]
+    assert cached.find_link(key).cached
+    assert cached.find_cm(key) is None
+    assert Cont(None, cached).get_mark_first(key).value == 1
+    cached.update_cm(key, W_Fixnum(2))
+    assert cached.find_cm(key).value == 2
+    assert cached.get_mark_first(key).value == 2
+    assert k.get_mark_first(W_Symbol.make("other")) is None
+
+def test_parameter_in_deep_recursion():
+    run_fix("""
+    (let ([p (make-parameter 1)])
+      (define (deep n)
+        (if (= n 0) (p) (+ (p) (deep (- n 1)))))
+      (+ (deep 1000) (parameterize ([p 2]) (deep 1000))))""", 1001 + 2002)
+
+def test_parameterization_sharing():
+    params = [W_Parameter(W_Fixnum(i)) for i in range(100)]
+    paramz = top_level_config
+    for i, p in enumerate(params):
+        paramz = paramz.extend([p], [W_Fixnum(i + 100)])
+    inner = paramz.extend([params[0], params[1]], [W_Fixnum(-1), W_Fixnum(-2)])
+    assert inner.get(params[0]).get().value == -1
+    assert inner.get(params[1]).get().value == -2
+    assert paramz.get(params[0]).get().value == 100
+    # the cells of the other parameters are shared
+    assert inner.get(params[99]) is paramz.get(params[99])
+    assert top_level_config.get(params[5]).get().value == 5
+    run_fix("""
+    (let ([p (make-parameter 1)] [q (make-parameter 2)])
+      (parameterize ([p 10])
+        (+ (p) (parameterize ([q 20] [p 30]) (+ (p) (q))))))""", 60)
 
 def test_string_set_bang():
     m = run_mod(
@@ -464,7 +549,7 @@ def test_string_set_bang():
     (string-set! str 0 #\\x)
     """)
     sym = W_Symbol.make("str")
-    res = m.defs[sym]
+    res = m.lookup(sym)
     assert isinstance(res, W_String)
     assert not res.immutable()
     assert res.value == "xello"
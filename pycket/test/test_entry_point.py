@@ -175,3 +175,24 @@ class TestCommandline(object):
         assert entry_point(['arg0', '-f', racket_file]) == 0
         out, err = capfd.readouterr()
         assert out == "42"
+
+    def test_profile(self, capfd, tmpdir):
+        from pycket.profiler import profiler
+        output = str(tmpdir.join("profile.txt"))
+        code = "(define (f n) (if (= n 0) 0 (+ 1 (f (- n 1))))) (display (f 100))"
+        try:
+            assert entry_point(['arg0', '--profile', output,
+                                '--profile-interval', '1', '-e', code]) == 0
+        finally:
+            profiler.output = None
+            profiler.interval = 10000
+        out, err = capfd.readouterr()
+        assert out == "100"
+        assert "samples" in err
+        lines = open(output).read().splitlines()
+        assert lines
+        for line in lines:
+            path, time = line.rsplit(" ", 1)
+            assert path.startswith("<module>")
+            assert int(time) >= 0
+        assert [l for l in lines if l.count(";") > 2]
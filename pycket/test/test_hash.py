@@ -196,3 +196,219 @@ def test_get_item():
             i += 1
     tg("1", 2, "3", 4)
     interpret(tg, [1, 2, 334, 4])
+
+def test_next_dict_index():
+    from rpython.rtyper.test.test_llinterp import interpret
+    from pycket.values_hash import next_dict_index, get_dict_item
+    def tg(n, removed):
+        dct = {}
+        for i in range(n):
+            dct[i] = i * 10
+        del dct[removed]
+        total = 0
+        count = 0
+        pos = next_dict_index(dct, 0)
+        while pos >= 0:
+            k, v = get_dict_item(dct, pos)
+            total += v
+            count += 1
+            pos = next_dict_index(dct, pos + 1)
+        assert count == n - 1
+        return total
+    assert tg(5, 2) == 80
+    assert interpret(tg, [5, 2]) == 80
+
+def test_hamt_nth():
+    from pycket.hamt import (HAMTBucket, empty_hamt_node, hamt_replace,
+                             hamt_nth, hamt_items)
+    node = empty_hamt_node
+    # 1 and 33 share a slot of the root, so they end up in an inner node
+    for h in [1, 33, 1 << 10, 7, 33 + (1 << 15)]:
+        node = hamt_replace(node, h, HAMTBucket(h, [h], [h * 2]))
+    node = hamt_replace(node, 7, HAMTBucket(7, [7, 8], [14, 16]))
+    items = hamt_items(node, [])
+    assert node.count == len(items) == 6
+    for i, (k, v) in enumerate(items):
+        bucket, j = hamt_nth(node, i)
+        assert (bucket.keys[j], bucket.vals[j]) == (k, v)
+    assert hamt_replace(node, 33, None).count == 5
+
+def test_equal_keyed_hash(doctest):
+    """
+    ! (define ht (make-hash))
+    ! (hash-set! ht (list 1 2) 'a)
+    ! (hash-set! ht (vector 1 2) 'b)
+    ! (hash-set! ht "str" 'c)
+    ! (hash-set! ht (cons 1.5 'x) 'd)
+    > (hash-ref ht (list 1 2))
+    'a
+    > (hash-ref ht (vector 1 2))
+    'b
+    > (hash-ref ht (string-append "s" "tr"))
+    'c
+    > (hash-ref ht (cons 1.5 'x))
+    'd
+    > (hash-ref ht (list 1 3) 'none)
+    'none
+    > (begin (hash-set! ht (list 1 2) 'e) (hash-count ht))
+    4
+    > (hash-ref ht (list 1 2))
+    'e
+    """
+
+def test_make_hash_duplicate_compound_keys(doctest):
+    """
+    ! (define ht (make-hash (list (cons (list 1 2) 'a) (cons (vector 3) 'b) (cons (list 1 2) 'c) (cons (vector 3) 'd))))
+    > (hash-count ht)
+    2
+    > (hash-ref ht (list 1 2))
+    'c
+    > (hash-ref ht (vector 3))
+    'd
+    > (hash-count (make-hash (list (cons (box "x") 1) (cons (box "x") 2) (cons 'y 3))))
+    2
+    """
+
+def test_equal_hash_code(doctest):
+    """
+    > (= (equal-hash-code (list 1 (vector 2 "x"))) (equal-hash-code (list 1 (vector 2 "x"))))
+    #t
+    > (= (equal-hash-code (box 'a)) (equal-hash-code (box 'a)))
+    #t
+    """
+
+def test_immutable_hash_set_remove(doctest):
+    """
+    ! (define h0 (hash 'a 1 'b 2))
+    ! (define h1 (hash-set h0 'c 3))
+    ! (define h2 (hash-remove h1 'a))
+    > (hash-ref h1 'c)
+    3
+    > (hash-ref h0 'c #f)
+    #f
+    > (hash-count h1)
+    3
+    > (hash-ref h2 'a #f)
+    #f
+    > (hash-count h2)
+    2
+    > (hash-ref h1 'a)
+    1
+    > (hash-count (hash-remove h0 'zzz))
+    2
+    > (immutable? h0)
+    #t
+    """
+
+def test_immutable_hash_compound_keys(doctest):
+    """
+    ! (define h (hash-set (hash-set (hash) (list 1 2) 'x) (vector 3) 'y))
+    > (hash-ref h (list 1 2))
+    'x
+    > (hash-ref (hash-set h (list 1 2) 'z) (list 1 2))
+    'z
+    > (hash-count (hash-set h (list 1 2) 'z))
+    2
+    > (hash-count (hash-remove h (vector 3)))
+    1
+    """
+
+def test_immutable_hash_duplicate_compound_keys(doctest):
+    """
+    ! (struct mod10 (n) #:property prop:equal+hash (list (lambda (a b recur) (= (modulo (mod10-n a) 10) (modulo (mod10-n b) 10))) (lambda (a recur) 0) (lambda (a recur) 0)))
+    > (hash-count (hash (list 1) 'a (list 1) 'b))
+    1
+    > (hash-ref (hash (list 1) 'a (list 1) 'b) (list 1))
+    'b
+    > (hash-count (hash (vector 1 (box "x")) 'a (vector 1 (box "x")) 'b (vector 2) 'c))
+    2
+    > (hash-count (make-immutable-hash (list (cons (list 1 2) 'a) (cons (list 1 2) 'b))))
+    1
+    > (hash-count (hash (mod10 1) 'a (mod10 11) 'b (mod10 2) 'c))
+    2
+    > (hash-ref (hash (mod10 1) 'a (mod10 11) 'b) (mod10 21))
+    'b
+    """
+
+def test_immutable_hash_many_updates(doctest):
+    """
+    ! (define (build n h) (if (= n 0) h (build (- n 1) (hash-set h n (* n n)))))
+    ! (define h (build 1000 (hasheqv)))
+    > (hash-count h)
+    1000
+    > (hash-ref h 999)
+    998001
+    > (hash-ref h 1001 'none)
+    'none
+    """
+
+def test_hash_iterate(doctest):
+    """
+    ! (define ht (make-hash))
+    ! (hash-set! ht 'a 1)
+    ! (hash-set! ht 'b 2)
+    ! (hash-set! ht 'c 3)
+    ! (define (sum-values h)
+    !   (let loop ([pos (hash-iterate-first h)] [acc 0])
+    !     (if pos
+    !         (loop (hash-iterate-next h pos) (+ acc (hash-iterate-value h pos)))
+    !         acc)))
+    > (sum-values ht)
+    6
+    > (sum-values (hash 1 10 (list 2) 20 "x" 30))
+    60
+    > (hash-iterate-first (make-hasheq))
+    #f
+    > (let ([pos (hash-iterate-first ht)])
+        (hash-set! ht (hash-iterate-key ht pos) 100)
+        (hash-iterate-value ht pos))
+    100
+    E (hash-iterate-key ht 1000)
+    """
+
+def test_in_hash(doctest):
+    """
+    ! (define h (hash 'a 1 'b 2 'c 3))
+    > (for/fold ([acc 0]) ([(k v) (in-hash h)]) (+ acc v))
+    6
+    """
+
+def test_impersonated_hash_iterate(doctest):
+    """
+    ! (define ht (make-hash))
+    ! (hash-set! ht 'a 1)
+    ! (hash-set! ht 'b 2)
+    ! (define ih (impersonate-hash ht (lambda (h k) (values k (lambda (h k v) (* v 10)))) (lambda (h k v) (values k v)) (lambda (h k) k) (lambda (h k) k)))
+    > (hash-ref ih 'a)
+    10
+    > (let ([x 0]) (hash-for-each ih (lambda (k v) (set! x (+ x v)))) x)
+    30
+    > (apply + (hash-map ih (lambda (k v) v)))
+    30
+    > (let ([pos (hash-iterate-first ih)])
+        (= (hash-iterate-value ih pos) (* 10 (hash-ref ht (hash-iterate-key ih pos)))))
+    #t
+    """
+
+def test_impersonated_equal_keys(doctest):
+    """
+    ! (define iv (impersonate-vector (vector 1 2) (lambda (v i x) (* x 10)) (lambda (v i x) x)))
+    ! (define ht (make-hash))
+    ! (hash-set! ht (vector 10 20) 'a)
+    > (equal? iv (vector 10 20))
+    #t
+    > (hash-ref ht iv #f)
+    'a
+    > (begin (hash-set! ht iv 'b) (hash-count ht))
+    1
+    > (hash-ref ht (vector 10 20))
+    'b
+    > (hash-ref (hash (vector 10 20) 'a (vector 1 2) 'x) iv)
+    'a
+    > (hash-ref (hash iv 'a 'k 'v) (vector 10 20))
+    'a
+    > (hash-count (hash iv 1 (vector 10 20) 2 (vector 1 2) 3))
+    2
+    > (hash-count (hash-remove (hash (vector 10 20) 1 'z 2) iv))
+    1
+    """
@@ -44,3 +44,47 @@ def test_bug():
             [{"quote" : { "string": "\\" }},{"quote" : { "string": "Hi" }}])
 
     _compare(r'{"string" : "\\\\"}', {"string": "\\\\"})
+
+class FakeStream(object):
+    def __init__(self, data):
+        self.data = data
+    def read(self, n):
+        result, self.data = self.data[:n], self.data[n:]
+        return result
+    def close(self):
+        pass
+
+def test_chunked_reader():
+    from pycket.pycket_json import ChunkedJsonReader
+    text = r'{"a": [1, "x\\\"]}", {"b": null}], "c" : -2.5e3 }'
+    reader = ChunkedJsonReader(FakeStream(text))
+    reader.chunk_size = 3
+    reader.expect("{")
+    assert reader.read_value().value_string() == "a"
+    reader.expect(":")
+    reader.expect("[")
+    assert reader.read_value().value_int() == 1
+    assert reader.skip(",")
+    assert reader.read_value_text() == r'"x\\\"]}"'
+    assert reader.skip(",")
+    assert reader.read_value()._unpack_deep() == {"b": None}
+    assert not reader.skip(",")
+    reader.expect("]")
+    reader.expect(",")
+    assert reader.read_value().value_string() == "c"
+    reader.expect(":")
+    assert reader.read_value().value_float() == -2500.0
+    reader.expect("}")
+    assert reader.peek() == ""
+
+def test_streaming_module():
+    from pycket.pycket_json import ChunkedJsonReader
+    from pycket.expand import _to_module_streaming
+    text = """{"body-forms": [{"quote": {"number": {"integer": "1"}}},
+                              {"quote": {"string": "two"}}],
+               "language": "", "module-name": "m"}"""
+    reader = ChunkedJsonReader(FakeStream(text))
+    reader.chunk_size = 7
+    module = _to_module_streaming(reader)
+    assert module.name == "m"
+    assert [b.tostring() for b in module.body] == ["1", "two"]
@@ -11,7 +11,7 @@ def test_empty_mod():
 
 def test_racket_mod():
     m = run_mod("#lang racket/base\n (define x 1)")
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert ov.value == 1
 
 def test_constant_mod():
@@ -39,7 +39,7 @@ def test_set_modvar():
 
 (tail-rec-aux 0 100)
 """)
-    ov = m.defs[W_Symbol.make("sum")].get_val()
+    ov = m.lookup(W_Symbol.make("sum")).get_val()
     assert ov.value == 100
 
 def test_set_mod2():
@@ -49,7 +49,7 @@ def test_set_mod2():
 (define table #f)
 (set! table #f)
 """)
-    ov = m.defs[W_Symbol.make("table")]
+    ov = m.lookup(W_Symbol.make("table"))
     assert isinstance(ov, W_Cell)
 
 
@@ -59,7 +59,7 @@ def test_set_mod_other():
     (require pycket/set-export)
 (define y (not x))
 """)
-    assert m.defs[W_Symbol.make("y")]
+    assert m.lookup(W_Symbol.make("y"))
 
 def test_use_before_definition():
     with pytest.raises(SchemeException):
@@ -88,5 +88,125 @@ def test_shadowing_macro():
 
 (define x (bind+ 1 2 3))
 """)
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert ov.value == 6
+
+def test_module_instantiated_once_per_namespace(tmpdir, capfd):
+    from pycket.expand import ModTable, expand_file_cached
+    from pycket.env import ToplevelEnv
+    tmpdir.join("common.rkt").write(
+        '#lang pycket\n(provide x)\n(display "instantiated\\n")\n(define x 1)\n')
+    tmpdir.join("a.rkt").write(
+        '#lang pycket\n(require "common.rkt")\n(provide a)\n(define a (+ x 1))\n')
+    tmpdir.join("b.rkt").write(
+        '#lang pycket\n(require "common.rkt")\n(provide b)\n(define b (+ x 2))\n')
+    main = tmpdir.join("main.rkt")
+    main.write('#lang pycket\n(require "a.rkt" "b.rkt")\n(define y (+ a b))\n')
+    ModTable.reset()
+    m = expand_file_cached(str(main))
+    interpret_module(m, ToplevelEnv())
+    W_FileOutputPort.flush_all()
+    out, err = capfd.readouterr()
+    assert out.count("instantiated") == 1
+    assert m.lookup(W_Symbol.make("y")).value == 5
+    # a new namespace gets its own instance
+    interpret_module(m, ToplevelEnv())
+    W_FileOutputPort.flush_all()
+    out, err = capfd.readouterr()
+    assert out.count("instantiated") == 1
+
+def test_module_slots():
+    from pycket.error import SchemeException
+    m = run_mod("""
+#lang pycket
+(define-values (x y) (values 1 2))
+(define z (+ x y))
+""")
+    assert m.slots[W_Symbol.make("x")] == 0
+    assert m.slots[W_Symbol.make("y")] == 1
+    assert m.lookup(W_Symbol.make("z")).value == 3
+    with pytest.raises(SchemeException) as e:
+        run_mod("""
+#lang pycket
+(define (f) y)
+(define x (f))
+(define y 1)
+""")
+    assert "before definition" in e.value.msg
+
+def _definition(m, name):
+    sym = W_Symbol.make(name)
+    for b in m.body:
+        if isinstance(b, DefineValues) and sym in b.names:
+            return b.rhs
+    assert 0, "no definition of %s" % name
+
+def test_inline_procedures(tmpdir):
+    from pycket.expand import ModTable, expand_file_cached
+    from pycket.env import ToplevelEnv
+    tmpdir.join("lib.rkt").write("""#lang pycket
+(provide first-of add counter-value)
+(define (first-of p) (car p))
+(define (add x y) (+ x y))
+(define counter 0)
+(define (counter-value) counter)
+""")
+    main = tmpdir.join("main.rkt")
+    main.write("""#lang pycket
+(require "lib.rkt")
+(define (id x) x)
+(define (mutable x) x)
+(set! mutable id)
+(define (f p) (id (first-of p)))
+(define two (add 1 1))
+(define (g x) (mutable x))
+(define (c) (counter-value))
+""")
+    ModTable.reset()
+    m = expand_file_cached(str(main))
+    interpret_module(m, ToplevelEnv())
+    # same module and across modules
+    body = _definition(m, "f").lams[0].body[0]
+    assert isinstance(body, App)
+    assert body.rator.srcsym is W_Symbol.make("car")
+    # the arguments are constants, so the inlined body is folded
+    two = _definition(m, "two")
+    assert isinstance(two, Quote) and two.w_val.value == 2
+    # mutated procedures and procedures referring to their own module's
+    # variables are not inlined into other modules
+    body = _definition(m, "g").lams[0].body[0]
+    assert body.rator.srcsym is W_Symbol.make("mutable")
+    body = _definition(m, "c").lams[0].body[0]
+    assert body.rator.srcsym is W_Symbol.make("counter-value")
+
+def test_cache_invalidated_by_requires(tmpdir):
+    from pycket.expand import ModTable, expand_file_cached
+    from pycket.env import ToplevelEnv
+    lib = tmpdir.join("lib.rkt")
+    lib.write("#lang pycket\n(provide k)\n(define (k) 1)\n")
+    main = tmpdir.join("main.rkt")
+    main.write('#lang pycket\n(require "lib.rkt")\n(define v (k))\n')
+    ModTable.reset()
+    m = expand_file_cached(str(main))
+    interpret_module(m, ToplevelEnv())
+    assert m.lookup(W_Symbol.make("v")).value == 1
+    # the body of k was inlined into the cached main module
+    lib.write("#lang pycket\n(provide k)\n(define (k) 2)\n")
+    ModTable.reset()
+    m = expand_file_cached(str(main))
+    interpret_module(m, ToplevelEnv())
+    assert m.lookup(W_Symbol.make("v")).value == 2
+
+def test_no_inline():
+    from pycket.simplify import inliner
+    inliner.enabled = False
+    try:
+        m = run_mod("""
+#lang pycket
+(define (id x) x)
+(define (f y) (id y))
+""")
+    finally:
+        inliner.enabled = True
+    body = _definition(m, "f").lams[0].body[0]
+    assert isinstance(body, App)
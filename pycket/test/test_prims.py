@@ -6,7 +6,7 @@
 
 import pytest
 import sys
-from pycket.values import w_true
+from pycket.values import w_true, w_false
 from pycket.test.testhelper import check_all, check_none, check_equal, run_flo, run_fix, run, run_mod, run_mod_expr
 from pycket.error import SchemeException
 
@@ -503,3 +503,86 @@ def test_number_to_string(doctest):
     "3bf9304450677dc5f60e4afde2a26b6546f195ed670022bc71c71c71c71c71c71c7"
     """
 
+
+def test_file_stream_buffer_mode(tmpdir):
+    from rpython.rlib.streamio import open_file_as_stream
+    from pycket.values import W_FileOutputPort
+    path = str(tmpdir.join("buffered.txt"))
+    port = W_FileOutputPort(open_file_as_stream(path, mode="wb"))
+    port.write("abc\n")
+    assert tmpdir.join("buffered.txt").read() == ""
+    port.set_buffer_mode(W_FileOutputPort.BUFFER_LINE)
+    port.write("def\n")
+    assert tmpdir.join("buffered.txt").read() == "abc\ndef\n"
+    port.set_buffer_mode(W_FileOutputPort.BUFFER_NONE)
+    port.write("g")
+    assert tmpdir.join("buffered.txt").read() == "abc\ndef\ng"
+    port.set_buffer_mode(W_FileOutputPort.BUFFER_BLOCK)
+    port.write("h")
+    assert port.tell() == 10
+    port.close()
+    assert tmpdir.join("buffered.txt").read() == "abc\ndef\ngh"
+
+    source = """
+    (let ([p (open-output-file "%s" 'binary 'truncate)])
+      (file-stream-buffer-mode p 'none)
+      (begin0 (list (file-stream-buffer-mode p)
+                    (file-stream-buffer-mode (open-output-string)))
+              (close-output-port p)))
+    """ % path
+    result = run_mod_expr(source, wrap=True)
+    assert result.car().value == "none"
+    assert result.cdr().car() is w_false
+
+def test_file_output_ports_not_kept_alive(tmpdir):
+    import gc
+    from rpython.rlib.streamio import open_file_as_stream
+    from pycket.values import W_FileOutputPort, file_output_state
+    path = str(tmpdir.join("ports.txt"))
+    def live_ports():
+        return [ref() for ref in file_output_state.open_ports
+                if ref() is not None and not ref().closed]
+    before = len(live_ports())
+    port = W_FileOutputPort(open_file_as_stream(path, mode="wb"))
+    assert len(live_ports()) == before + 1
+    port.close()
+    assert len(live_ports()) == before
+    W_FileOutputPort(open_file_as_stream(path, mode="wb"))
+    gc.collect()
+    assert len(live_ports()) == before
+    for i in range(100):
+        W_FileOutputPort(open_file_as_stream(path, mode="wb")).close()
+    assert len(file_output_state.open_ports) < 2 * before + 50
+
+def test_output_buffer_size(tmpdir):
+    from rpython.rlib.streamio import open_file_as_stream
+    from pycket.values import W_FileOutputPort, file_output_state
+    path = str(tmpdir.join("sized.txt"))
+    port = W_FileOutputPort(open_file_as_stream(path, mode="wb"))
+    old = file_output_state.buffer_size
+    # the size set on the command line applies to existing ports, too
+    file_output_state.buffer_size = 4
+    try:
+        port.write("abc")
+        assert tmpdir.join("sized.txt").read() == ""
+        port.write("d")
+        assert tmpdir.join("sized.txt").read() == "abcd"
+    finally:
+        file_output_state.buffer_size = old
+        port.close()
+
+def test_jit_stats():
+    from pycket.jit_stats import JitStats
+    from rpython.rlib.jit import Counters
+    stats = JitStats()
+    stats.record_loop("loop.rkt:10 (f x)")
+    stats.record_loop("loop.rkt:10 (f x)")
+    stats.record_bridge()
+    stats.record_abort(Counters.ABORT_TOO_LONG, "big.rkt:5 (g y)")
+    report = stats.report()
+    assert "loops compiled: 2" in report
+    assert "bridges compiled: 1" in report
+    assert "trace too long: 1" in report
+    assert "2 loop.rkt:10 (f x)" in report
+    assert "1 big.rkt:5 (g y)" in report
+    check_all('(string? (pycket:jit-stats))')
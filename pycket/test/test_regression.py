@@ -62,4 +62,4 @@ class TestRegressions(object):
         (define result #t)
         """
         m = run_mod(source)
-        assert m.defs[W_Symbol.make("result")] == w_true
+        assert m.lookup(W_Symbol.make("result")) == w_true
@@ -101,7 +101,7 @@ def test_struct_inheritance2():
     (define r ((raven-constructor struct:posn) 1 2))
     (define x (posn-x r))
     """)
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert ov.value == 1
 
 def test_struct_comparison(source):
@@ -143,7 +143,7 @@ def test_struct_comparison2():
 
     (define result (equal? (lead 1 2) (lead 1 2)))
     """)
-    assert m.defs[W_Symbol.make("result")] == w_true
+    assert m.lookup(W_Symbol.make("result")) == w_true
 
 def test_struct_mutation(source):
     """
@@ -201,7 +201,7 @@ def test_struct_guard2():
     
     (define x (o-ref (make-o 10) 0))
     """)
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert ov.value == 11
 
 @skip
@@ -220,7 +220,7 @@ def test_struct_guard3():
 
     (define x (a-ref (make-b 'x 'y 'z) 0))
     """)
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert ov.value == 1
 
 def test_struct_prefab():
@@ -236,7 +236,7 @@ def test_struct_prefab():
 
     (define result (and (not f) t))
     """)
-    assert m.defs[W_Symbol.make("result")] == w_true
+    assert m.lookup(W_Symbol.make("result")) == w_true
 
 def test_unsafe():
     m = run_mod(
@@ -250,7 +250,7 @@ def test_unsafe():
     (unsafe-struct*-set! p 2 4)
     (define x (unsafe-struct*-ref p 2))
     """)
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert ov.value == 4
 
 def test_unsafe_impersonators():
@@ -264,7 +264,7 @@ def test_unsafe_impersonators():
     (unsafe-struct-set! b 1 2)
     (define x (unsafe-struct-ref b 1))
     """)
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert ov.value == 2
 
 
@@ -283,8 +283,8 @@ def test_struct_prop_procedure():
     (define xval ((x)))
     (define yval ((y)))
     """)
-    assert m.defs[W_Symbol.make("xval")].value == 1
-    assert m.defs[W_Symbol.make("yval")].value == 2
+    assert m.lookup(W_Symbol.make("xval")).value == 1
+    assert m.lookup(W_Symbol.make("yval")).value == 2
 
 def test_struct_prop_procedure_inheritance():
     m = run_mod(
@@ -297,7 +297,7 @@ def test_struct_prop_procedure_inheritance():
     (define b (y (lambda (x) x)))
     (define val (b 10))
     """)
-    assert m.defs[W_Symbol.make("val")].value == 10
+    assert m.lookup(W_Symbol.make("val")).value == 10
 
 def test_struct_prop_procedure_fail():
     e = pytest.raises(SchemeException, run_mod,
@@ -325,7 +325,7 @@ def test_struct_prop_procedure_with_self_arg():
     (define joe-greet (greeter "Joe"))
     (define greeting (joe-greet "Mary"))
     """)
-    ov = m.defs[W_Symbol.make("greeting")]
+    ov = m.lookup(W_Symbol.make("greeting"))
     assert ov.value == "Hi Mary, I'm Joe"
 
 def test_struct_prop_arity():
@@ -348,7 +348,7 @@ def test_struct_prop_arity():
                  (apply pairs more))])))
     (define x (pairs 1 2 3 4))
     """)
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert isinstance(ov, W_Cons)
     e = pytest.raises(SchemeException, run_mod,
     """
@@ -482,5 +482,5 @@ def test_procedure():
     (define proc (procedure-rename (f 1) 'x))
     (define x (proc))
     """)
-    ov = m.defs[W_Symbol.make("x")]
+    ov = m.lookup(W_Symbol.make("x"))
     assert ov.value == 1
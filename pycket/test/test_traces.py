@@ -0,0 +1,149 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Trace shape tests, in the style of PyPy's test_pypy_c: small Racket loops
+# are run by a translated pycket-c with the optimized loops logged, and the
+# operations of one iteration of each loop are checked against bounds on
+# allocations, guards and calls. The tests are skipped without a pycket-c
+# binary (next to targetpycket.py, or given by $PYCKET).
+#
+
+import os
+import subprocess
+from textwrap import dedent
+
+import py
+import pytest
+
+def pycket_executable():
+    exe = os.environ.get("PYCKET", None)
+    if exe is None:
+        exe = str(py.path.local(__file__).dirpath("..", "..", "pycket-c"))
+    if os.access(exe, os.X_OK):
+        return exe
+    return None
+
+class Loop(object):
+    def __init__(self, operations):
+        # the operations after the last label are one iteration of the loop,
+        # the ones before it are the preamble
+        start = 0
+        for i, op in enumerate(operations):
+            if op.name == "label":
+                start = i + 1
+        self.operations = operations[start:]
+
+    def count(self, *prefixes):
+        return len([op for op in self.operations if op.name.startswith(prefixes)])
+
+    def allocations(self):
+        return self.count("new")
+
+    def guards(self):
+        return self.count("guard_")
+
+    def calls(self):
+        return self.count("call")
+
+    def opnames(self):
+        return [op.name for op in self.operations if op.name != "debug_merge_point"]
+
+def parse_loops(logfile):
+    from rpython.tool.logparser import parse_log_file, extract_category
+    from rpython.tool.jitlogparser.parser import SimpleParser
+    log = parse_log_file(logfile)
+    return [Loop(SimpleParser.parse_from_input(text).operations)
+            for text in extract_category(log, "jit-log-opt-loop")]
+
+def test_parse_loops(tmpdir):
+    log = tmpdir.join("jit.log")
+    log.write(dedent("""\
+        [1a2b] {jit-log-opt-loop
+        # Loop 0 () : loop with 7 ops
+        [i0, p1]
+        +100: label(i0, p1, descr=TargetToken(1))
+        +110: i2 = int_lt(i0, 0)
+        guard_false(i2, descr=<Guard0x1>) [i0, p1]
+        +120: i3 = int_sub_ovf(i0, 1)
+        guard_no_overflow(descr=<Guard0x2>) [i0, p1]
+        +130: label(i3, p1, descr=TargetToken(2))
+        +140: p4 = new_with_vtable(descr=<SizeDescr 16>)
+        +150: i5 = call_i(ConstClass(f), i3, descr=<Calli 8 i EF=3>)
+        guard_no_exception(descr=<Guard0x3>) [i3, p1]
+        +160: jump(i5, p1, descr=TargetToken(2))
+        +170: --end of the loop--
+        [1a2c] jit-log-opt-loop}
+        """))
+    loop, = parse_loops(str(log))
+    assert loop.allocations() == 1
+    assert loop.guards() == 1
+    assert loop.calls() == 1
+
+class TestTraces(object):
+    def setup_class(cls):
+        cls.pycket = pycket_executable()
+        if cls.pycket is None:
+            pytest.skip("needs a translated pycket-c (or $PYCKET)")
+
+    def run(self, tmpdir, source):
+        prog = tmpdir.join("prog.rkt")
+        prog.write("#lang pycket\n" + dedent(source))
+        log = tmpdir.join("jit.log")
+        env = dict(os.environ)
+        env["PYPYLOG"] = "jit-log-opt:%s" % log
+        subprocess.check_call([self.pycket, str(prog)], env=env)
+        loops = parse_loops(str(log))
+        assert loops, "no loop was compiled"
+        return loops
+
+    def check(self, tmpdir, source, allocations=0, calls=0, guards=0):
+        for loop in self.run(tmpdir, source):
+            assert loop.allocations() <= allocations, loop.opnames()
+            assert loop.calls() <= calls, loop.opnames()
+            assert loop.guards() <= guards, loop.opnames()
+
+    def test_countdown(self, tmpdir):
+        self.check(tmpdir, """
+        (let countdown ([n 100000]) (if (< n 0) n (countdown (- n 1))))
+        """, guards=4)
+
+    def test_consenv_unboxed(self, tmpdir):
+        # the environments of the let and of the loop variables are virtual
+        self.check(tmpdir, """
+        (let loop ([i 0] [acc 0.0])
+          (if (= i 100000)
+              acc
+              (let ([x (exact->inexact i)])
+                (loop (+ i 1) (+ acc (* x 0.5))))))
+        """, guards=8)
+
+    def test_let_fusion(self, tmpdir):
+        # nested lets with no values yet use FusedLet0Let0Cont, which must
+        # not survive in the trace
+        self.check(tmpdir, """
+        (define (f x) (+ x 1))
+        (let loop ([i 0] [acc 0])
+          (if (= i 100000)
+              acc
+              (let ([a (f i)])
+                (let ([b (f a)])
+                  (loop a (+ acc b))))))
+        """, guards=8)
+
+    def test_env_pruning(self, tmpdir):
+        # the closure only keeps k, the loop does not allocate environments
+        self.check(tmpdir, """
+        (define (make-adder k big)
+          (let ([unused (make-vector big 0)])
+            (lambda (x) (+ x k))))
+        (define add (make-adder 3 1000))
+        (let loop ([i 0] [acc 0])
+          (if (= i 100000) acc (loop (+ i 1) (add acc))))
+        """, guards=8)
+
+    def test_vector_loop(self, tmpdir):
+        self.check(tmpdir, """
+        (define v (make-vector 100000 1))
+        (let loop ([i 0] [acc 0])
+          (if (= i (vector-length v)) acc (loop (+ i 1) (+ acc (vector-ref v i)))))
+        """, guards=10)
@@ -39,7 +39,7 @@ def run_mod_expr(e, v=None, stdlib=False, wrap=False, extra="", srcloc=False):
     expr = "(let () %s)"%e if wrap else e
     defn = "(define #%%pycket-expr %s)"%expr
     mod = run_mod_defs(defn, stdlib=stdlib, extra=extra, srcloc=srcloc)
-    ov = mod.defs[values.W_Symbol.make("#%pycket-expr")]
+    ov = mod.lookup(values.W_Symbol.make("#%pycket-expr"))
     if v:
         assert ov.equal(v)
     return ov
@@ -12,6 +12,8 @@ from rpython.rlib.objectmodel import r_dict, compute_hash, we_are_translated
 from rpython.rlib.rarithmetic import r_longlong, intmask
 from pycket.prims.expose      import make_call_method
 from pycket.base              import W_Object
+from pycket.hamt              import (HAMTBucket, empty_hamt_node, hamt_find,
+                                      hamt_replace)
 
 import rpython.rlib.rweakref as weakref
 from rpython.rlib.rbigint import rbigint, NULLRBIGINT
@@ -875,6 +877,7 @@ class W_Symbol(W_Object):
 break_enabled_key = W_Symbol("break-enabled-key")
 exn_handler_key = W_Symbol("exnh")
 parameterization_key = W_Symbol("parameterization")
+w_default_continuation_prompt_tag = W_ContinuationPromptTag(W_Symbol("default"))
 
 class W_Keyword(W_Object):
     _immutable_fields_ = ["value"]
@@ -952,11 +955,14 @@ class W_SimplePrim(W_Procedure):
         return "<procedure:%s>" % self.name
 
 class W_Prim(W_Procedure):
-    _immutable_fields_ = ["name", "code", "arity"]
-    def __init__ (self, name, code, arity=([],0)):
+    _immutable_fields_ = ["name", "code", "arity", "simple"]
+    def __init__ (self, name, code, arity=([],0), simple=False):
         self.name = name
         self.code = code
         self.arity = arity
+        # simple primitives never look at their continuation, see
+        # App.interpret_direct
+        self.simple = simple
 
     def get_arity(self):
         return self.arity
@@ -1014,10 +1020,13 @@ class W_Continuation(W_Procedure):
 class W_Closure(W_Procedure):
     _immutable_fields_ = ["caselam"]
     @jit.unroll_safe
-    def __init__ (self, caselam, env):
+    def __init__ (self, caselam, env, w_self):
+        # w_self is what the recursive name is bound to, if not the closure
         self.caselam = caselam
+        if w_self is None:
+            w_self = self
         for (i,lam) in enumerate(caselam.lams):
-            vals = lam.collect_frees(caselam.recursive_sym, env, self)
+            vals = lam.collect_frees(caselam.recursive_sym, env, w_self)
             self._set_list(i, ConsEnv.make(vals, env.toplevel_env()))
 
     def tostring(self):
@@ -1035,7 +1044,7 @@ class W_Closure(W_Procedure):
                     caselam.recursive_sym, env)
             return W_Closure1AsEnv.make(vals, caselam, env.toplevel_env())
         envs = [None] * num_lams
-        return W_Closure._make(envs, caselam, env)
+        return W_Closure._make(envs, caselam, env, None)
 
     def get_arity(self):
         return self.caselam.get_arity()
@@ -1055,20 +1064,34 @@ class W_Closure(W_Procedure):
                     raise
             else:
                 frees = self._get_list(i)
-                return (actuals, frees, lam)
+                return (actuals, frees, lam, i)
         raise SchemeException("No matching arity in case-lambda")
 
+    # The interpreter uses the inline cache of the calling App; in traces
+    # the promoted caselam makes _find_lam constant-fold anyway.
+    def _find_lam_cached(self, args, cache):
+        i = cache.lookup(self.caselam)
+        if i < 0:
+            (actuals, frees, lam, i) = self._find_lam(args)
+            cache.record(self.caselam, i)
+            return (actuals, frees, lam)
+        lam = self.caselam.lams[i]
+        return (lam.match_args(args), self._get_list(i), lam)
+
     def call_with_extra_info(self, args, env, cont, calling_app):
         return self._call_with_env_structure(
-                args, env, cont, calling_app.env_structure)
+                args, env, cont, calling_app.env_structure, calling_app.cache)
 
     def call(self, args, env, cont):
         return self._call_with_env_structure(args, env, cont, None)
 
-    def _call_with_env_structure(self, args, env, cont, env_structure):
+    def _call_with_env_structure(self, args, env, cont, env_structure, cache=None):
         jit.promote(self.caselam)
         jit.promote(env_structure)
-        (actuals, frees, lam) = self._find_lam(args)
+        if cache is not None and not jit.we_are_jitted():
+            (actuals, frees, lam) = self._find_lam_cached(args, cache)
+        else:
+            (actuals, frees, lam, _) = self._find_lam(args)
         # specialize on the fact that often we end up executing in the
         # same environment.
         prev = lam.env_structure.prev.find_env_in_chain_speculate(
@@ -1168,7 +1191,10 @@ class W_PromotableClosure(W_Procedure):
     _immutable_fields_ = ["closure"]
 
     def __init__(self, caselam, toplevel_env):
-        self.closure = W_Closure._make([ConsEnv.make([], toplevel_env)] * len(caselam.lams), caselam, toplevel_env)
+        # the only free variable a cached closure can have is its own
+        # recursive name, which has to be bound to the promotable closure
+        envs = [None] * len(caselam.lams)
+        self.closure = W_Closure._make(envs, caselam, toplevel_env, self)
 
     def mark_non_loop(self):
         self.closure.mark_non_loop()
@@ -1195,50 +1221,55 @@ class RootParameterization(object):
         # This table maps ParamKey -> W_ThreadCell
         self.table = {}
 
-# This is a Scheme_Config in Racket
-# Except that Scheme_Config uses a functional hash table and this uses a list that we copy
+# This is a Scheme_Config in Racket, which is a functional hash table too.
+# Extending a parameterization shares everything but the path to the new
+# entries with the parameterization it extends.
 class W_Parameterization(W_Object):
-    _immutable_fields_ = ["root", "keys", "vals"]
+    _immutable_fields_ = ["root", "cells"]
     errorname = "parameterization"
-    def __init__(self, root, keys, vals):
-        #assert len(params) == len(vals)
-        self.keys = keys
-        self.vals = vals
+    def __init__(self, root, cells):
+        # a HAMT mapping ParamKey -> W_ThreadCell
+        self.cells = cells
         self.root = root
-    def extend(self, params, vals): 
+
+    def extend(self, params, vals):
         # why doesn't it like this assert?
         # assert len(params) == len(vals)
-        # FIXME this is awful
-        total = len(params) + len(self.keys)
-        keys = [p.key for p in params]
-        new_keys = [None] * total
-        new_vals = [None] * total
-        for i in range(total):
-            if i < len(params):
-                new_keys[i] = keys[i]
-                new_vals[i] = W_ThreadCell(vals[i], True)
-            else:
-                new_keys[i] = self.keys[i-len(params)]
-                new_vals[i] = self.vals[i-len(params)]
+        cells = self.cells
+        for i, param in enumerate(params):
+            k = param.key
+            cell = W_ThreadCell(vals[i], True)
+            cells = hamt_replace(cells, k.hash, HAMTBucket(k.hash, [k], [cell]))
+        return W_Parameterization(self.root, cells)
 
-        return W_Parameterization(self.root, new_keys, new_vals)
     def get(self, param):
         k = param.key
-        for (i, key) in enumerate(self.keys):
-            if key is k:
-                return self.vals[i]
+        bucket = hamt_find(self.cells, k.hash)
+        if bucket is not None:
+            # the hashes of ParamKeys are unique
+            return bucket.vals[0]
         val = self.root.table[k]
         assert val
         return val
+
     def tostring(self):
         return "#<parameterization>"
 
 # This will need to be thread-specific
-top_level_config = W_Parameterization(RootParameterization(), [], [])
+top_level_config = W_Parameterization(RootParameterization(), empty_hamt_node)
+
+class ParamKeyCounter(object):
+    def __init__(self):
+        self.next = 0
+
+param_key_counter = ParamKeyCounter()
 
-# a token
-class ParamKey(object):
-    pass
+# a token, which is a W_Object to be a key of the HAMT
+class ParamKey(W_Object):
+    _immutable_fields_ = ["hash"]
+    def __init__(self):
+        self.hash = param_key_counter.next
+        param_key_counter.next += 1
 
 def find_param_cell(cont, param):
     assert isinstance(cont, BaseCont)
@@ -1418,6 +1449,8 @@ class W_StringInputPort(W_InputPort):
 class W_FileInputPort(W_InputPort):
     errorname = "input-port"
     def close(self):
+        if self.closed:
+            return
         self.closed = True
         self.file.close()
         self.file = None
@@ -1438,26 +1471,94 @@ class W_FileInputPort(W_InputPort):
     def tell(self):
         return self.file.tell()
 
+class FileOutputState(object):
+    """ Process-wide settings and bookkeeping of file output ports. """
+    def __init__(self):
+        self.buffer_size = 4096
+        # weak references to the file output ports, so that the open ones can
+        # be flushed at exit. Like Racket's plumbers, this does not keep ports
+        # alive. Dead and closed ports are dropped whenever the list has
+        # doubled in size.
+        self.open_ports = []
+        self.compacted_size = 0
+
+    def register(self, port):
+        if len(self.open_ports) >= 2 * self.compacted_size + 16:
+            self.compact()
+        self.open_ports.append(weakref.ref(port))
+
+    def compact(self):
+        open_ports = []
+        for ref in self.open_ports:
+            port = ref()
+            if port is not None and not port.closed:
+                open_ports.append(ref)
+        self.open_ports = open_ports
+        self.compacted_size = len(open_ports)
+
+file_output_state = FileOutputState()
+
 class W_FileOutputPort(W_OutputPort):
     errorname = "output-port"
+
+    # buffer modes as in file-stream-buffer-mode
+    BUFFER_NONE  = "none"
+    BUFFER_LINE  = "line"
+    BUFFER_BLOCK = "block"
+
+    def __init__(self, f, buffer_mode=BUFFER_BLOCK, buffer_size=-1):
+        self.closed = False
+        self.file = f
+        self.buffer_mode = buffer_mode
+        # -1 uses the size set with --output-buffer-size, which is only known
+        # after the standard ports are created
+        self.buffer_size = buffer_size
+        self.buffer = StringBuilder()
+        file_output_state.register(self)
+
     def write(self, str):
-        self.file.write(str)
-        self.file.flush() # flushes too often
+        self.buffer.append(str)
+        mode = self.buffer_mode
+        buffer_size = self.buffer_size
+        if buffer_size < 0:
+            buffer_size = file_output_state.buffer_size
+        if (mode == W_FileOutputPort.BUFFER_NONE or
+                self.buffer.getlength() >= buffer_size or
+                (mode == W_FileOutputPort.BUFFER_LINE and "\n" in str)):
+            self.flush()
+
     def flush(self):
+        if self.buffer.getlength():
+            self.file.write(self.buffer.build())
+            self.buffer = StringBuilder()
         self.file.flush()
+
+    def set_buffer_mode(self, mode):
+        self.buffer_mode = mode
+        if mode == W_FileOutputPort.BUFFER_NONE:
+            self.flush()
+
     def close(self):
+        if self.closed:
+            return
+        self.flush()
         self.closed = True
         self.file.close()
         self.file = None
-    def __init__(self, f):
-        self.closed = False
-        self.file = f
 
     def seek(self, offset, end=False):
+        self.flush()
         if end:
             self.file.seek(0, 2)
         else:
             self.file.seek(offset, 0)
 
     def tell(self):
-        return self.file.tell()
+        return self.file.tell() + self.buffer.getlength()
+
+    @staticmethod
+    def flush_all():
+        for ref in file_output_state.open_ports:
+            port = ref()
+            if port is not None and not port.closed:
+                port.flush()
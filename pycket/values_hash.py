@@ -1,10 +1,18 @@
 from pycket.base import W_Object, SingletonMeta
 from pycket import values
 from pycket.cont import continuation, label
+from pycket.error import SchemeException
+from pycket.hamt import (HAMTBucket, HAMTNode, empty_hamt_node, hamt_find,
+                         hamt_replace, hamt_items, hamt_nth, hamt_buckets)
 
 from rpython.rlib.objectmodel import r_dict, compute_hash, import_from_mixin
 from rpython.rlib import rerased
 
+class UndecidedEqual(Exception):
+    """ raised when building a table from lists needs equal? on keys that
+    only Racket code can compare, see pycket.prims.equal.equal_nocont, and
+    for keys that have no equal-hash code, see equal_hash_code """
+
 class W_HashTable(W_Object):
     errorname = "hash"
     _attrs_ = []
@@ -28,6 +36,40 @@ class W_HashTable(W_Object):
         # see get_dict_item at the bottom of the file for the interface
         raise NotImplementedError("abstract method")
 
+    # Iteration cursors are positions as understood by get_item. Positions of
+    # existing keys do not move when their value is replaced, so a cursor
+    # stays valid across updates that keep the size of the table.
+
+    def hash_iterate_next(self, pos):
+        """ return the first valid position >= pos, or -1 if there is none """
+        raise NotImplementedError("abstract method")
+
+    def hash_iterate_item(self, pos):
+        if pos >= 0:
+            try:
+                return self.get_item(pos)
+            except KeyError:
+                pass
+            except IndexError:
+                pass
+        raise SchemeException("hash-iterate: no element at index %s" % pos)
+
+    # The iteration primitives get keys and values through these, so that
+    # impersonated tables can run their interposition procedures.
+
+    @label
+    def hash_iterate_key(self, pos, env, cont):
+        from pycket.interpreter import return_value
+        w_key, _ = self.hash_iterate_item(pos)
+        return return_value(w_key, env, cont)
+
+    @label
+    def hash_iterate_pair(self, pos, env, cont):
+        """ returns the key and the value at pos as two values """
+        from pycket.interpreter import return_multi_vals
+        w_key, w_val = self.hash_iterate_item(pos)
+        return return_multi_vals(values.Values.make([w_key, w_val]), env, cont)
+
 
 class W_SimpleHashTable(W_HashTable):
     _attrs_ = ['data']
@@ -67,6 +109,9 @@ class W_SimpleHashTable(W_HashTable):
     def length(self):
         return len(self.data)
 
+    def hash_iterate_next(self, pos):
+        return next_dict_index(self.data, pos)
+
 class W_EqvHashTable(W_SimpleHashTable):
     @staticmethod
     def hash_value(k):
@@ -97,43 +142,92 @@ class W_EqHashTable(W_SimpleHashTable):
     def get_item(self, i):
         return get_dict_item(self.data, i)
 
-def equal_hash_ref_loop(data, idx, key, env, cont):
+class EqualHashStorage(object):
+    """ storage of the object strategy. The entries are kept in insertion
+    order in keys/vals, buckets maps an equal-hash code to the indexes of the
+    entries with that code. Only keys in the same bucket are compared with
+    equal?. Keys that contain impersonators have no hash code, their indexes
+    are in unhashed and they are compared with every key. """
+
+    def __init__(self):
+        self.buckets = {}
+        self.unhashed = []
+        self.keys = []
+        self.vals = []
+
+    def bucket(self, w_key):
+        """ raises UndecidedEqual if w_key has no hash code """
+        from pycket.prims.equal import equal_hash_code
+        h = equal_hash_code(w_key)
+        bucket = self.buckets.get(h, None)
+        if bucket is None:
+            bucket = []
+            self.buckets[h] = bucket
+        return bucket
+
+    def candidates(self, w_key):
+        """ returns the list of indexes a new entry for w_key is added to, and
+        the indexes of the entries w_key has to be compared with """
+        try:
+            bucket = self.bucket(w_key)
+        except UndecidedEqual:
+            return self.unhashed, range(len(self.keys))
+        if self.unhashed:
+            return bucket, bucket + self.unhashed
+        return bucket, bucket
+
+    def append(self, bucket, w_key, w_val):
+        bucket.append(len(self.keys))
+        self.keys.append(w_key)
+        self.vals.append(w_val)
+
+    def items(self):
+        return [(self.keys[i], self.vals[i]) for i in range(len(self.keys))]
+
+def equal_hash_ref_loop(storage, bucket, idx, key, env, cont):
     from pycket.interpreter import return_value
     from pycket.prims.equal import equal_func, EqualInfo
-    if idx >= len(data):
+    if idx >= len(bucket):
         return return_value(None, env, cont)
-    k, v = data[idx]
+    i = bucket[idx]
+    k = storage.keys[i]
+    if k.eqv(key):
+        return return_value(storage.vals[i], env, cont)
     info = EqualInfo.BASIC_SINGLETON
     return equal_func(k, key, info, env,
-            catch_ref_is_equal_cont(data, idx, key, v, env, cont))
+            catch_ref_is_equal_cont(storage, bucket, idx, key, env, cont))
 
 @continuation
-def catch_ref_is_equal_cont(data, idx, key, v, env, cont, _vals):
+def catch_ref_is_equal_cont(storage, bucket, idx, key, env, cont, _vals):
     from pycket.interpreter import check_one_val, return_value
     val = check_one_val(_vals)
     if val is not values.w_false:
-        return return_value(v, env, cont)
-    return equal_hash_ref_loop(data, idx + 1, key, env, cont)
+        return return_value(storage.vals[bucket[idx]], env, cont)
+    return equal_hash_ref_loop(storage, bucket, idx + 1, key, env, cont)
 
-def equal_hash_set_loop(data, idx, key, val, env, cont):
-    from pycket.interpreter import check_one_val, return_value
+def equal_hash_set_loop(storage, home, bucket, idx, key, val, env, cont):
+    from pycket.interpreter import return_value
     from pycket.prims.equal import equal_func, EqualInfo
-    if idx >= len(data):
-        data.append((key, val))
+    if idx >= len(bucket):
+        storage.append(home, key, val)
+        return return_value(values.w_void, env, cont)
+    i = bucket[idx]
+    k = storage.keys[i]
+    if k.eqv(key):
+        storage.vals[i] = val
         return return_value(values.w_void, env, cont)
-    k, _ = data[idx]
     info = EqualInfo.BASIC_SINGLETON
     return equal_func(k, key, info, env,
-            catch_set_is_equal_cont(data, idx, key, val, env, cont))
+            catch_set_is_equal_cont(storage, home, bucket, idx, key, val, env, cont))
 
 @continuation
-def catch_set_is_equal_cont(data, idx, key, val, env, cont, _vals):
+def catch_set_is_equal_cont(storage, home, bucket, idx, key, val, env, cont, _vals):
     from pycket.interpreter import check_one_val, return_value
     cmp = check_one_val(_vals)
     if cmp is not values.w_false:
-        data[idx] = (key, val)
+        storage.vals[bucket[idx]] = val
         return return_value(values.w_void, env, cont)
-    return equal_hash_set_loop(data, idx + 1, key, val, env, cont)
+    return equal_hash_set_loop(storage, home, bucket, idx + 1, key, val, env, cont)
 
 
 class HashmapStrategy(object):
@@ -151,6 +245,9 @@ class HashmapStrategy(object):
     def get_item(self, w_dict, i):
         raise NotImplementedError("abstract base class")
 
+    def iterate_next(self, w_dict, pos):
+        raise NotImplementedError("abstract base class")
+
     def length(self, w_dict):
         raise NotImplementedError("abstract base class")
 
@@ -206,6 +303,9 @@ class UnwrappedHashmapStrategyMixin(object):
         key, w_val = get_dict_item(self.unerase(w_dict.hstorage), i)
         return self.wrap(key), w_val
 
+    def iterate_next(self, w_dict, pos):
+        return next_dict_index(self.unerase(w_dict.hstorage), pos)
+
     def length(self, w_dict):
         return len(self.unerase(w_dict.hstorage))
 
@@ -249,6 +349,9 @@ class EmptyHashmapStrategy(HashmapStrategy):
     def get_item(self, w_dict, i):
         raise IndexError
 
+    def iterate_next(self, w_dict, pos):
+        return -1
+
     def length(self, w_dict):
         return 0
 
@@ -279,25 +382,53 @@ class ObjectHashmapStrategy(HashmapStrategy):
     unerase = staticmethod(unerase)
 
     def get(self, w_dict, w_key, env, cont):
-        return equal_hash_ref_loop(self.unerase(w_dict.hstorage), 0, w_key, env, cont)
+        storage = self.unerase(w_dict.hstorage)
+        _, bucket = storage.candidates(w_key)
+        return equal_hash_ref_loop(storage, bucket, 0, w_key, env, cont)
 
     def set(self, w_dict, w_key, w_val, env, cont):
-        return equal_hash_set_loop(self.unerase(w_dict.hstorage), 0, w_key, w_val, env, cont)
+        storage = self.unerase(w_dict.hstorage)
+        home, bucket = storage.candidates(w_key)
+        return equal_hash_set_loop(storage, home, bucket, 0, w_key, w_val,
+                                   env, cont)
 
     def items(self, w_dict):
-        return self.unerase(w_dict.hstorage)
+        return self.unerase(w_dict.hstorage).items()
 
     def get_item(self, w_dict, i):
-        try:
-            return self.unerase(w_dict.hstorage)[i]
-        except IndexError:
-            raise
+        storage = self.unerase(w_dict.hstorage)
+        if i >= len(storage.keys):
+            raise IndexError
+        return storage.keys[i], storage.vals[i]
+
+    def iterate_next(self, w_dict, pos):
+        # entries are never removed, so every index below the size is valid
+        if pos < len(self.unerase(w_dict.hstorage).keys):
+            return pos
+        return -1
 
     def length(self, w_dict):
-        return len(self.unerase(w_dict.hstorage))
+        return len(self.unerase(w_dict.hstorage).keys)
 
     def create_storage(self, keys, vals):
-        return self.erase([(k, vals[i]) for i, k in enumerate(keys)])
+        """ raises UndecidedEqual if keys can only be compared by running
+        Racket code or have no hash code, see build_equal_hash """
+        from pycket.prims.equal import equal_nocont
+        storage = EqualHashStorage()
+        for i, w_key in enumerate(keys):
+            bucket = storage.bucket(w_key)
+            found = False
+            for j in bucket:
+                cmp = equal_nocont(storage.keys[j], w_key)
+                if cmp == -1:
+                    raise UndecidedEqual
+                if cmp == 1:
+                    storage.vals[j] = vals[i]
+                    found = True
+                    break
+            if not found:
+                storage.append(bucket, w_key, vals[i])
+        return self.erase(storage)
 
 
 class FixnumHashmapStrategy(HashmapStrategy):
@@ -408,6 +539,9 @@ class W_EqualHashTable(W_HashTable):
     def get_item(self, i):
         return self.strategy.get_item(self, i)
 
+    def hash_iterate_next(self, pos):
+        return self.strategy.iterate_next(self, pos)
+
     def length(self):
         return self.strategy.length(self)
 
@@ -416,6 +550,308 @@ class W_EqualHashTable(W_HashTable):
         return "#hash(%s)" % " ".join(lst)
 
 
+def build_equal_hash(keys, vals, env, cont):
+    """ a new mutable equal?-based table with the keys and values, added in
+    order """
+    from pycket.interpreter import return_value
+    try:
+        table = W_EqualHashTable(keys, vals)
+    except UndecidedEqual:
+        return equal_hash_build_loop(W_EqualHashTable([], []), keys, vals, 0,
+                                     env, cont)
+    return return_value(table, env, cont)
+
+def equal_hash_build_loop(table, keys, vals, i, env, cont):
+    from pycket.interpreter import return_value
+    if i >= len(keys):
+        return return_value(table, env, cont)
+    return table.hash_set(keys[i], vals[i], env,
+            equal_hash_build_cont(table, keys, vals, i, env, cont))
+
+@continuation
+def equal_hash_build_cont(table, keys, vals, i, env, cont, _vals):
+    return equal_hash_build_loop(table, keys, vals, i + 1, env, cont)
+
+# ____________________________________________________________
+# persistent immutable hash tables, see pycket.hamt
+
+HASH_REF, HASH_SET, HASH_REMOVE = range(3)
+
+# the hash code of the bucket for the keys of equal? tables that have no hash
+# code, which gets searched for every key
+UNHASHED_KEY_HASH = 0x2545f491
+
+class W_ImmutableHashTable(W_HashTable):
+    """ abstract base of immutable hash tables, which are persistent. The
+    subclasses decide how keys are hashed and compared. """
+    _attrs_ = ["root", "size"]
+    _immutable_fields_ = ["root", "size"]
+
+    def __init__(self, root, size):
+        self.root = root
+        self.size = size
+
+    def make_empty(self):
+        raise NotImplementedError("abstract method")
+
+    def hash_key(self, k):
+        """ raises UndecidedEqual if k has no hash code, these keys are
+        stored under UNHASHED_KEY_HASH """
+        raise NotImplementedError("abstract method")
+
+    def unhashed_bucket(self):
+        return None
+
+    def compare_keys(self, a, b):
+        """ return 1 if the keys are equal, 0 if they are not and -1 if this
+        needs to be decided by equal? """
+        raise NotImplementedError("abstract method")
+
+    def make(self, root, size):
+        raise NotImplementedError("abstract method")
+
+    def from_lists(self, keys, vals):
+        """ build a table of the same kind. Keys that need equal? to be told
+        apart are compared with equal_nocont; raises UndecidedEqual if that
+        would take running Racket code, see build_immutable_hash. """
+        from pycket.prims.equal import equal_nocont
+        root = empty_hamt_node
+        size = 0
+        for i, k in enumerate(keys):
+            h = self.hash_key(k)
+            bucket = hamt_find(root, h)
+            if bucket is None:
+                bucket = HAMTBucket(h, [k], [vals[i]])
+                size += 1
+            else:
+                idx = -1
+                for j, other in enumerate(bucket.keys):
+                    cmp = self.compare_keys(other, k)
+                    if cmp == -1:
+                        cmp = equal_nocont(other, k)
+                        if cmp == -1:
+                            raise UndecidedEqual
+                    if cmp == 1:
+                        idx = j
+                        break
+                bucket, added = _bucket_set(bucket, idx, k, vals[i])
+                size += added
+            root = hamt_replace(root, h, bucket)
+        return self.make(root, size)
+
+    def immutable(self):
+        return True
+
+    def hash_items(self):
+        return hamt_items(self.root, [])
+
+    # the position of an entry is its index in the iteration order of the
+    # trie, which hamt_nth finds without building the list of items
+
+    def get_item(self, i):
+        if i >= self.size:
+            raise IndexError
+        bucket, j = hamt_nth(self.root, i)
+        return bucket.keys[j], bucket.vals[j]
+
+    def hash_iterate_next(self, pos):
+        if pos < self.size:
+            return pos
+        return -1
+
+    def length(self):
+        return self.size
+
+    def tostring(self):
+        lst = [values.W_Cons.make(k, v).tostring() for k, v in self.hash_items()]
+        return "#hash(%s)" % " ".join(lst)
+
+    @label
+    def hash_set(self, k, v, env, cont):
+        raise SchemeException("hash-set!: contract violation, expected a mutable hash table")
+
+    @label
+    def hash_ref(self, k, env, cont):
+        return self._find(k, HASH_REF, None, env, cont)
+
+    @label
+    def hash_iset(self, k, v, env, cont):
+        return self._find(k, HASH_SET, v, env, cont)
+
+    @label
+    def hash_iremove(self, k, env, cont):
+        return self._find(k, HASH_REMOVE, None, env, cont)
+
+    def _find(self, k, op, v, env, cont):
+        try:
+            h = self.hash_key(k)
+        except UndecidedEqual:
+            # k can be equal? to any key
+            h = UNHASHED_KEY_HASH
+            buckets = hamt_buckets(self.root, [])
+        else:
+            buckets = []
+            bucket = hamt_find(self.root, h)
+            if bucket is not None:
+                buckets.append(bucket)
+            if h != UNHASHED_KEY_HASH:
+                bucket = self.unhashed_bucket()
+                if bucket is not None:
+                    buckets.append(bucket)
+        return immutable_hash_find_loop(self, buckets, 0, 0, k, h, op, v,
+                                        env, cont)
+
+    def _finish(self, bucket, idx, k, h, op, v, env, cont):
+        """ bucket and idx locate the entry equal? to k, if idx is -1 there
+        is none and h is where k belongs """
+        from pycket.interpreter import return_value
+        if op == HASH_REF:
+            if idx < 0:
+                return return_value(None, env, cont)
+            return return_value(bucket.vals[idx], env, cont)
+        if op == HASH_SET:
+            if idx < 0:
+                bucket = hamt_find(self.root, h)
+            if bucket is None:
+                new_bucket = HAMTBucket(h, [k], [v])
+                added = 1
+            else:
+                new_bucket, added = _bucket_set(bucket, idx, k, v)
+            result = self.make(hamt_replace(self.root, new_bucket.hash, new_bucket),
+                               self.size + added)
+            return return_value(result, env, cont)
+        assert op == HASH_REMOVE
+        if idx < 0:
+            return return_value(self, env, cont)
+        new_bucket = _bucket_remove(bucket, idx)
+        result = self.make(hamt_replace(self.root, bucket.hash, new_bucket),
+                           self.size - 1)
+        return return_value(result, env, cont)
+
+def _bucket_set(bucket, idx, k, v):
+    if idx < 0:
+        return HAMTBucket(bucket.hash, bucket.keys + [k], bucket.vals + [v]), 1
+    vals = bucket.vals[:]
+    vals[idx] = v
+    return HAMTBucket(bucket.hash, bucket.keys, vals), 0
+
+def _bucket_remove(bucket, idx):
+    if len(bucket.keys) == 1:
+        return None
+    keys = bucket.keys[:idx] + bucket.keys[idx + 1:]
+    vals = bucket.vals[:idx] + bucket.vals[idx + 1:]
+    return HAMTBucket(bucket.hash, keys, vals)
+
+def immutable_hash_find_loop(table, buckets, b, idx, key, h, op, val, env, cont):
+    from pycket.prims.equal import equal_func, EqualInfo
+    while b < len(buckets):
+        bucket = buckets[b]
+        while idx < len(bucket.keys):
+            cmp = table.compare_keys(bucket.keys[idx], key)
+            if cmp == 1:
+                return table._finish(bucket, idx, key, h, op, val, env, cont)
+            if cmp == -1:
+                info = EqualInfo.BASIC_SINGLETON
+                return equal_func(bucket.keys[idx], key, info, env,
+                        immutable_hash_find_cont(table, buckets, b, idx, key, h,
+                                                 op, val, env, cont))
+            idx += 1
+        b += 1
+        idx = 0
+    return table._finish(None, -1, key, h, op, val, env, cont)
+
+@continuation
+def immutable_hash_find_cont(table, buckets, b, idx, key, h, op, val, env, cont, _vals):
+    from pycket.interpreter import check_one_val
+    if check_one_val(_vals) is not values.w_false:
+        return table._finish(buckets[b], idx, key, h, op, val, env, cont)
+    return immutable_hash_find_loop(table, buckets, b, idx + 1, key, h, op,
+                                    val, env, cont)
+
+def build_immutable_hash(table, keys, vals, env, cont):
+    """ adds the keys and values to the immutable table, in order. Unlike
+    from_lists, this can compare keys with every kind of equal?. """
+    from pycket.interpreter import return_value
+    try:
+        result = table.from_lists(keys, vals)
+    except UndecidedEqual:
+        return immutable_hash_build_loop(table, keys, vals, 0, env, cont)
+    return return_value(result, env, cont)
+
+def immutable_hash_build_loop(table, keys, vals, i, env, cont):
+    from pycket.interpreter import return_value
+    if i >= len(keys):
+        return return_value(table, env, cont)
+    return table.hash_iset(keys[i], vals[i], env,
+            immutable_hash_build_cont(keys, vals, i, env, cont))
+
+@continuation
+def immutable_hash_build_cont(keys, vals, i, env, cont, _vals):
+    from pycket.interpreter import check_one_val
+    table = check_one_val(_vals)
+    assert isinstance(table, W_ImmutableHashTable)
+    return immutable_hash_build_loop(table, keys, vals, i + 1, env, cont)
+
+class W_ImmutableEqHashTable(W_ImmutableHashTable):
+    def make_empty(self):
+        return empty_immutable_eq_hash
+
+    def make(self, root, size):
+        return W_ImmutableEqHashTable(root, size)
+
+    def hash_key(self, k):
+        return W_EqHashTable.hash_value(k)
+
+    def compare_keys(self, a, b):
+        from pycket.prims.equal import eqp_logic
+        return 1 if eqp_logic(a, b) else 0
+
+class W_ImmutableEqvHashTable(W_ImmutableHashTable):
+    def make_empty(self):
+        return empty_immutable_eqv_hash
+
+    def make(self, root, size):
+        return W_ImmutableEqvHashTable(root, size)
+
+    def hash_key(self, k):
+        return k.hash_eqv()
+
+    def compare_keys(self, a, b):
+        return 1 if a.eqv(b) else 0
+
+class W_ImmutableEqualHashTable(W_ImmutableHashTable):
+    def make_empty(self):
+        return empty_immutable_equal_hash
+
+    def make(self, root, size):
+        return W_ImmutableEqualHashTable(root, size)
+
+    def hash_key(self, k):
+        from pycket.prims.equal import equal_hash_code
+        return equal_hash_code(k)
+
+    def unhashed_bucket(self):
+        return hamt_find(self.root, UNHASHED_KEY_HASH)
+
+    def compare_keys(self, a, b):
+        if a.eqv(b):
+            return 1
+        # keys of the types that have their own hashmap strategy can be
+        # compared directly, everything else goes through equal?
+        if _is_simple_equal_key(a) and _is_simple_equal_key(b):
+            return 1 if a.equal(b) else 0
+        return -1
+
+def _is_simple_equal_key(w_key):
+    return (isinstance(w_key, values.W_Fixnum) or
+            isinstance(w_key, values.W_Symbol) or
+            isinstance(w_key, values.W_String) or
+            isinstance(w_key, values.W_Bytes))
+
+empty_immutable_eq_hash = W_ImmutableEqHashTable(empty_hamt_node, 0)
+empty_immutable_eqv_hash = W_ImmutableEqvHashTable(empty_hamt_node, 0)
+empty_immutable_equal_hash = W_ImmutableEqualHashTable(empty_hamt_node, 0)
+
 
 def get_dict_item(d, i):
     """ return item of dict d at position i. Raises a KeyError if the index
@@ -423,6 +859,13 @@ def get_dict_item(d, i):
     the dict. """
     return d.items()[i]
 
+def next_dict_index(d, i):
+    """ return the first position >= i of dict d that carries an entry, or -1
+    if there is none. Untranslated, positions are indexes into d.items(). """
+    if i < len(d):
+        return i
+    return -1
+
 def ll_get_dict_item(RES, dict, i):
     from rpython.rtyper.lltypesystem import lltype
     from rpython.rtyper.lltypesystem.rdict import recast
@@ -462,4 +905,25 @@ class Entry(ExtRegistryEntry):
         v_res = hop.gendirectcall(ll_get_dict_item, cTUPLE, v_dict, v_index)
         return v_res
 
+def ll_next_dict_index(dict, i):
+    entries = dict.entries
+    entries_len = len(entries)
+    while i < entries_len:
+        if entries.valid(i):
+            return i
+        i += 1
+    return -1
+
+class NextIndexEntry(ExtRegistryEntry):
+    _about_ = next_dict_index
 
+    def compute_result_annotation(self, s_d, s_i):
+        from rpython.annotator.model import SomeInteger
+        return SomeInteger()
+
+    def specialize_call(self, hop):
+        from rpython.rtyper.lltypesystem import lltype
+        dictrepr = hop.rtyper.getrepr(hop.args_s[0])
+        v_dict, v_index = hop.inputargs(dictrepr, lltype.Signed)
+        hop.exception_cannot_occur()
+        return hop.gendirectcall(ll_next_dict_index, v_dict, v_index)
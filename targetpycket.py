@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 #
 
-from pycket.entry_point import target
+from pycket.entry_point import target, jitpolicy
 
 
 if __name__ == '__main__':